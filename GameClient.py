@@ -1,70 +1,227 @@
-import os
 import json
 import copy
-from collections import OrderedDict
+import os
+import argparse
+import logging
+import threading
+import time
 
-import paho.mqtt.client as paho
-from paho import mqtt
-from dotenv import load_dotenv
+from pydantic import ValidationError
 
-from InputTypes import NewPlayer
+from InputTypes import NewPlayer, LobbyConfig, MoveBatch, ProfileRequest
+from checkpoint import CheckpointStore, lobby_record, restore_game
 from game import Game
+from gameLogging import log_board, setup_logging
+from lobbyRegistry import Lobby, LobbyRegistry
+from mapPool import MapPool, parse_size
+from metrics import ServerMetrics, serve_metrics
 from moveset import Moveset
+from profiling import Profiler, ProfileSession
+from publisher import TickPublisher
+from replay import GameRecorder, recording_path
+from stateDelta import DeltaTracker
+from tickScheduler import TickScheduler
+from wireFormat import MOVES_MAGIC, decode_moves, encode_state
+from transport import Transport, PahoTransport
 
-# setting callbacks for different events to see if it works, print the message etc.
+log = logging.getLogger('GameClient')
+
+# setting callbacks for different events to see if it works, log the message etc.
 def on_connect(client, userdata, flags, rc, properties=None):
     """
-        Prints the result of the connection with a reasoncode to stdout ( used as callback for connect )
+        Logs the result of the connection with a reasoncode ( used as callback for connect )
         :param client: the client itself
         :param userdata: userdata is set when initiating the client, here it is userdata=None
         :param flags: these are response flags sent by the broker
         :param rc: stands for reasonCode, which is a code for the connection result
         :param properties: can be used in MQTTv5, but is optional
     """
-    print("CONNACK received with code %s." % rc)
+    log.info("CONNACK received with code %s.", rc)
 
 
 # with this callback you can see if your publish was successful
 def on_publish(client, userdata, mid, properties=None):
     """
-        Prints mid to stdout to reassure a successful publish ( used as callback for publish )
+        Logs mid at DEBUG to reassure a successful publish ( used as callback for publish )
         :param client: the client itself
         :param userdata: userdata is set when initiating the client, here it is userdata=None
         :param mid: variable returned from the corresponding publish() call, to allow outgoing messages to be tracked
         :param properties: can be used in MQTTv5, but is optional
     """
-    print("mid: " + str(mid))
+    log.debug("mid: %s", mid)
 
 
-# print which topic was subscribed to
+# log which topic was subscribed to
 def on_subscribe(client, userdata, mid, granted_qos, properties=None):
     """
-        Prints a reassurance for successfully subscribing
+        Logs a reassurance for successfully subscribing
         :param client: the client itself
         :param userdata: userdata is set when initiating the client, here it is userdata=None
         :param mid: variable returned from the corresponding publish() call, to allow outgoing messages to be tracked
         :param granted_qos: this is the qos that you declare when subscribing, use the same one for publishing
         :param properties: can be used in MQTTv5, but is optional
     """
-    print("Subscribed: " + str(mid) + " " + str(granted_qos))
+    log.info("Subscribed: %s %s", mid, granted_qos)
 
 
 # triggered on message from subscription
 def on_message(client, userdata, msg):
     """
         Runs game logic and dispatches behavior depending on route
-        :param client: the client itself
+        :param client: the GameServer holding the lobby state
         :param userdata: userdata is set when initiating the client, here it is userdata=None
         :param msg: the message with topic and payload
     """
-    print("message: " + msg.topic + " " + str(msg.qos) + " " + str(msg.payload))
+    metrics = client.metrics
+    # Counter.inc() inlined, this runs for every message
+    metrics.messages_in.value += 1
+    timed = metrics.messages_in.value % metrics.sample_every == 0
+    if timed:
+        start = time.perf_counter()
+    log.debug("message: %s %s %s", msg.topic, msg.qos, msg.payload)
     topic_list = msg.topic.split("/")
 
     # Validate it is input we can deal with
     if topic_list[-1] in dispatch.keys(): 
-        dispatch[topic_list[-1]](client, topic_list, msg.payload)
+        session = client.profiling
+        if session is None:
+            dispatch[topic_list[-1]](client, topic_list, msg.payload)
+        else:
+            # A capture is running, it profiles the message if it covers the lobby
+            session.run(get_lobby_name(msg.topic, msg.payload), dispatch[topic_list[-1]], client, topic_list, msg.payload)
+    if timed:
+        metrics.dispatch.observe(time.perf_counter() - start)
 
 
+def get_lobby_name(topic, msg_payload):
+    """
+        Name of the lobby a message belongs to, taken from the topic or from the new_game payload
+        :return: the lobby name, None when the message names no lobby
+    """
+    if topic == 'new_game':
+        try:
+            lobby_name = json.loads(msg_payload).get('lobby_name')
+        except (ValueError, AttributeError):
+            return None
+        return lobby_name if isinstance(lobby_name, str) else None
+    topic_list = topic.split("/")
+    if len(topic_list) >= 3 and topic_list[0] == 'games':
+        return topic_list[1]
+    return None
+
+
+class GameServer:
+    SUBSCRIPTIONS = ('new_game', 'games/+/start', 'games/+/+/move', 'games/+/config', 'games/+/+/resync')
+    SWEEP_INTERVAL = 5.0 # Seconds between checks for idle lobbies
+    RECORDINGS_DIR = 'recordings' # Where lobbies with config.record write their games
+
+    def __init__(self, transport: Transport, default_config: LobbyConfig = None, lobbies: LobbyRegistry = None,
+                 checkpoints: CheckpointStore = None, maps: MapPool = None):
+        """
+        Holds the lobby state of the game server and runs the dispatched functions on messages from transport
+        :param default_config: options of lobbies that set no config of their own
+        :param lobbies: registry with the lobby limits, a default one when omitted
+        :param checkpoints: store the lobbies are checkpointed to and restored from on start
+        :param maps: pool of pre-generated maps games start on, generated on start
+        """
+        self.transport = transport
+        self.transport.on_message = self.on_message
+        self.default_config = default_config or LobbyConfig()
+        self.lobbies = lobbies if lobbies is not None else LobbyRegistry()
+        self.checkpoints = checkpoints
+        self.maps = maps
+        # Messages and turn timers arrive on different threads
+        self.lock = threading.RLock()
+        self.scheduler = TickScheduler()
+        self.metrics = ServerMetrics()
+        self.metrics_interval = 10.0 # Seconds between metrics samples, each one is published on metrics_topic
+        self.metrics_topic = 'games/$sys/metrics'
+        self.profiler: Profiler = None # Takes profiling requests on admin_topic when set
+        self.profiling: ProfileSession = None # Capture running now
+        self.admin_topic = 'games/$sys/admin/profile'
+
+    def on_message(self, client, userdata, msg):
+        with self.lock:
+            on_message(self, userdata, msg)
+
+    def on_timer(self, lobby, tick, deadline):
+        with self.lock:
+            turn_deadline(self, lobby, tick, deadline)
+
+    def on_sweep(self):
+        with self.lock:
+            sweep_lobbies(self)
+        self.scheduler.call_later(self.SWEEP_INTERVAL, self.on_sweep)
+
+    def on_checkpoint(self):
+        with self.lock:
+            checkpoint_lobbies(self)
+        self.scheduler.call_later(self.checkpoints.interval, self.on_checkpoint)
+
+    def on_metrics(self):
+        with self.lock:
+            publish_metrics(self)
+        self.scheduler.call_later(self.metrics_interval, self.on_metrics)
+
+    def on_profile_status(self, status):
+        # Runs on the thread that wrote the capture
+        with self.lock:
+            publish_profile_status(self, status)
+
+    def post(self, lobby_name, fn, *args):
+        """
+        Runs fn(*args) as work of the lobby, servers that run lobbies apart queue it behind the lobby's messages
+        """
+        fn(*args)
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.metrics.messages_out.inc()
+        return self.transport.publish(topic, payload, qos, retain)
+
+    def publish_many(self, messages):
+        self.metrics.messages_out.inc(len(messages))
+        return self.transport.publish_many(messages)
+
+    def queue_depths(self) -> dict[str, int]:
+        """
+        Work waiting to be handled by name of the queue, for the metrics. Messages are handled as they arrive here
+        """
+        return {}
+
+    def start(self):
+        if self.checkpoints is not None:
+            with self.lock:
+                restore_lobbies(self)
+        for topic in GameServer.SUBSCRIPTIONS:
+            self.transport.subscribe(topic)
+        if self.profiler is not None:
+            self.transport.subscribe(self.admin_topic, qos=1)
+        self.start_housekeeping()
+
+    def start_housekeeping(self):
+        """
+        Schedules the sweep of idle lobbies, the checkpoints and the metrics samples, and starts filling the map pool
+        """
+        if self.maps is not None:
+            self.maps.start()
+        self.scheduler.call_later(self.SWEEP_INTERVAL, self.on_sweep)
+        self.scheduler.call_later(self.metrics_interval, self.on_metrics)
+        if self.checkpoints is not None:
+            self.scheduler.call_later(self.checkpoints.interval, self.on_checkpoint)
+
+    def serve_forever(self):
+        self.start()
+        self.transport.loop_forever()
+
+    def lobby_updated(self, lobby_name):
+        """
+        Called after a lobby's roster, config or started flag changed
+        """
+        pass
+
+    def lobby_removed(self, lobby_name):
+        pass
+
 
 # Dispatched function, adds player to a lobby & team
 def add_player(client, topic_list, msg_payload):
@@ -72,29 +229,37 @@ def add_player(client, topic_list, msg_payload):
     try:
         player = NewPlayer(**json.loads(msg_payload))
     except:
-        print("ValidationError in create_game")
+        log.warning("ValidationError in create_game: %s", msg_payload)
         return
     
     # If lobby doesn't exists...
-    if player.lobby_name not in client.team_dict.keys():
-        client.team_dict[player.lobby_name] = {}
-        client.team_dict[player.lobby_name]['started'] = False
-
-    if client.team_dict[player.lobby_name]['started']:
+    lobby = client.lobbies.get(player.lobby_name)
+    if lobby is None:
+        if len(client.lobbies) >= client.lobbies.max_lobbies:
+            # Full, unless some lobbies went idle since the last sweep
+            sweep_lobbies(client)
+        lobby = client.lobbies.create(player.lobby_name, client.default_config)
+        if lobby is None:
+            publish_error_to_lobby(client, player.lobby_name, "Server is full, please try again later")
+            return
+    client.lobbies.touch(lobby)
+
+    if lobby.started:
         publish_error_to_lobby(client, player.lobby_name, "Game has already started, please make a new lobby")
 
-    add_team(client, player)
+    add_team(lobby, player)
+    client.lobby_updated(player.lobby_name)
 
-    print(f'Added Player: {player.player_name} to Team: {player.team_name}')
+    log.info('Added Player: %s to Team: %s', player.player_name, player.team_name)
 
 
-def add_team(client, player):
+def add_team(lobby, player):
     # If team not in lobby, make new team and start a player list for the team
-    if player.team_name not in client.team_dict[player.lobby_name].keys():
-        client.team_dict[player.lobby_name][player.team_name] = [player.player_name,]    
+    if player.team_name not in lobby.teams:
+        lobby.teams[player.team_name] = [player.player_name,]
     # If team already exists, add player to existing list
     else:
-        client.team_dict[player.lobby_name][player.team_name].append(player.player_name)
+        lobby.teams[player.team_name].append(player.player_name)
 
 move_to_Moveset = {
     'UP' : Moveset.UP,
@@ -104,68 +269,406 @@ move_to_Moveset = {
 }
 
 # Dispatched Function: handles player movement commands
+# The payload is either a single move for the current turn, e.g. UP,
+# or moves for consecutive turns starting at a tick, e.g. {"tick": 12, "moves": ["UP", "UP", "LEFT"]} or its binary form
 def player_move(client, topic_list, msg_payload):
     lobby_name = topic_list[1]
     player_name = topic_list[2]
-    if lobby_name in client.team_dict.keys():
+    lobby: Lobby = client.lobbies.get(lobby_name)
+    if lobby is not None:
+        client.lobbies.touch(lobby)
         try:
-            new_move = msg_payload.decode()
-
-            client.move_dict[lobby_name][player_name] = (player_name, move_to_Moveset[new_move])
-            game: Game = client.game_dict[lobby_name]
-
-            # If all players made a move, resolve movement
-            if len(game.all_players) == len(client.move_dict[lobby_name]):
-                for player, move in client.move_dict[lobby_name].values():
-                    game.movePlayer(player, move)
-
-                # Publish player states after all movement is resolved
-                for player, _ in client.move_dict[lobby_name].values():
-                    client.publish(f'games/{lobby_name}/{player}/game_state', json.dumps(game.getGameData(player)))
-
-                # Clear move list
-                client.move_dict[lobby_name].clear()
-                print(game.map)
-                client.publish(f'games/{lobby_name}/scores', json.dumps(game.getScores()))
-                if game.gameOver():
-                    # Publish game over, remove game
-                    publish_to_lobby(client, lobby_name, "Game Over: All coins have been collected")
-                    client.team_dict.pop(lobby_name)
-                    client.move_dict.pop(lobby_name)
-                    client.game_dict.pop(lobby_name)
+            game: Game = lobby.game
+            if game is None:
+                publish_error_to_lobby(client, lobby_name, "Game has not started yet.")
+                return
+            if player_name not in game.all_players:
+                publish_error_to_lobby(client, lobby_name, f"Player {player_name} is not in this game.")
+                return
+
+            if msg_payload.startswith(b'{') or msg_payload[:1] == bytes((MOVES_MAGIC,)):
+                try:
+                    if msg_payload.startswith(b'{'):
+                        batch = MoveBatch(**json.loads(msg_payload))
+                    else:
+                        tick, moves = decode_moves(msg_payload)
+                        batch = MoveBatch(tick=tick, moves=moves)
+                except ValidationError as e:
+                    log.warning("ValidationError in player_move: %s", msg_payload)
+                    problems = '; '.join(f"{'.'.join(map(str, error['loc']))}: {error['msg']}" for error in e.errors())
+                    publish_error_to_lobby(client, lobby_name, f"Invalid move batch, {problems}.")
+                    return
+                except Exception:
+                    log.warning("Undecodable move batch in player_move: %s", msg_payload)
+                    publish_error_to_lobby(client, lobby_name, "Invalid move batch, send a JSON batch or the binary layout of wireFormat.py.")
+                    return
+                queue_moves(lobby, player_name, batch)
+            else:
+                new_move = move_to_Moveset.get(msg_payload.decode(errors='replace'))
+                if new_move is None:
+                    log.warning("Invalid move in player_move: %s", msg_payload)
+                    publish_error_to_lobby(client, lobby_name, "Invalid move, send UP, DOWN, LEFT or RIGHT.")
+                    return
+                lobby.moves[player_name] = new_move
+
+            # If all players made a move, resolve movement, queued moves may complete the following turns too
+            while lobby.game is not None and turn_ready(lobby):
+                resolve_turn(client, lobby)
 
         except Exception as e:
-            raise e
-            publish_error_to_lobby(client, lobby_name, e.__str__)
+            # Logged and answered, an exception here would take the lobby down in the async and sharded modes
+            log.warning("Error handling the move of %s in lobby %s: %s", player_name, lobby_name, e, exc_info=True)
+            publish_error_to_lobby(client, lobby_name, str(e))
     else:
         publish_error_to_lobby(client, lobby_name, "Lobby name not found.")
 
 
+def queue_moves(lobby, player_name, batch):
+    """
+        Files moves sent for ticks ahead, stale ticks, ticks beyond the queue and ticks that already have a move are dropped
+        so redelivered batches change nothing
+    """
+    game: Game = lobby.game
+    queue = lobby.queued.setdefault(player_name, {})
+    for tick in range(max(batch.tick, game.tick), min(batch.tick + len(batch.moves), game.tick + lobby.config.move_queue)):
+        move = move_to_Moveset[batch.moves[tick - batch.tick]]
+        if tick == game.tick:
+            lobby.moves.setdefault(player_name, move)
+        else:
+            queue.setdefault(tick, move)
+
+
+def turn_ready(lobby):
+    """
+        Whether every player moved in a lobby that resolves turns as soon as the moves are in
+    """
+    return lobby.config.tick_ms is None and len(lobby.game.all_players) == len(lobby.moves)
+
+
+def resolve_turn(client, lobby, deadline=None):
+    """
+        Applies the moves collected for a lobby, players without a move stay in place
+        :param deadline: the deadline that triggered the turn, None when every player moved
+    """
+    start = time.perf_counter()
+    game: Game = lobby.game
+    game.applyMoves(lobby.moves)
+    if lobby.recorder is not None:
+        lobby.recorder.record(game, lobby.moves)
+
+    # Publish player states after all movement is resolved, the states and scores of the turn go out together
+    out = TickPublisher(lobby.name, game.tick)
+    publish_game_states(client, lobby, out=out)
+
+    # Clear move list
+    lobby.moves.clear()
+    client.lobbies.mark(lobby)
+    log_board(log, lobby.name, game)
+    publish_scores(client, lobby, out)
+    out.flush(client, lobby.config.batch)
+    client.metrics.turn.observe(time.perf_counter() - start)
+    if game.gameOver():
+        # Publish game over, remove game
+        publish_to_lobby(client, lobby.name, "Game Over: All coins have been collected")
+        remove_lobby(client, lobby.name)
+        return
+
+    # Moves queued for the new turn become its moves
+    for player_name, queue in lobby.queued.items():
+        for tick in [tick for tick in queue if tick <= game.tick]:
+            move = queue.pop(tick)
+            if tick == game.tick:
+                lobby.moves[player_name] = move
+    schedule_turn(client, lobby, deadline)
+
+
+def schedule_turn(client, lobby, previous_deadline=None):
+    """
+        Sets the deadline of the lobby's next turn if it resolves on a timer
+    """
+    if lobby.timer is not None:
+        lobby.timer.cancel()
+        lobby.timer = None
+    config = lobby.config
+    now = time.monotonic()
+    if config.tick_ms is not None:
+        # Fixed rate: count from the last deadline so turns do not drift, but never schedule into the past
+        start = now if previous_deadline is None else max(previous_deadline, now - config.tick_ms / 1000)
+        deadline = start + config.tick_ms / 1000
+    elif config.move_deadline_ms is not None:
+        deadline = now + config.move_deadline_ms / 1000
+    else:
+        return
+    lobby.timer = client.scheduler.call_at(deadline, client.on_timer, lobby, lobby.game.tick, deadline)
+
+
+def turn_deadline(client, lobby, tick, deadline):
+    # The turn may have resolved early or the lobby may be gone since the timer was set
+    if client.lobbies.get(lobby.name) is not lobby or lobby.game is None or lobby.game.tick != tick:
+        return
+    lobby.timer = None
+    session = client.profiling
+    if session is None:
+        resolve_due_turns(client, lobby, deadline)
+    else:
+        session.run(lobby.name, resolve_due_turns, client, lobby, deadline)
+
+
+def resolve_due_turns(client, lobby, deadline):
+    resolve_turn(client, lobby, deadline)
+    while lobby.game is not None and turn_ready(lobby):
+        resolve_turn(client, lobby)
+
+
 # Dispatched function: Instantiates Game object
 def start_game(client, topic_list, msg_payload):
     lobby_name = topic_list[1]
     if isinstance(msg_payload, bytes) and msg_payload.decode() == "START":
 
-        if lobby_name in client.team_dict.keys():
-                # create new game
-                dict_copy = copy.deepcopy(client.team_dict[lobby_name])
-                dict_copy.pop('started')
+        lobby: Lobby = client.lobbies.get(lobby_name)
+        if lobby is not None and not lobby.started:
+                # create new game, on a map made ahead of time when the pool has one
+                config = lobby.config
+                layout = client.maps.take(config.height, config.width) if client.maps is not None else None
+                game = Game(copy.deepcopy(lobby.teams), config.width, config.height, layout)
+                lobby.game = game
+                client.lobbies.start(lobby)
+
+                # Binary states are full states already smaller than JSON deltas
+                if lobby.config.delta and lobby.config.encoding == 'json':
+                    lobby.delta = DeltaTracker(lobby.config.keyframe_interval)
+
+                start_recording(client, lobby)
+                client.lobby_updated(lobby_name)
+                publish_game_states(client, lobby)
+                schedule_turn(client, lobby)
+                log_board(log, lobby_name, game)
+    elif isinstance(msg_payload, bytes) and msg_payload.decode() == "STOP":
+        publish_to_lobby(client, lobby_name, "Game Over: Game has been stopped")
+        remove_lobby(client, lobby_name)
+
 
-                game = Game(dict_copy)
-                client.game_dict[lobby_name] = game
-                client.move_dict[lobby_name] = OrderedDict()
-                client.team_dict[lobby_name]["started"] = True
+# Dispatched function: sets lobby options such as delta encoded game states
+def set_config(client, topic_list, msg_payload):
+    lobby_name = topic_list[1]
+    try:
+        update = json.loads(msg_payload)
+        # Only the fields the message sets, the others keep the lobby's current values
+        fields = LobbyConfig(**update).model_dump(include=set(update))
+    except:
+        log.warning("ValidationError in set_config: %s", msg_payload)
+        return
 
-                for player in game.all_players.keys():
-                    client.publish(f'games/{lobby_name}/{player}/game_state', json.dumps(game.getGameData(player)))
+    lobby: Lobby = client.lobbies.get(lobby_name)
+    if lobby is None:
+        publish_error_to_lobby(client, lobby_name, "Lobby name not found.")
+        return
+    if lobby.started:
+        # Timers, delta trackers and recorders are set up from the config when the game starts
+        publish_error_to_lobby(client, lobby_name, "Config can only be changed before the game starts.")
+        return
+    client.lobbies.touch(lobby)
+    lobby.config = lobby.config.model_copy(update=fields)
+    client.lobby_updated(lobby_name)
 
 
-                print(game.map)
-    elif isinstance(msg_payload, bytes) and msg_payload.decode() == "STOP":
-        publish_to_lobby(client, lobby_name, "Game Over: Game has been stopped")
-        client.team_dict.pop(lobby_name, None)
-        client.move_dict.pop(lobby_name, None)
-        client.game_dict.pop(lobby_name, None)
+# Dispatched function: sends a player a full game state, e.g. after a client lost track of the deltas
+def resync(client, topic_list, msg_payload):
+    lobby_name = topic_list[1]
+    player_name = topic_list[2]
+    lobby: Lobby = client.lobbies.get(lobby_name)
+    if lobby is None or lobby.game is None or player_name not in lobby.game.all_players:
+        publish_error_to_lobby(client, lobby_name, "Lobby name not found.")
+        return
+    client.lobbies.touch(lobby)
+    publish_game_states(client, lobby, [player_name], keyframe=True)
+
+
+def publish_game_states(client, lobby, player_names=None, keyframe=False, out=None):
+    """
+        :param out: TickPublisher collecting the turn's messages, without one the states are sent right away
+    """
+    game: Game = lobby.game
+    publisher = out or TickPublisher(lobby.name, game.tick)
+    # Delta lobbies only get what changed since the last state sent to each player
+    tracker = lobby.delta
+    # Only some turns time their phases, every clock read counts at this rate
+    timed = game.tick % client.metrics.sample_every == 0
+    if timed:
+        start = time.perf_counter()
+    all_game_data = game.getAllGameData(playerNames=player_names)
+    if timed:
+        encoding = time.perf_counter()
+        client.metrics.game_data.observe(encoding - start)
+    for player, game_data in all_game_data.items():
+        if lobby.config.encoding == 'binary':
+            game_data = encode_state(game_data, game.tick)
+        elif tracker is not None:
+            game_data = tracker.encode(player, game_data, game.tick, keyframe)
+        else:
+            # The turn the next move is for, pipelined moves are numbered from it
+            game_data['tick'] = game.tick
+        publisher.add_state(player, game_data)
+    if timed:
+        publisher.encode_seconds = (publisher.encode_seconds or 0.0) + time.perf_counter() - encoding
+    if out is None:
+        publisher.flush(client, lobby.config.batch)
+
+
+def publish_scores(client, lobby, out=None):
+    scores = lobby.game.getScores()
+    tracker = lobby.delta
+    if tracker is None or tracker.scoresChanged(scores):
+        if out is not None:
+            out.set_scores(scores)
+        else:
+            client.publish(f'games/{lobby.name}/scores', json.dumps(scores))
+
+
+def remove_lobby(client, lobby_name):
+    lobby = client.lobbies.remove(lobby_name)
+    if lobby is None:
+        return
+    close_lobby(client, lobby)
+
+
+def close_lobby(client, lobby):
+    # Timers of a lobby can still be pending after it left the registry
+    if lobby.timer is not None:
+        lobby.timer.cancel()
+        lobby.timer = None
+    if lobby.recorder is not None:
+        lobby.recorder.close(lobby.game)
+        lobby.recorder = None
+    client.lobby_removed(lobby.name)
+
+
+def start_recording(client, lobby):
+    if lobby.config.record:
+        os.makedirs(client.RECORDINGS_DIR, exist_ok=True)
+        lobby.recorder = GameRecorder(recording_path(client.RECORDINGS_DIR, lobby.name), lobby.game)
+
+
+def sweep_lobbies(client):
+    """
+        Removes the lobbies that went idle for longer than the registry's TTLs
+    """
+    for lobby_name in client.lobbies.idle():
+        client.post(lobby_name, sweep_lobby, client, lobby_name)
+
+
+def sweep_lobby(client, lobby_name):
+    # A message may have arrived since the lobby was found idle
+    lobby = client.lobbies.expire(lobby_name)
+    if lobby is not None:
+        publish_to_lobby(client, lobby_name, "Game Over: Lobby closed after being idle")
+        close_lobby(client, lobby)
+
+
+def checkpoint_lobbies(client):
+    """
+        Hands copies of the lobbies changed since the last checkpoint to the checkpoint store's writer
+    """
+    changed, removed = client.lobbies.take_changes()
+    records = dict.fromkeys(removed)
+    for lobby_name in changed:
+        lobby = client.lobbies.get(lobby_name)
+        if lobby is not None:
+            records[lobby_name] = lobby_record(lobby)
+    client.checkpoints.submit(records)
+
+
+def checkpoint_lobby(client, lobby_name):
+    lobby = client.lobbies.get(lobby_name)
+    if lobby is not None:
+        client.checkpoints.submit({lobby_name: lobby_record(lobby)})
+
+
+def restore_lobbies(client):
+    """
+        Rebuilds the lobbies of the last checkpoint, games carry on from the turn they were checkpointed at
+    """
+    client.lobbies.track_changes()
+    dropped = {}
+    for record in client.checkpoints.load():
+        if record['name'] in client.lobbies:
+            continue
+        lobby = client.lobbies.create(record['name'], LobbyConfig(**record['config']))
+        if lobby is None:
+            dropped[record['name']] = None
+            continue
+        lobby.teams = record['teams']
+        if record['started']:
+            lobby.game = restore_game(record)
+            client.lobbies.start(lobby)
+            lobby.moves.update((player_name, Moveset[move]) for player_name, move in record['moves'].items())
+            lobby.queued = {player_name: {tick: Moveset[move] for tick, move in queue.items()}
+                            for player_name, queue in record['queued'].items()}
+            if lobby.config.delta and lobby.config.encoding == 'json':
+                lobby.delta = DeltaTracker(lobby.config.keyframe_interval)
+            start_recording(client, lobby)
+            publish_to_lobby(client, lobby.name, "Game restored after a server restart")
+            publish_game_states(client, lobby, keyframe=True)
+            schedule_turn(client, lobby)
+        client.lobby_updated(lobby.name)
+    # The restored lobbies match their checkpoints already, lobbies that no longer fit are dropped from the file
+    client.lobbies.take_changes()
+    client.checkpoints.submit(dropped)
+    log.info('Restored %d lobbies from %s', len(client.lobbies), client.checkpoints.path)
+
+
+def publish_metrics(client):
+    """
+        Takes a metrics sample and publishes it on the server's metrics topic
+    """
+    client.publish(client.metrics_topic, json.dumps(client.metrics.sample(client)))
+
+
+# Dispatched function: starts a capture on the admin topic, see profiling.py
+def profile_request(client, topic_list, msg_payload):
+    # Only the server's own admin topic, a lobby's games/<lobby>/.../profile is not a request
+    if client.profiler is None or "/".join(topic_list) != client.admin_topic:
+        return
+    try:
+        request = ProfileRequest(**json.loads(msg_payload))
+    except Exception as e:
+        publish_profile_status(client, {'status': 'error', 'error': f'invalid request: {e}'})
+        return
+    if not client.profiler.authorized(request):
+        log.warning('Refused a profiling request without the profiling token')
+        publish_profile_status(client, {'status': 'error', 'error': 'not authorized'})
+        return
+    if request.kind == 'memory' and request.lobby is not None:
+        publish_profile_status(client, {'status': 'error', 'error': 'tracemalloc sees the whole process, memory captures take no lobby'})
+        return
+    if client.profiling is not None:
+        publish_profile_status(client, {'status': 'error', 'error': f'a {client.profiling.kind} capture is running'})
+        return
+    session = client.profiling = client.profiler.start(request)
+    client.scheduler.call_later(request.seconds, finish_profile, client, session)
+    log.info('Started a %s capture of %s for %g s', request.kind, request.lobby or 'all lobbies', request.seconds)
+    publish_profile_status(client, {'status': 'started', **request.model_dump(exclude={'token'})})
+
+
+def finish_profile(client, session):
+    client.profiling = None
+    # Writing a capture can take a while, a heap snapshot above all, so it stays off the scheduler thread
+    threading.Thread(target=write_profile, args=(client, session), name='ProfileWriter', daemon=True).start()
+
+
+def write_profile(client, session):
+    try:
+        files = client.profiler.finish(session)
+    except Exception as e:
+        log.exception('Writing the %s capture failed', session.kind)
+        client.on_profile_status({'status': 'error', 'error': f'writing the capture failed: {e}'})
+        return
+    log.info('Wrote the %s capture to %s', session.kind, ', '.join(files))
+    client.on_profile_status({'status': 'done', 'kind': session.kind, 'lobby': session.lobby, 'files': files})
+
+
+def publish_profile_status(client, status):
+    client.publish(f'{client.admin_topic}/status', json.dumps(status), qos=1)
 
 
 def publish_error_to_lobby(client, lobby_name, error):
@@ -180,38 +683,113 @@ dispatch = {
     'new_game' : add_player,
     'move' : player_move,
     'start' : start_game,
+    'config' : set_config,
+    'resync' : resync,
+    'profile' : profile_request,
 }
 
 
 if __name__ == '__main__':
-    load_dotenv(dotenv_path='./credentials.env')
-    
-    broker_address = os.environ.get('BROKER_ADDRESS')
-    broker_port = int(os.environ.get('BROKER_PORT'))
-    username = os.environ.get('USER_NAME')
-    password = os.environ.get('PASSWORD')
-
-    client = paho.Client(callback_api_version=paho.CallbackAPIVersion.VERSION1, client_id="GameClient", userdata=None, protocol=paho.MQTTv5)
-    
-    # enable TLS for secure connection
-    client.tls_set(tls_version=mqtt.client.ssl.PROTOCOL_TLS)
-    # set username and password
-    client.username_pw_set(username, password)
-    # connect to HiveMQ Cloud on port 8883 (default for MQTT)
-    client.connect(broker_address, broker_port)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mode', choices=('sync', 'async', 'pool', 'sharded', 'cluster'), default='sync',
+                        help='sync runs game logic in the paho callback, async runs every lobby as its own asyncio task, '
+                             'pool runs lobbies on a thread pool, sharded spreads lobbies over worker processes, '
+                             'cluster shares the load with other GameClient nodes')
+    parser.add_argument('--workers', type=int, default=None, help='threads in pool mode, worker processes in sharded mode, one per core by default')
+    parser.add_argument('--connection-per-worker', action='store_true', help='sharded workers publish over their own broker connection')
+    parser.add_argument('--node-id', help='name of this node in cluster mode, host and pid by default')
+    parser.add_argument('--broker', help='broker address, credentials.env is used when omitted')
+    parser.add_argument('--port', type=int, default=1883)
+    parser.add_argument('--no-tls', action='store_true')
+    parser.add_argument('--username')
+    parser.add_argument('--password')
+    parser.add_argument('--tick-ms', type=int, help='resolve turns at this fixed interval, missing moves stay in place')
+    parser.add_argument('--move-deadline-ms', type=int, help='resolve a turn this long after its states were sent if moves are missing')
+    parser.add_argument('--batch', choices=('pipelined', 'combined'), default='pipelined',
+                        help='send a turn as one message per player, or as one games/<lobby>/tick message')
+    parser.add_argument('--encoding', choices=('json', 'binary'), default='json', help='game_state payload format, see wireFormat.py')
+    parser.add_argument('--max-lobbies', type=int, default=10000, help='lobbies held at once, per worker in sharded mode')
+    parser.add_argument('--pending-ttl', type=float, default=300.0, help='seconds before an idle lobby that never started is closed')
+    parser.add_argument('--idle-ttl', type=float, default=600.0, help='seconds before a game nobody sends moves to is closed')
+    parser.add_argument('--map-pool', metavar='HEIGHTxWIDTH', nargs='*', type=parse_size,
+                        help='pre-generate maps for these board sizes, 10x10 when given no sizes')
+    parser.add_argument('--map-pool-depth', type=int, default=8, help='maps kept ready per board size')
+    parser.add_argument('--map-pool-rate', type=float, default=50.0, help='most maps generated per second')
+    parser.add_argument('--record', action='store_true', help=f'record every game to {GameServer.RECORDINGS_DIR}/, see replay.py')
+    parser.add_argument('--checkpoint', metavar='PATH', help='SQLite file to checkpoint lobbies to, live games are restored from it on start')
+    parser.add_argument('--checkpoint-interval', type=float, default=1.0, help='seconds between checkpoints of the lobbies that changed')
+    parser.add_argument('--log-level', choices=('DEBUG', 'INFO', 'WARNING', 'ERROR'), default='INFO',
+                        help='DEBUG logs every message and samples the boards')
+    parser.add_argument('--board-every', type=int, default=10, help='ticks between board dumps of a lobby at DEBUG, 0 for none')
+    parser.add_argument('--metrics-interval', type=float, default=10.0,
+                        help='seconds between metrics samples published on games/$sys/metrics, see metrics.py')
+    parser.add_argument('--metrics-port', type=int, help='serve the metrics in the Prometheus text format at http://HOST:PORT/metrics')
+    parser.add_argument('--metrics-host', default='127.0.0.1', help='address the metrics endpoint listens on')
+    parser.add_argument('--profile-dir', metavar='DIR',
+                        help='take profiling requests on games/$sys/admin/profile and write the captures to DIR, see profiling.py')
+    parser.add_argument('--profile-token', help='token profiling requests have to carry, PROFILE_TOKEN by default')
+    args = parser.parse_args()
+    setup_logging(args.log_level, args.board_every)
+    if args.checkpoint and args.mode == 'cluster':
+        parser.error('cluster nodes take over the lobbies of a node that went down, --checkpoint is not supported')
+    if args.metrics_port is not None and args.mode == 'sharded':
+        parser.error('sharded workers publish their metrics on games/$sys/metrics/shard<N>, --metrics-port is not supported')
+    if args.profile_dir and args.mode == 'sharded':
+        parser.error('lobbies run in the worker processes in sharded mode, --profile-dir is not supported')
+    if args.metrics_interval <= 0:
+        parser.error('--metrics-interval must be positive')
+    # Lobbies can still override these with their own config
+    default_config = LobbyConfig(tick_ms=args.tick_ms, move_deadline_ms=args.move_deadline_ms, batch=args.batch,
+                                 encoding=args.encoding, record=args.record)
+    lobbies = LobbyRegistry(args.max_lobbies, args.pending_ttl, args.idle_ttl)
+    checkpoints = CheckpointStore(args.checkpoint, args.checkpoint_interval) if args.checkpoint else None
+    maps = None
+    if args.map_pool is not None:
+        maps = MapPool(args.map_pool or [(10, 10)], args.map_pool_depth, args.map_pool_rate)
+
+    if args.broker:
+        connection_args = {'broker_address': args.broker, 'broker_port': args.port, 'username': args.username,
+                           'password': args.password, 'tls': not args.no_tls}
+    else:
+        connection_args = PahoTransport.env_args()
+    # Read after credentials.env is loaded, which can hold it
+    profile_token = args.profile_token or os.environ.get('PROFILE_TOKEN')
+    if args.profile_dir and not profile_token:
+        parser.error('anyone on the broker can publish to the admin topic, --profile-dir needs --profile-token or PROFILE_TOKEN')
+
+    if args.mode == 'cluster':
+        from clusterServer import ClusterGameServer, default_node_id, node_will
+        node_id = args.node_id or default_node_id()
+        # Nodes need their own client ids, the broker drops the older of two connections with the same id
+        transport = PahoTransport(f"GameClient-{node_id}", **connection_args, will=node_will(node_id))
+    else:
+        transport = PahoTransport("GameClient", **connection_args)
 
     # setting callbacks, use separate functions like above for better visibility
-    client.on_subscribe = on_subscribe # Can comment out to not print when subscribing to new topics
-    client.on_message = on_message
-    client.on_publish = on_publish # Can comment out to not print when publishing to topics
-    
-    # custom dictionary to track players
-    client.team_dict = {} # Keeps tracks of players before a game starts {'lobby_name' : {'team_name' : [player_name, ...]}}
-    client.game_dict = {} # Keeps track of the games {{'lobby_name' : Game Object}
-    client.move_dict = {} # Keeps track of the games {{'lobby_name' : Game Object}
-
-    client.subscribe("new_game")
-    client.subscribe('games/+/start')
-    client.subscribe('games/+/+/move')
-
-    client.loop_forever()
\ No newline at end of file
+    transport.client.on_subscribe = on_subscribe # Can comment out to not log when subscribing to new topics
+    if log.isEnabledFor(logging.DEBUG):
+        # Every publish calls back, only worth it when the mids are logged
+        transport.client.on_publish = on_publish
+
+    if args.mode == 'async':
+        from asyncServer import AsyncGameServer
+        server = AsyncGameServer(transport, default_config=default_config, lobbies=lobbies, checkpoints=checkpoints,
+                                 maps=maps)
+    elif args.mode == 'pool':
+        from workerPool import PooledGameServer
+        server = PooledGameServer(transport, args.workers, default_config=default_config, lobbies=lobbies,
+                                  checkpoints=checkpoints, maps=maps)
+    elif args.mode == 'sharded':
+        from shardedServer import ShardedGameServer
+        server = ShardedGameServer(transport, args.workers, connection_args if args.connection_per_worker else None,
+                                   default_config=default_config, lobbies=lobbies, checkpoints=checkpoints, maps=maps)
+    elif args.mode == 'cluster':
+        server = ClusterGameServer(transport, node_id, default_config=default_config, lobbies=lobbies, maps=maps)
+    else:
+        server = GameServer(transport, default_config, lobbies, checkpoints, maps)
+    server.metrics_interval = args.metrics_interval
+    if args.profile_dir:
+        server.profiler = Profiler(profile_token, args.profile_dir)
+    if args.metrics_port is not None:
+        serve_metrics(server, args.metrics_port, args.metrics_host)
+    server.serve_forever()
@@ -1,13 +1,52 @@
-from pydantic import BaseModel, StringConstraints
+from typing import Literal, Optional
+
+from pydantic import BaseModel, Field, StringConstraints
 from typing_extensions import Annotated
 
+# A single topic level, which the server also puts in file names: no topic wildcards or path separators,
+# and no leading '$' since games/$sys/... topics belong to the server
+LobbyName = Annotated[str, StringConstraints(min_length=1, max_length=20, pattern=r'^[^$/\\+#\x00][^/\\+#\x00]*$')]
+
 class NewPlayer(BaseModel):
-    lobby_name: Annotated[str, StringConstraints(min_length=1, max_length=20)]
+    lobby_name: LobbyName
     team_name: Annotated[str, StringConstraints(min_length=1, max_length=20)]
     player_name: Annotated[str, StringConstraints(min_length=1, max_length=20)]
 
 class Move(BaseModel):
     move: Annotated[str, StringConstraints(pattern=r'^(UP|DOWN|LEFT|RIGHT)$')]
 
+class MoveBatch(BaseModel):
+    # moves[i] is the move for turn tick + i
+    tick: Annotated[int, Field(ge=0)]
+    moves: Annotated[list[Annotated[str, StringConstraints(pattern=r'^(UP|DOWN|LEFT|RIGHT)$')]], Field(min_length=1, max_length=64)]
+
 class Start(BaseModel):
-    start: Annotated[str, StringConstraints(pattern=r'^(START)$')]
\ No newline at end of file
+    start: Annotated[str, StringConstraints(pattern=r'^(START)$')]
+
+class LobbyConfig(BaseModel):
+    delta: bool = False
+    keyframe_interval: Annotated[int, Field(ge=1, le=1000)] = 20
+    # Fixed rate turns, resolved every tick_ms whether or not every player moved
+    tick_ms: Optional[Annotated[int, Field(ge=10, le=60000)]] = None
+    # Without tick_ms, a turn resolves once every player moved or move_deadline_ms after its game states went out
+    move_deadline_ms: Optional[Annotated[int, Field(ge=10, le=60000)]] = None
+    # Turns ahead of the current one a player may queue moves for
+    move_queue: Annotated[int, Field(ge=1, le=64)] = 8
+    # pipelined sends each player's game_state on its own topic, combined sends a turn as one games/<lobby>/tick message
+    batch: Literal['pipelined', 'combined'] = 'pipelined'
+    # json game_state payloads, or the compact binary layout of wireFormat.py
+    encoding: Literal['json', 'binary'] = 'json'
+    # Write the game to the server's recordings directory, see replay.py
+    record: bool = False
+    # Board size, the default wall layout needs at least 10x10
+    height: Annotated[int, Field(ge=10, le=1000)] = 10
+    width: Annotated[int, Field(ge=10, le=1000)] = 10
+
+class ProfileRequest(BaseModel):
+    # cprofile traces the lobby work one item at a time, sample one message or deadline in ten, memory diffs tracemalloc snapshots
+    kind: Literal['cprofile', 'sample', 'memory'] = 'sample'
+    seconds: Annotated[float, Field(gt=0, le=300)] = 10.0
+    # Only the work of this lobby, every lobby when omitted. Not for memory, tracemalloc sees the whole process
+    lobby: Optional[LobbyName] = None
+    # Shared with the server through --profile-token or PROFILE_TOKEN, requests without it are refused
+    token: Optional[str] = None
@@ -1,18 +1,22 @@
-import os
 import json
-from dotenv import load_dotenv
-
-import paho.mqtt.client as paho
-from paho import mqtt
+import argparse
+import logging
 import time
 import random
 from collections import deque
 
+from gameLogging import setup_logging
+from transport import InMemoryBus, PahoTransport
+from wireFormat import decode_state, encode_moves, is_binary
+
+log = logging.getLogger('PlayerClient')
+
 # Dictionary to store the global map for each team
 team_maps = {}
 player_team_dict = {}
 prev_player_positions = {}
 player_move_history = {}
+player_ticks = {} # Turn each player's next move is for, from the tick in its last game_state
 
 state_mapping = {'unexplored': '·', 'free': ' ', 'wall': '#', 'coin': '⬤', 'player': 'P'}
 
@@ -24,129 +28,108 @@ def create_empty_map():
 def update_team_map(team_name: str, coords: list, object: str):
     team_maps[team_name][coords[0]][coords[1]] = state_mapping[object]
 
-def print_map(map_2d):
+def log_map(map_2d):
     """
-    Print a 2D list as a grid.
+    Log a 2D list as a grid at DEBUG.
     :param map_2d: 2D list representing the team map
     """
-    print("Current Map:")
-    for row in map_2d:
-        print(" ".join(str(item) for item in row))
+    if log.isEnabledFor(logging.DEBUG):
+        # The team map keeps changing, so the grid is joined here rather than on the logging thread
+        log.debug("Current Map:\n%s", "\n".join(" ".join(str(item) for item in row) for row in map_2d))
         
-# setting callbacks for different events to see if it works, print the message etc.
+# setting callbacks for different events to see if it works, log the message etc.
 def on_connect(client, userdata, flags, rc, properties=None):
     """
-        Prints the result of the connection with a reasoncode to stdout ( used as callback for connect )
+        Logs the result of the connection with a reasoncode ( used as callback for connect )
         :param client: the client itself
         :param userdata: userdata is set when initiating the client, here it is userdata=None
         :param flags: these are response flags sent by the broker
         :param rc: stands for reasonCode, which is a code for the connection result
         :param properties: can be used in MQTTv5, but is optional
     """
-    print("CONNACK received with code %s." % rc)
+    log.info("CONNACK received with code %s.", rc)
 
 
 # with this callback you can see if your publish was successful
 def on_publish(client, userdata, mid, properties=None):
     """
-        Prints mid to stdout to reassure a successful publish ( used as callback for publish )
+        Logs mid at DEBUG to reassure a successful publish ( used as callback for publish )
         :param client: the client itself
         :param userdata: userdata is set when initiating the client, here it is userdata=None
         :param mid: variable returned from the corresponding publish() call, to allow outgoing messages to be tracked
         :param properties: can be used in MQTTv5, but is optional
     """
-    print("mid: " + str(mid))
+    log.debug("mid: %s", mid)
 
 
-# print which topic was subscribed to
+# log which topic was subscribed to
 def on_subscribe(client, userdata, mid, granted_qos, properties=None):
     """
-        Prints a reassurance for successfully subscribing
+        Logs a reassurance for successfully subscribing
         :param client: the client itself
         :param userdata: userdata is set when initiating the client, here it is userdata=None
         :param mid: variable returned from the corresponding publish() call, to allow outgoing messages to be tracked
         :param granted_qos: this is the qos that you declare when subscribing, use the same one for publishing
         :param properties: can be used in MQTTv5, but is optional
     """
-    print("Subscribed: " + str(mid) + " " + str(granted_qos))
+    log.info("Subscribed: %s %s", mid, granted_qos)
 
 
-# print message, useful for checking if it was successful
+# log message, useful for checking if it was successful
 def on_message(client, userdata, msg):
     """
-        Prints a mqtt message to stdout ( used as callback for subscribe )
+        Logs a mqtt message and updates the team maps ( used as callback for subscribe )
         :param client: the client itself
         :param userdata: userdata is set when initiating the client, here it is userdata=None
         :param msg: the message with topic and payload
     """
 
-    #print("message: " + msg.topic + " " + str(msg.qos) + " " + str(msg.payload))
+    #log.debug("message: %s %s %s", msg.topic, msg.qos, msg.payload)
     if msg.topic == f"games/{lobby_name}/lobby" and msg.payload.startswith(b"Game Over"):
-        print("Game Over: All coins have been collected")
+        log.info("Game Over: All coins have been collected")
         return
     elif msg.payload.startswith(b"Error: Lobby name not found"):
-            print("Lobby has been deleted after the game ended")
+            log.info("Lobby has been deleted after the game ended")
             return
     if msg.topic == f"games/{lobby_name}/scores":
         try:
             scores_dict = json.loads(msg.payload)
-            print("Scores:")
-            for team, score in scores_dict.items():
-                print(f"{team}: {score}")
+            log.info("Scores: %s", ", ".join(f"{team}: {score}" for team, score in scores_dict.items()))
         except json.JSONDecodeError as e:
-            print("Error decoding JSON for scores:", e)
+            log.warning("Error decoding JSON for scores: %s", e)
         return
     try:
-        # Decoding the message payload from byte to JSON
-        message_dict = json.loads(msg.payload)    
+        # Decoding the message payload from byte to JSON, or from the binary layout of lobbies that asked for it
+        message_dict = decode_state(msg.payload) if is_binary(msg.payload) else json.loads(msg.payload)
         # '{"teammateNames": ["Player1"], "teammatePositions": [[7, 9]], "enemyPositions": [[2, 3]], "currentPosition": [9, 9], "coin1": [[8, 4], [8, 6]], "coin2": [[7, 5], [9, 2], [9, 5]], "coin3": [], "walls": [[7, 7], [8, 7]]}'         
         if (msg.topic.endswith("/game_state")):
             # Extract relevant information from the game state message
             player_name = msg.topic.split("/")[-2]
             team_name = player_team_dict[player_name]
             current_position = message_dict.get('currentPosition', 'N/A')
-            print(f"\n=== Message received on topic: {msg.topic} ===")
-            print(f"Current Position: {current_position}")
+            player_ticks[player_name] = message_dict.get('tick')
             if player_name in prev_player_positions:
                 update_team_map(team_name, prev_player_positions[player_name], 'free')
             prev_player_positions[player_name] = current_position
             update_team_map(team_name, message_dict.get('currentPosition'), 'player')
             teammates = ', '.join(message_dict.get('teammateNames', []))
-            print(f"Teammates: {teammates if teammates else 'None'}")
-            
-            print("Teammate Positions:")
-            if message_dict.get('teammatePositions'):
-                for pos in message_dict['teammatePositions']:
-                    print(f"  - {pos}")
-                    update_team_map(team_name, pos, 'player')
-            else:
-                print("  None")
-            
-            print("Enemy Positions:")
-            if message_dict.get('enemyPositions'):
-                for pos in message_dict['enemyPositions']:
-                    print(f"  - {pos}")
-                    update_team_map(team_name, pos, 'player')
-            else:
-                print("  None")
-            
-            print("Coins:")
             coins_combined = {**{'Coin1': message_dict.get('coin1', [])}, **{'Coin2': message_dict.get('coin2', [])}, **{'Coin3': message_dict.get('coin3', [])}}
+            # One record per message, its arguments are only turned into text if DEBUG is on
+            log.debug("=== Message received on topic: %s ===\nCurrent Position: %s\nTeammates: %s\n"
+                      "Teammate Positions: %s\nEnemy Positions: %s\nCoins: %s\nWalls: %s",
+                      msg.topic, current_position, teammates if teammates else 'None',
+                      message_dict.get('teammatePositions') or 'None', message_dict.get('enemyPositions') or 'None',
+                      coins_combined, message_dict.get('walls') or 'None')
+
+            for pos in message_dict.get('teammatePositions') or []:
+                update_team_map(team_name, pos, 'player')
+            for pos in message_dict.get('enemyPositions') or []:
+                update_team_map(team_name, pos, 'player')
             for coin_type, positions in coins_combined.items():
-                if positions:
-                    for pos in positions:
-                        print(f"  {coin_type} at: {pos}")
-                        update_team_map(team_name, pos, 'coin')
-                else:
-                    print(f"  {coin_type}: None")
-            
-            print("Walls:")
-            if message_dict.get('walls'):
-                for wall in message_dict['walls']:
-                    print(f"  - {wall}")
-                    update_team_map(team_name, wall, 'wall')
-            else:
-                print("  None")
+                for pos in positions:
+                    update_team_map(team_name, pos, 'coin')
+            for wall in message_dict.get('walls') or []:
+                update_team_map(team_name, wall, 'wall')
             
             # Update surrounding 5x5 grid centered at current player position to 'free' if the current value is 0
             if current_position != 'N/A':
@@ -160,12 +143,12 @@ def on_message(client, userdata, msg):
                         if team_maps[team_name][i][j] == state_mapping['unexplored']:
                             update_team_map(team_name, [i, j], 'free')
                             
-            print_map(team_maps[team_name])
+            log_map(team_maps[team_name])
 
     except json.JSONDecodeError as e:
-        print("Error decoding JSON:", e)
+        log.warning("Error decoding JSON: %s", e)
     except KeyError as e:
-        print(f"Key error: {e} - message format might have changed or is incorrect.")
+        log.warning("Key error: %s - message format might have changed or is incorrect.", e)
 
 def manhattan_distance(coord1, coord2) -> int:
     return abs(coord1[0] - coord2[0]) + abs(coord1[1] - coord2[1])
@@ -284,11 +267,11 @@ def find_next_move(player_name, team_name, current_position):
                 coins.append(((i, j), manhattan_distance(current_position, (i, j))))
     
     if coins:
-        print(f"coins coords with dist = {coins}")
+        log.debug("coins coords with dist = %s", coins)
 
         # Check if the player is stuck in a loop
         if current_position in list(player_move_history[player_name])[-5:]:
-            print("Player is stuck in a loop. Finding an alternative path.")
+            log.debug("Player is stuck in a loop. Finding an alternative path.")
             # Find the nearest unexplored cell 
             path_to_unexplored = find_nearest_unexplored_cell(team_map, current_position)
             if path_to_unexplored:
@@ -341,34 +324,57 @@ def find_next_move(player_name, team_name, current_position):
 
     return best_move
 
-if __name__ == '__main__':
-    load_dotenv(dotenv_path='./credentials.env')
-    
-    broker_address = os.environ.get('BROKER_ADDRESS')
-    broker_port = int(os.environ.get('BROKER_PORT'))
-    username = os.environ.get('USER_NAME')
-    password = os.environ.get('PASSWORD')
+def plan_moves(team_map, start, steps):
+    """
+        Up to steps moves along the path to the nearest known coin, or else towards the nearest unexplored cell
+        :return: list of moves such as ['UP', 'UP', 'LEFT'], empty when there is nowhere to go
+    """
+    start = tuple(start)
+    coins = [(i, j) for i in range(10) for j in range(10) if team_map[i][j] == state_mapping['coin']]
+    path = None
+    if coins:
+        path = find_path_to_coin(team_map, start, min(coins, key=lambda coin: manhattan_distance(start, coin)))
+    if not path:
+        path = find_nearest_unexplored_cell(team_map, start) or []
 
-    client = paho.Client(paho.CallbackAPIVersion.VERSION1, client_id="Player1", userdata=None, protocol=paho.MQTTv5)
-    
-    # enable TLS for secure connection
-    client.tls_set(tls_version=mqtt.client.ssl.PROTOCOL_TLS)
-    # set username and password
-    client.username_pw_set(username, password)
-    # connect to HiveMQ Cloud on port 8883 (default for MQTT)
-    client.connect(broker_address, broker_port)
-    print("PlayerClient connec+ted to broker")
-    # setting callbacks, use separate functions like above for better visibility
-    client.on_subscribe = on_subscribe # Can comment out to not print when subscribing to new topics
+    moves = []
+    for (x, y), (next_x, next_y) in zip(path, path[1:steps + 1]):
+        for move, (dx, dy) in zip(["UP", "DOWN", "LEFT", "RIGHT"], [(-1, 0), (1, 0), (0, -1), (0, 1)]):
+            if (x + dx, y + dy) == (next_x, next_y):
+                moves.append(move)
+    return moves
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--local', action='store_true', help='play against a GameServer in this process instead of the broker')
+    parser.add_argument('--pipeline', type=int, default=1, help='send this many planned moves ahead in one message')
+    parser.add_argument('--binary', action='store_true', help='ask for binary game states and send binary move batches')
+    parser.add_argument('--log-level', choices=('DEBUG', 'INFO', 'WARNING', 'ERROR'), default='INFO',
+                        help='DEBUG logs every game state and the team maps')
+    args = parser.parse_args()
+    setup_logging(args.log_level)
+
+    if args.local:
+        from GameClient import GameServer
+
+        bus = InMemoryBus()
+        GameServer(bus.connect("GameClient")).start()
+        client = bus.connect("Player1")
+    else:
+        client = PahoTransport.from_env("Player1")
+        log.info("PlayerClient connected to broker")
+        # setting callbacks, use separate functions like above for better visibility
+        client.client.on_subscribe = on_subscribe # Can comment out to not log when subscribing to new topics
+        if log.isEnabledFor(logging.DEBUG):
+            client.client.on_publish = on_publish # Only worth the callback on every publish when the mids are logged
     client.on_message = on_message
-    client.on_publish = on_publish # Can comment out to not print when publishing to topics
 
     lobby_name = "TestLobby"
     player_1 = "Player1"
     player_2 = "Player2"
     player_3 = "Player3"
     player_4 = "Player4"
-    print("Initialized lobby name and player strings")
+    log.info("Initialized lobby name and player strings")
     client.subscribe(f"games/{lobby_name}/lobby")
     client.subscribe(f'games/{lobby_name}/+/game_state')
     client.subscribe(f'games/{lobby_name}/scores')
@@ -401,7 +407,9 @@ if __name__ == '__main__':
                                         'team_name':'BTeam',
                                         'player_name' : player_4}))
 
-    print("Published new game")
+    log.info("Published new game")
+    if args.binary:
+        client.publish(f"games/{lobby_name}/config", json.dumps({'encoding': 'binary'}))
     time.sleep(1) # Wait a second to resolve game start
     client.publish(f"games/{lobby_name}/start", "START")
     
@@ -418,7 +426,17 @@ if __name__ == '__main__':
                 team_name = player_team_dict[player]
                 current_position = prev_player_positions.get(player)
                 
-                if current_position is not None and team_name is not None:
+                if current_position is not None and team_name is not None and args.pipeline > 1 and player_ticks.get(player) is not None:
+                    # Moves for the next few turns in one message, the server plays them without waiting for us
+                    planned_moves = plan_moves(team_maps[team_name], current_position, args.pipeline)
+                    if planned_moves and args.binary:
+                        client.publish(f"games/{lobby_name}/{player}/move", encode_moves(player_ticks[player], planned_moves))
+                    elif planned_moves:
+                        client.publish(f"games/{lobby_name}/{player}/move", json.dumps({'tick': player_ticks[player],
+                                                                                         'moves': planned_moves}))
+                    else:
+                        log.warning("No valid move found for %s", player)
+                elif current_position is not None and team_name is not None:
                     next_move = find_next_move(player, team_name, current_position)
                     
                     if next_move:
@@ -428,19 +446,19 @@ if __name__ == '__main__':
                         client.publish(f"games/{lobby_name}/{player}/move", next_move)
                             # print(f"Move {next_move} sent for {player}")
                     else:
-                        print(f"No valid move found for {player}")
+                        log.warning("No valid move found for %s", player)
                 else:
-                    print(f"Current position not available for {player}")
+                    log.warning("Current position not available for %s", player)
             
             # Add a delay if necessary, for example, to wait for all moves to be processed
             # time.sleep(1)
     
     except KeyboardInterrupt:
-        print("Game interrupted by user.")
+        log.info("Game interrupted by user.")
 
     finally:
         # Optionally: publish a STOP command to end the game
         client.publish(f"games/{lobby_name}/start", "STOP")
         # Stopping the MQTT client loop to cleanly shutdown
         client.loop_stop()
-        print("Game ended.")
\ No newline at end of file
+        log.info("Game ended.")
\ No newline at end of file
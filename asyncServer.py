@@ -0,0 +1,145 @@
+"""
+asyncio mode of the game server. The transport callback only hands messages to the event loop,
+every lobby works through its own ordered mailbox in its own task, and publishes are flushed in batches.
+"""
+
+import asyncio
+import functools
+import logging
+import threading
+from collections import deque
+
+from GameClient import (GameServer, checkpoint_lobbies, get_lobby_name, on_message, publish_metrics,
+                        publish_profile_status, sweep_lobbies, turn_deadline)
+from checkpoint import CheckpointStore
+from InputTypes import LobbyConfig
+from lobbyRegistry import LobbyRegistry
+from mapPool import MapPool
+from transport import Transport
+
+log = logging.getLogger('GameClient.async')
+
+
+class AsyncGameServer(GameServer):
+    def __init__(self, transport: Transport, max_batch: int = 512, default_config: LobbyConfig = None,
+                 lobbies: LobbyRegistry = None, checkpoints: CheckpointStore = None, maps: MapPool = None):
+        """
+        :param max_batch: most publishes handed to the transport in one flush
+        """
+        super().__init__(transport, default_config, lobbies, checkpoints, maps)
+        self.max_batch = max_batch
+        self.loop: asyncio.AbstractEventLoop = None
+        self.ready = threading.Event()
+        self.__ingress: asyncio.Queue = None
+        self.__mailboxes: dict[str, deque] = {}
+        self.__outbox: deque = deque()
+        self.__outbox_ready: asyncio.Event = None
+
+    def on_message(self, client, userdata, msg):
+        # Runs on the network thread, which must never wait on game logic
+        self.loop.call_soon_threadsafe(self.__ingress.put_nowait, msg)
+
+    def on_timer(self, lobby, tick, deadline):
+        # Runs on the scheduler thread, the deadline is handled in the lobby's mailbox like a message
+        self.loop.call_soon_threadsafe(self.__post, lobby.name, functools.partial(turn_deadline, self, lobby, tick, deadline))
+
+    def on_sweep(self):
+        # Lobby work all runs on the loop, so the sweep cannot interleave with a lobby's message
+        self.loop.call_soon_threadsafe(sweep_lobbies, self)
+        self.scheduler.call_later(self.SWEEP_INTERVAL, self.on_sweep)
+
+    def on_checkpoint(self):
+        self.loop.call_soon_threadsafe(checkpoint_lobbies, self)
+        self.scheduler.call_later(self.checkpoints.interval, self.on_checkpoint)
+
+    def on_metrics(self):
+        self.loop.call_soon_threadsafe(publish_metrics, self)
+        self.scheduler.call_later(self.metrics_interval, self.on_metrics)
+
+    def on_profile_status(self, status):
+        self.loop.call_soon_threadsafe(publish_profile_status, self, status)
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.metrics.messages_out.inc()
+        self.__outbox.append((topic, payload, qos, retain))
+        self.__outbox_ready.set()
+
+    def publish_many(self, messages):
+        self.metrics.messages_out.inc(len(messages))
+        self.__outbox.extend(messages)
+        self.__outbox_ready.set()
+
+    def mailbox_depths(self) -> dict[str, int]:
+        # Copied in one step, the metrics endpoint reads it from another thread
+        return {lobby_name: len(mailbox) for lobby_name, mailbox in list(self.__mailboxes.items())}
+
+    def queue_depths(self) -> dict[str, int]:
+        depths = self.mailbox_depths().values()
+        return {'ingress': self.__ingress.qsize() if self.__ingress is not None else 0,
+                'mailboxes': sum(depths),
+                'mailbox_max': max(depths, default=0),
+                'outbox': len(self.__outbox)}
+
+    def __post(self, lobby_name, work):
+        mailbox = self.__mailboxes.get(lobby_name)
+        if mailbox is None:
+            # A lobby only has a task while it has mail, the task exits once the mailbox runs dry
+            mailbox = self.__mailboxes[lobby_name] = deque()
+            asyncio.create_task(self.__run_lobby(lobby_name, mailbox))
+        mailbox.append(work)
+
+    async def __route(self):
+        while True:
+            msg = await self.__ingress.get()
+            self.__post(get_lobby_name(msg.topic, msg.payload), functools.partial(on_message, self, None, msg))
+
+    async def __run_lobby(self, lobby_name, mailbox: deque):
+        try:
+            while mailbox:
+                work = mailbox.popleft()
+                try:
+                    work()
+                except Exception:
+                    # One bad message must not take the lobby's mailbox down with it
+                    log.exception('Error handling work for lobby %s', lobby_name)
+                # Let the other lobbies and the flusher run between messages
+                await asyncio.sleep(0)
+        finally:
+            # A mailbox left behind with no task would never be drained, the next message starts a fresh one
+            if self.__mailboxes.get(lobby_name) is mailbox:
+                del self.__mailboxes[lobby_name]
+
+    async def __flush(self):
+        while True:
+            await self.__outbox_ready.wait()
+            self.__outbox_ready.clear()
+            while self.__outbox:
+                # paho only queues the packets for its network thread, so a batch is cheap to hand over inline
+                self.transport.publish_many([self.__outbox.popleft() for _ in range(min(self.max_batch, len(self.__outbox)))])
+                await asyncio.sleep(0)
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.__ingress = asyncio.Queue()
+        self.__outbox_ready = asyncio.Event()
+        flusher = asyncio.create_task(self.__flush())
+        router = asyncio.create_task(self.__route())
+        self.start()
+        self.transport.loop_start()
+        self.ready.set()
+        try:
+            await asyncio.gather(flusher, router)
+        finally:
+            self.transport.loop_stop()
+
+    def serve_forever(self):
+        asyncio.run(self.serve())
+
+    def serve_in_background(self) -> threading.Thread:
+        """
+        Runs the event loop on a daemon thread and returns once it accepts messages
+        """
+        thread = threading.Thread(target=self.serve_forever, name='AsyncGameServer', daemon=True)
+        thread.start()
+        self.ready.wait()
+        return thread
@@ -0,0 +1,185 @@
+"""
+Vectorized engine that steps many games at once with NumPy, for bulk self-play and tournaments.
+Follows the rules of Game.applyMoves exactly, see BatchGame.step.
+"""
+
+import random
+
+import numpy as np
+
+from game import Game
+from gameItems import *
+from moveset import Moveset
+
+
+MOVES = tuple(Moveset)
+MOVE_DELTAS = np.array([move.value for move in MOVES], dtype=np.int32)
+NO_MOVE = -1
+
+# Coin value for each cell code, zero for everything else
+CODE_VALUES = np.zeros(256, dtype=np.int64)
+for code, value in COIN_VALUES.items():
+    CODE_VALUES[code] = value
+
+# Cell codes of the vision tensors, the item codes are shared with Map
+VISION_TEAMMATE = PLAYER
+VISION_ENEMY = PLAYER + 1
+VISION_SELF = PLAYER + 2
+VISION_OUT = PLAYER + 3
+
+
+class BatchGame:
+    def __init__(self, games: list[Game]):
+        """
+        Stacks games that share the same board size and roster into arrays
+        :param games: freshly created or in-progress games, left untouched
+        """
+        assert len(games) > 0
+        first = games[0]
+        self.height, self.width = first.map.height, first.map.width
+        self.playerNames = list(first.all_players.keys())
+        self.teamNames = list(first.teams.keys())
+        for game in games:
+            assert (game.map.height, game.map.width) == (self.height, self.width)
+            assert list(game.all_players.keys()) == self.playerNames and list(game.teams.keys()) == self.teamNames
+
+        teamIndex = {name: t for t, name in enumerate(self.teamNames)}
+        self.playerTeams = np.array([teamIndex[first.all_players[name].team.name] for name in self.playerNames], dtype=np.int32)
+        self.__teamOneHot = np.eye(len(self.teamNames), dtype=np.int64)[self.playerTeams]
+
+        self.grid = np.stack([np.frombuffer(game.map.map, dtype=np.uint8).reshape(self.height, self.width) for game in games])
+        self.positions = np.array([[game.all_players[name].loc for name in self.playerNames] for game in games], dtype=np.int32)
+        self.scores = np.array([[game.teams[name].score for name in self.teamNames] for game in games], dtype=np.int64)
+        self.coins = np.array([game.map.numCoins for game in games], dtype=np.int64)
+        self.ticks = np.array([game.tick for game in games], dtype=np.int64)
+
+    @classmethod
+    def create(cls, numGames: int, playerNames: dict[str, list[str]], width: int = 10, height: int = 10, seed: int = None) -> 'BatchGame':
+        """
+        Generates numGames new games through the reference Game, reproducible with seed
+        """
+        if seed is not None:
+            random.seed(seed)
+        return cls([Game(playerNames, width, height) for _ in range(numGames)])
+
+    @property
+    def numGames(self):
+        return self.grid.shape[0]
+
+    @property
+    def done(self) -> np.ndarray:
+        """
+        (N,) games that are over, these ignore further moves
+        """
+        return self.coins <= 0
+
+    def step(self, moves: np.ndarray) -> np.ndarray:
+        """
+        Resolves one turn of every game, with the same rules as Game.applyMoves
+        :param moves: (N, P) indices into MOVES in playerNames order, NO_MOVE to stay in place
+        :return: (N, P) coin value collected by each player this turn
+        """
+        moves = np.asarray(moves)
+        N, P = moves.shape
+        assert N == self.numGames and P == len(self.playerNames)
+        games = np.arange(N)[:, None]
+
+        playing = ~self.done
+        active = (moves != NO_MOVE) & playing[:, None]
+        targets = self.positions + MOVE_DELTAS[np.where(active, moves, 0)]
+        tx, ty = targets[..., 0], targets[..., 1]
+        inBounds = (tx >= 0) & (tx < self.height) & (ty >= 0) & (ty < self.width)
+        codes = self.grid[games, np.clip(tx, 0, self.height - 1), np.clip(ty, 0, self.width - 1)]
+        candidate = active & inBounds & (codes != WALL)
+
+        # Moves that share a target are all dropped
+        targetCells = np.where(candidate, tx * self.width + ty, -1)
+        sameTarget = (targetCells[:, :, None] == targetCells[:, None, :]) & candidate[:, :, None]
+        mover = candidate & (sameTarget.sum(-1) == 1)
+
+        # occupies[n, i, j]: player i targets the cell player j stands on
+        cells = self.positions[..., 0] * self.width + self.positions[..., 1]
+        occupies = targetCells[:, :, None] == cells[:, None, :]
+        swapped = occupies & occupies.transpose(0, 2, 1) & mover[:, :, None] & mover[:, None, :]
+        mover &= ~swapped.any(-1)
+
+        # Blocking spreads back along chains of players queued behind a player that stays
+        while True:
+            blocked = mover & (occupies & ~mover[:, None, :]).any(-1)
+            if not blocked.any():
+                break
+            mover &= ~blocked
+
+        gained = np.where(mover, CODE_VALUES[codes], 0)
+        self.scores += gained @ self.__teamOneHot
+        self.coins -= (gained > 0).sum(-1)
+        self.ticks += playing
+
+        gameIndex, playerIndex = np.nonzero(mover)
+        old = self.positions[gameIndex, playerIndex]
+        self.grid[gameIndex, old[:, 0], old[:, 1]] = EMPTY
+        self.grid[gameIndex, tx[gameIndex, playerIndex], ty[gameIndex, playerIndex]] = PLAYER
+        self.positions[gameIndex, playerIndex] = targets[gameIndex, playerIndex]
+
+        return gained
+
+    def vision(self, visionRadius: int = 2) -> np.ndarray:
+        """
+        Vision windows equivalent to Game.getGameData, centered on each player
+        :return: (N, P, 2r+1, 2r+1) cell codes, players split into VISION_SELF, VISION_TEAMMATE and VISION_ENEMY,
+                 cells off the board are VISION_OUT
+        """
+        r = visionRadius
+        size = 2 * r + 1
+        N, P = self.positions.shape[:2]
+        padded = np.pad(self.grid, ((0, 0), (r, r), (r, r)), constant_values=VISION_OUT)
+        offsets = np.arange(size)
+        rows = self.positions[..., 0, None, None] + offsets[:, None]
+        cols = self.positions[..., 1, None, None] + offsets[None, :]
+        vision = padded[np.arange(N)[:, None, None, None], rows, cols]
+
+        # Label every player standing inside a viewer's window relative to that viewer
+        relative = self.positions[:, None, :, :] - self.positions[:, :, None, :] + r
+        visible = ((relative >= 0) & (relative < size)).all(-1)
+        sameTeam = self.playerTeams[:, None] == self.playerTeams[None, :]
+        labels = np.where(sameTeam, VISION_TEAMMATE, VISION_ENEMY).astype(np.uint8)
+        labels[np.arange(P), np.arange(P)] = VISION_SELF
+        gameIndex, viewer, other = np.nonzero(visible)
+        vision[gameIndex, viewer, relative[gameIndex, viewer, other, 0], relative[gameIndex, viewer, other, 1]] = labels[viewer, other]
+        return vision
+
+    def getGameData(self, gameIndex: int, playerName: str, visionRadius: int = 2) -> dict:
+        """
+        Rebuilds the Game.getGameData payload of one player from the vision tensor, for checks against the reference
+        """
+        p = self.playerNames.index(playerName)
+        window = self.vision(visionRadius)[gameIndex, p]
+        centerX, centerY = (int(v) for v in self.positions[gameIndex, p])
+        locsOf = lambda code: [(centerX + int(dx) - visionRadius, centerY + int(dy) - visionRadius) for dx, dy in zip(*np.nonzero(window == code))]
+        teammates = {tuple(int(v) for v in self.positions[gameIndex, q]): name for q, name in enumerate(self.playerNames)}
+        teammatePositions = locsOf(VISION_TEAMMATE)
+        return {'teammateNames': [teammates[loc] for loc in teammatePositions],
+                'teammatePositions': teammatePositions,
+                'enemyPositions': locsOf(VISION_ENEMY),
+                'currentPosition': (centerX, centerY),
+                'coin1': locsOf(COIN1),
+                'coin2': locsOf(COIN2),
+                'coin3': locsOf(COIN3),
+                'walls': locsOf(WALL)}
+
+    def getScores(self, gameIndex: int) -> dict:
+        return {name: int(score) for name, score in zip(self.teamNames, self.scores[gameIndex])}
+
+
+if __name__ == '__main__':
+    import time
+
+    batch = BatchGame.create(10000, {'TeamA': ['Charles', 'Girish'], 'TeamB': ['James', 'Rana']}, seed=1)
+    rng = np.random.default_rng(1)
+    steps = 100
+    moves = rng.integers(0, len(MOVES), size=(steps, batch.numGames, len(batch.playerNames)))
+    start = time.perf_counter()
+    for t in range(steps):
+        batch.step(moves[t])
+    seconds = time.perf_counter() - start
+    print(f'{steps * moves.shape[1] * moves.shape[2] / seconds:,.0f} agent-steps/s')
@@ -0,0 +1,411 @@
+"""
+Headless benchmarks for the game core, the GameClient dispatch and the PlayerClient planners.
+Run with `python benchmark.py`, results are printed as JSON.
+Use --save-baseline to store them and --baseline to fail when a case gets slower than the stored result.
+"""
+
+import argparse
+import json
+import random
+import sys
+import time
+
+from game import Game
+from map import Map, ITEM_KINDS
+from moveset import Moveset
+from player import Player
+from team import Team
+from gameItems import *
+from transport import InMemoryBus, Message
+
+
+MAP_SIZES = (10, 50, 100, 500, 1000, 2000)
+DEFAULT_TOLERANCE = 0.25
+
+
+def timeIt(fn, repeat: int = 3) -> float:
+    """
+    Best wall time in seconds over repeat calls of fn
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def makeGame(args, seed: int = None) -> Game:
+    random.seed(args.seed if seed is None else seed)
+    names = {}
+    for i in range(args.players):
+        names.setdefault(f'Team{i % args.teams}', []).append(f'Player{i}')
+    return Game(names, args.size, args.size)
+
+
+def randomMoves(game: Game, rng: random.Random, turns: int) -> list[dict[str, Moveset]]:
+    moves = list(Moveset)
+    return [{name: rng.choice(moves) for name in game.all_players} for _ in range(turns)]
+
+
+def benchMapGeneration(size: int, numPlayers: int = 4, seed: int = 0) -> float:
+    def generate():
+        random.seed(seed)
+        Map(size, size, [Player(f'Player{i}', None) for i in range(numPlayers)])
+    return timeIt(generate, repeat=3 if size <= 500 else 1)
+
+
+def benchMapGenerationCase(args):
+    def run():
+        random.seed(args.seed)
+        Map(args.size, args.size, [Player(f'Player{i}', None) for i in range(args.players)])
+    return run, 1
+
+
+def benchGameStart(args):
+    names = {}
+    for i in range(args.players):
+        names.setdefault(f'Team{i % args.teams}', []).append(f'Player{i}')
+    def run():
+        for _ in range(args.turns // 10):
+            Game(names, args.size, args.size)
+    return run, args.turns // 10
+
+
+def benchGameStartPooled(args):
+    from mapPool import MapPool
+
+    names = {}
+    for i in range(args.players):
+        names.setdefault(f'Team{i % args.teams}', []).append(f'Player{i}')
+    pool = MapPool([(args.size, args.size)], depth=(args.turns // 10) * args.repeat, seed=args.seed)
+    # Layouts are made ahead of the timing, as the pool's thread would between games
+    pool.fill()
+    def run():
+        for _ in range(args.turns // 10):
+            Game(names, args.size, args.size, pool.take(args.size, args.size))
+    return run, args.turns // 10
+
+
+def benchMovePlayer(args):
+    turns = randomMoves(makeGame(args), random.Random(args.seed), args.turns)
+    def run():
+        game = makeGame(args)
+        for moves in turns:
+            for name, move in moves.items():
+                game.movePlayer(name, move)
+    return run, args.turns * args.players
+
+
+def benchApplyMoves(args):
+    turns = randomMoves(makeGame(args), random.Random(args.seed), args.turns)
+    def run():
+        game = makeGame(args)
+        for moves in turns:
+            game.applyMoves(moves)
+    return run, args.turns * args.players
+
+
+def benchGetGameData(args):
+    game = makeGame(args)
+    def run():
+        for _ in range(args.turns):
+            for name in game.all_players:
+                game.getGameData(name, args.radius)
+    return run, args.turns * args.players
+
+
+def benchGetAllGameData(args):
+    game = makeGame(args)
+    def run():
+        for _ in range(args.turns):
+            game.getAllGameData(args.radius)
+    return run, args.turns * args.players
+
+
+def benchGetAllGameDataDefaultBoard(args):
+    # The board and lobby size games get by default, whatever --size and --players say
+    return benchGetAllGameData(argparse.Namespace(**{**vars(args), 'size': 10, 'players': 8}))
+
+
+def benchFindInWindows(fill: float):
+    # A large board and wide vision, whatever --size and --radius say: the occupied share of the cells decides
+    # whether findInWindows sweeps the tile index (sparse) or scans the windows (dense)
+    size, radius = 1000, 20
+    def case(args):
+        rng = random.Random(args.seed)
+        cells = bytearray(size * size)
+        for i in rng.sample(range(size * size), int(fill * size * size)):
+            cells[i] = rng.choice(ITEM_KINDS)
+        teams = [Team(f'Team{i}') for i in range(args.teams)]
+        players = []
+        for i in rng.sample([i for i, code in enumerate(cells) if code == EMPTY], args.players):
+            player = Player(f'Player{len(players)}', teams[len(players) % args.teams])
+            player.loc = divmod(i, size)
+            cells[i] = PLAYER
+            players.append(player)
+        board = Map(size, size, players, cells=bytes(cells))
+        windows = [(max(x - radius, 0), min(x + radius, size - 1), max(y - radius, 0), min(y + radius, size - 1))
+                   for x, y in (player.loc for player in players)]
+        def run():
+            for _ in range(args.turns // 10):
+                board.findInWindows(windows)
+        return run, args.turns // 10 * args.players
+    return case
+
+
+def benchJsonEncode(args):
+    states = list(makeGame(args).getAllGameData(args.radius).values())
+    def run():
+        for _ in range(args.turns):
+            for state in states:
+                json.dumps(state)
+    return run, args.turns * len(states), {'bytes_per_state': sum(len(json.dumps(state)) for state in states) / len(states)}
+
+
+def benchJsonDecode(args):
+    payloads = [json.dumps(state) for state in makeGame(args).getAllGameData(args.radius).values()]
+    def run():
+        for _ in range(args.turns):
+            for payload in payloads:
+                json.loads(payload)
+    return run, args.turns * len(payloads)
+
+
+def benchBinaryEncode(args):
+    from wireFormat import encode_state
+
+    states = list(makeGame(args).getAllGameData(args.radius).values())
+    def run():
+        for _ in range(args.turns):
+            for state in states:
+                encode_state(state, 0, args.radius)
+    return run, args.turns * len(states), {'bytes_per_state': sum(len(encode_state(state, 0, args.radius)) for state in states) / len(states)}
+
+
+def benchBinaryDecode(args):
+    from wireFormat import decode_state, encode_state
+
+    payloads = [encode_state(state, 0, args.radius) for state in makeGame(args).getAllGameData(args.radius).values()]
+    def run():
+        for _ in range(args.turns):
+            for payload in payloads:
+                decode_state(payload)
+    return run, args.turns * len(payloads)
+
+
+def benchDispatch(args):
+    import GameClient
+
+    rng = random.Random(args.seed)
+    lobby = 'BenchLobby'
+    players = [(f'Team{i % args.teams}', f'Player{i}') for i in range(args.players)]
+    messages = [Message('new_game', json.dumps({'lobby_name': lobby, 'team_name': team, 'player_name': name}).encode())
+                for team, name in players]
+    messages.append(Message(f'games/{lobby}/start', b'START'))
+    for _ in range(args.turns):
+        for _, name in players:
+            messages.append(Message(f'games/{lobby}/{name}/move', rng.choice((b'UP', b'DOWN', b'LEFT', b'RIGHT'))))
+
+    def run():
+        random.seed(args.seed)
+        server = GameClient.GameServer(InMemoryBus().connect('GameClient'))
+        for msg in messages:
+            GameClient.on_message(server, None, msg)
+    return run, len(messages)
+
+
+def benchReplaySeek(args):
+    import os
+    import tempfile
+    from replay import GameRecorder, Replay
+
+    game = makeGame(args)
+    turns = randomMoves(game, random.Random(args.seed), args.turns * 10)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'bench.rec')
+        recorder = GameRecorder(path, game)
+        for moves in turns:
+            game.applyMoves(moves)
+            recorder.record(game, moves)
+        recorder.close(game)
+        replay = Replay.open(path)
+        size = os.path.getsize(path)
+    rng = random.Random(args.seed)
+    ticks = [rng.randrange(replay.last_tick + 1) for _ in range(args.turns)]
+    def run():
+        for tick in ticks:
+            replay.seek(tick)
+    return run, len(ticks), {'bytes_per_tick': size / len(turns)}
+
+
+def benchMetricsObserve(args):
+    from metrics import Histogram
+
+    # What an instrumented call site adds: two clock reads and an observation
+    histogram = Histogram('bench_seconds', 'benchmark')
+    def run():
+        for _ in range(1000):
+            start = time.perf_counter()
+            histogram.observe(time.perf_counter() - start)
+    return run, 1000
+
+
+def planningMap(args) -> tuple[list[list[str]], tuple[int, int], list[tuple[int, int]]]:
+    """
+    A fully explored team map built from a generated game, with a start cell and the coin cells
+    """
+    from PlayerClient import state_mapping
+
+    game = makeGame(args)
+    cells = game.map.map
+    symbols = {EMPTY: 'free', WALL: 'wall', COIN1: 'coin', COIN2: 'coin', COIN3: 'coin', PLAYER: 'free'}
+    team_map = [[state_mapping[symbols[cells[x, y]]] for y in range(args.size)] for x in range(args.size)]
+    coins = [(x, y) for x in range(args.size) for y in range(args.size) if cells[x, y] in COIN_VALUES]
+    start = next(iter(game.all_players.values())).loc
+    return team_map, start, coins
+
+
+def benchFindPath(args):
+    from PlayerClient import find_path_to_coin
+
+    team_map, start, coins = planningMap(args)
+    targets = random.Random(args.seed).sample(coins, min(len(coins), 20))
+    def run():
+        for coin in targets:
+            find_path_to_coin(team_map, start, coin)
+    return run, len(targets)
+
+
+def benchPathClear(args):
+    from PlayerClient import is_path_clear
+
+    team_map, start, coins = planningMap(args)
+    targets = random.Random(args.seed).sample(coins, min(len(coins), 20))
+    def run():
+        for coin in targets:
+            is_path_clear(team_map, start, coin)
+    return run, len(targets)
+
+
+def benchFindUnexplored(args):
+    from PlayerClient import find_nearest_unexplored_cell, state_mapping
+
+    team_map, start, _ = planningMap(args)
+    # Leave only the far corner unexplored so the search has to cross the board
+    team_map[-1][-1] = state_mapping['unexplored']
+    def run():
+        for _ in range(5):
+            find_nearest_unexplored_cell(team_map, start)
+    return run, 5
+
+
+def benchBatchStep(args):
+    import numpy as np
+    from batchGame import BatchGame, MOVES
+
+    names = {}
+    for i in range(args.players):
+        names.setdefault(f'Team{i % args.teams}', []).append(f'Player{i}')
+    batch = BatchGame.create(args.batch_games, names, args.size, args.size, seed=args.seed)
+    moves = np.random.default_rng(args.seed).integers(0, len(MOVES), size=(10, batch.numGames, args.players))
+    def run():
+        for t in range(len(moves)):
+            batch.step(moves[t])
+    return run, moves.size
+
+
+CASES = {
+    'map_generation': benchMapGenerationCase,
+    'game_start': benchGameStart,
+    'game_start_pooled': benchGameStartPooled,
+    'game_move_player': benchMovePlayer,
+    'game_apply_moves': benchApplyMoves,
+    'game_get_game_data': benchGetGameData,
+    'game_get_all_game_data': benchGetAllGameData,
+    'game_get_all_game_data_10x10': benchGetAllGameDataDefaultBoard,
+    'map_find_in_windows_1000x1000_sparse': benchFindInWindows(0.01),
+    'map_find_in_windows_1000x1000_dense': benchFindInWindows(0.3),
+    'json_encode_game_state': benchJsonEncode,
+    'json_decode_game_state': benchJsonDecode,
+    'binary_encode_game_state': benchBinaryEncode,
+    'binary_decode_game_state': benchBinaryDecode,
+    'gameclient_dispatch': benchDispatch,
+    'replay_seek': benchReplaySeek,
+    'metrics_observe': benchMetricsObserve,
+    'planner_find_path_to_coin': benchFindPath,
+    'planner_is_path_clear': benchPathClear,
+    'planner_find_nearest_unexplored': benchFindUnexplored,
+    'batch_game_step': benchBatchStep,
+}
+
+
+def runSuite(args, cases: list[str]) -> dict:
+    results = {}
+    for name in cases:
+        random.seed(args.seed)
+        # Cases may return a dict of extra figures, such as payload sizes, after fn and ops
+        fn, ops, *extra = CASES[name](args)
+        seconds = timeIt(fn, args.repeat)
+        results[name] = {'seconds': seconds, 'ops': ops, 'ops_per_sec': ops / seconds if seconds else float('inf'), **(extra[0] if extra else {})}
+    return results
+
+
+def compareToBaseline(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """
+    :return: descriptions of the cases slower than baseline by more than tolerance
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        limit = baseline[name]['seconds'] * (1 + tolerance)
+        if result['seconds'] > limit:
+            regressions.append(f"{name}: {result['seconds']:.6f}s > {baseline[name]['seconds']:.6f}s +{tolerance:.0%}")
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--cases', nargs='+', choices=CASES.keys(), default=list(CASES.keys()))
+    parser.add_argument('--size', type=int, default=10, help='board side length')
+    parser.add_argument('--players', type=int, default=4)
+    parser.add_argument('--teams', type=int, default=2)
+    parser.add_argument('--radius', type=int, default=2, help='vision radius')
+    parser.add_argument('--turns', type=int, default=200)
+    parser.add_argument('--batch-games', type=int, default=1000, help='games stepped together by batch_game_step')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='write the results to this JSON file as well')
+    parser.add_argument('--baseline', help='JSON results to compare against, exits with 1 on a regression')
+    parser.add_argument('--save-baseline', help='store the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE, help='allowed slowdown over the baseline')
+    parser.add_argument('--map-sizes', type=int, nargs='*', help='only print map generation times for these board sizes')
+    args = parser.parse_args()
+
+    if args.map_sizes is not None:
+        print('size\tcells\tseconds\tus/cell')
+        for size in args.map_sizes or MAP_SIZES:
+            seconds = benchMapGeneration(size, args.players, args.seed)
+            print(f'{size}x{size}\t{size * size}\t{seconds:.4f}\t{seconds / (size * size) * 1e6:.3f}')
+        sys.exit(0)
+
+    params = {key: getattr(args, key) for key in ('size', 'players', 'teams', 'radius', 'turns', 'batch_games', 'seed')}
+    report = {'params': params, 'results': runSuite(args, args.cases)}
+    print(json.dumps(report, indent=2))
+
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, 'w') as f:
+                json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline['params'] != params:
+            print(f"Baseline was recorded with different parameters: {baseline['params']}", file=sys.stderr)
+            sys.exit(2)
+        regressions = compareToBaseline(report['results'], baseline['results'], args.tolerance)
+        for regression in regressions:
+            print(f'Regression: {regression}', file=sys.stderr)
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,149 @@
+"""
+Checkpoints of live lobbies in a SQLite file, so a restarted GameClient picks its games up where they were.
+
+The server only marks lobbies changed while it handles messages. Every interval it captures the changed lobbies
+as plain records, which is a copy of a few hundred bytes per lobby, and hands them to the store's writer thread.
+Encoding and the SQLite transaction happen on that thread, off the path of turn resolution.
+A lobby's row is replaced on every checkpoint, so the file never holds more than one row per live lobby.
+"""
+
+from __future__ import annotations
+
+import json
+import queue
+import sqlite3
+import threading
+import time
+
+from game import Game
+from lobbyRegistry import Lobby
+
+
+SCHEMA = '''CREATE TABLE IF NOT EXISTS lobbies (
+    name TEXT PRIMARY KEY,
+    record TEXT NOT NULL,
+    cells BLOB,
+    updated REAL NOT NULL
+)'''
+
+
+def lobby_record(lobby: Lobby) -> dict:
+    """
+    Copy of a lobby's state that can be written on another thread
+    :return: {name, started, teams, config, game: Game.snapshot() or None,
+              moves: {player_name: move}, queued: {player_name: {tick: move}}}
+    """
+    return {'name': lobby.name,
+            'started': lobby.started,
+            'teams': {team_name: list(player_names) for team_name, player_names in lobby.teams.items()},
+            'config': lobby.config.model_dump(),
+            'game': lobby.game.snapshot() if lobby.game is not None else None,
+            'moves': {player_name: move.name for player_name, move in lobby.moves.items()},
+            'queued': {player_name: {tick: move.name for tick, move in queue.items()}
+                       for player_name, queue in lobby.queued.items() if queue}}
+
+
+def restore_game(record: dict) -> Game | None:
+    return Game.fromSnapshot(record['game']) if record['game'] is not None else None
+
+
+class CheckpointStore:
+    def __init__(self, path: str = 'checkpoints.db', interval: float = 1.0):
+        """
+        :param path: SQLite file, created if missing
+        :param interval: seconds between checkpoints of the lobbies that changed
+        """
+        assert interval > 0
+        self.path = path
+        self.interval = interval
+        self.written = 0
+        self.deleted = 0
+        self.batches = 0
+        self.__queue = queue.SimpleQueue()
+        self.__thread: threading.Thread = None
+        self.__lock = threading.Lock()
+
+    def load(self) -> list[dict]:
+        """
+        Records of every lobby in the file, in the shape of lobby_record
+        """
+        with sqlite3.connect(self.path) as db:
+            db.execute(SCHEMA)
+            rows = db.execute('SELECT record, cells FROM lobbies').fetchall()
+        db.close()
+        records = []
+        for text, cells in rows:
+            record = json.loads(text)
+            if record['game'] is not None:
+                record['game']['cells'] = cells
+            # JSON object keys are strings, queued moves are keyed by tick
+            record['queued'] = {player_name: {int(tick): move for tick, move in queue.items()}
+                                for player_name, queue in record['queued'].items()}
+            records.append(record)
+        return records
+
+    def submit(self, records: dict[str, dict | None]):
+        """
+        Queues records for the writer thread
+        :param records: {lobby_name: lobby_record or None to delete the lobby}
+        """
+        if not records:
+            return
+        with self.__lock:
+            if self.__thread is None:
+                self.__thread = threading.Thread(target=self.__run, name='CheckpointStore', daemon=True)
+                self.__thread.start()
+        self.__queue.put(records)
+
+    def close(self, timeout: float = None):
+        """
+        Writes what was submitted so far and stops the writer thread
+        """
+        with self.__lock:
+            thread, self.__thread = self.__thread, None
+        if thread is not None:
+            self.__queue.put(None)
+            thread.join(timeout)
+
+    def __run(self):
+        db = sqlite3.connect(self.path)
+        db.execute(SCHEMA)
+        # WAL lets load() read while a checkpoint is being written
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        stopping = False
+        while not stopping:
+            records = self.__queue.get()
+            if records is None:
+                break
+            # A slow disk only delays checkpoints, batches that piled up are merged and the latest record wins
+            while True:
+                try:
+                    more = self.__queue.get_nowait()
+                except queue.Empty:
+                    break
+                if more is None:
+                    stopping = True
+                    break
+                records.update(more)
+            self.__write(db, records)
+        db.close()
+
+    def __write(self, db: sqlite3.Connection, records: dict[str, dict | None]):
+        now = time.time()
+        rows = []
+        for name, record in records.items():
+            if record is None:
+                continue
+            cells = None
+            if record['game'] is not None:
+                record = dict(record, game=dict(record['game']))
+                cells = record['game'].pop('cells')
+            rows.append((name, json.dumps(record), cells, now))
+        deleted = [(name,) for name, record in records.items() if record is None]
+        with db:
+            db.executemany('INSERT OR REPLACE INTO lobbies (name, record, cells, updated) VALUES (?, ?, ?, ?)', rows)
+            db.executemany('DELETE FROM lobbies WHERE name = ?', deleted)
+        self.written += len(rows)
+        self.deleted += len(deleted)
+        self.batches += 1
@@ -0,0 +1,224 @@
+"""
+Cluster mode of the game server: several nodes share the broker's ingress through MQTT v5 shared subscriptions
+and every lobby stays pinned to the one node that claimed it.
+
+Topics used between the nodes:
+    gameservers/nodes/<node>            retained 'online' while the node lives, cleared by its will when it dies
+    gameservers/lobbies/<lobby>         retained ownership record {'node', 'teams', 'config'} of a lobby
+    gameservers/inbox/<node>/<topic>    a message another node received for a lobby this node owns
+
+A node that gets a message for a lobby owned elsewhere forwards it to the owner's inbox.
+A new lobby is claimed by the live node ranked first for its name (rendezvous hashing), and when two claims race
+the smaller node id keeps the lobby. Lobbies of a node that died go to the next node in their ranking,
+which rebuilds them from the ownership record and restarts games that were running.
+
+    python GameClient.py --mode cluster --node-id a --broker localhost --port 1883 --no-tls
+    python GameClient.py --mode cluster --node-id b --broker localhost --port 1883 --no-tls
+"""
+
+import hashlib
+import json
+import os
+import socket
+import threading
+
+from GameClient import GameServer, get_lobby_name, on_message, publish_to_lobby, remove_lobby, start_game
+from InputTypes import LobbyConfig
+from lobbyRegistry import LobbyRegistry
+from mapPool import MapPool
+from transport import Message, Transport
+
+
+GROUP = 'gameservers'
+NODES_TOPIC = 'gameservers/nodes'
+LOBBIES_TOPIC = 'gameservers/lobbies'
+INBOX_TOPIC = 'gameservers/inbox'
+
+
+def default_node_id() -> str:
+    return f'{socket.gethostname()}-{os.getpid()}'
+
+
+def node_will(node_id: str) -> tuple:
+    """
+    Will for a node's connection, clears its retained liveness record when the broker loses it
+    """
+    return f'{NODES_TOPIC}/{node_id}', None, 1, True
+
+
+def rank(lobby_name: str, nodes) -> list[str]:
+    """
+    Nodes in the order they should own lobby_name, the same on every node that knows the same nodes.
+    crc32 is linear and would rank the nodes alike for every lobby, so the weights come from blake2b
+    """
+    def weight(node):
+        return hashlib.blake2b(f'{lobby_name}/{node}'.encode(), digest_size=8).digest(), node
+    return sorted(nodes, key=weight, reverse=True)
+
+
+class ClusterGameServer(GameServer):
+    def __init__(self, transport: Transport, node_id: str = None, settle: float = 2.0, default_config: LobbyConfig = None,
+                 lobbies: LobbyRegistry = None, maps: MapPool = None):
+        """
+        :param transport: should carry node_will(node_id) as its will
+        :param settle: seconds to learn the other nodes and lobbies before taking over orphaned lobbies
+        """
+        super().__init__(transport, default_config, lobbies, maps=maps)
+        self.node_id = node_id or default_node_id()
+        assert not any(c in self.node_id for c in '/+#'), 'node id must be a single topic level'
+        self.settle = settle
+        self.nodes: set[str] = set()
+        self.owners: dict[str, str] = {} # Owning node of every lobby in the cluster {'lobby_name' : node_id}
+        self.records: dict[str, dict] = {} # Last ownership record of lobbies owned elsewhere, used for handover
+        self.forwarded = 0
+        self.__inbox = f'{INBOX_TOPIC}/{self.node_id}/'
+        # Every node reports its own metrics
+        self.metrics_topic = f'games/$sys/metrics/{self.node_id}'
+        self.admin_topic = f'games/$sys/admin/{self.node_id}/profile'
+        self.__settled = settle <= 0
+
+    def start(self):
+        self.transport.subscribe(f'{NODES_TOPIC}/+', qos=1)
+        self.transport.subscribe(f'{LOBBIES_TOPIC}/+', qos=1)
+        self.transport.subscribe(f'{self.__inbox}#', qos=1)
+        for topic in GameServer.SUBSCRIPTIONS:
+            self.transport.subscribe(f'$share/{GROUP}/{topic}', qos=1)
+        if self.profiler is not None:
+            self.transport.subscribe(self.admin_topic, qos=1)
+        self.publish(f'{NODES_TOPIC}/{self.node_id}', 'online', qos=1, retain=True)
+        self.start_housekeeping()
+        if not self.__settled:
+            timer = threading.Timer(self.settle, self.__settle)
+            timer.daemon = True
+            timer.start()
+
+    def stop(self):
+        """
+        Leaves the cluster cleanly, the other nodes take over this node's lobbies
+        """
+        self.publish(f'{NODES_TOPIC}/{self.node_id}', None, qos=1, retain=True)
+
+    def on_message(self, client, userdata, msg):
+        with self.lock:
+            if msg.topic.startswith(self.__inbox):
+                self.__route(Message(msg.topic[len(self.__inbox):], msg.payload, msg.qos), forwarded=True)
+            elif msg.topic.startswith(f'{NODES_TOPIC}/'):
+                self.__on_node(msg.topic.split('/')[-1], msg.payload)
+            elif msg.topic.startswith(f'{LOBBIES_TOPIC}/'):
+                self.__on_record(msg.topic.split('/')[-1], msg.payload)
+            elif msg.topic == self.admin_topic:
+                # Addressed to this node, '$sys' is no lobby to route
+                on_message(self, None, msg)
+            else:
+                self.__route(msg)
+
+    def __route(self, msg, forwarded=False):
+        lobby_name = get_lobby_name(msg.topic, msg.payload)
+        owner = self.owners.get(lobby_name)
+        if lobby_name is None or owner == self.node_id:
+            on_message(self, None, msg)
+            return
+        if owner is None:
+            # Unclaimed: new lobbies go to the first node in their ranking, which claims them on arrival
+            owner = self.node_id if forwarded else rank(lobby_name, self.nodes | {self.node_id})[0]
+            if owner == self.node_id:
+                if msg.topic == 'new_game':
+                    self.__claim(lobby_name)
+                on_message(self, None, msg)
+                return
+        self.forwarded += 1
+        self.publish(f'{INBOX_TOPIC}/{owner}/{msg.topic}', msg.payload, qos=1)
+
+    def __claim(self, lobby_name):
+        self.owners[lobby_name] = self.node_id
+        self.records.pop(lobby_name, None)
+
+    def __record(self, lobby_name) -> dict:
+        lobby = self.lobbies.get(lobby_name)
+        return {'node': self.node_id,
+                'teams': lobby.roster() if lobby is not None else {'started': False},
+                'config': lobby.config.model_dump() if lobby is not None else None}
+
+    def lobby_updated(self, lobby_name):
+        if self.owners.get(lobby_name) == self.node_id:
+            self.publish(f'{LOBBIES_TOPIC}/{lobby_name}', json.dumps(self.__record(lobby_name)), qos=1, retain=True)
+
+    def lobby_removed(self, lobby_name):
+        if self.owners.get(lobby_name) == self.node_id:
+            del self.owners[lobby_name]
+            self.publish(f'{LOBBIES_TOPIC}/{lobby_name}', None, qos=1, retain=True)
+
+    def __on_node(self, node_id, payload):
+        if payload:
+            self.nodes.add(node_id)
+        else:
+            self.nodes.discard(node_id)
+            if node_id != self.node_id:
+                self.__reconcile()
+
+    def __on_record(self, lobby_name, payload):
+        if not payload:
+            if self.owners.get(lobby_name) != self.node_id:
+                self.owners.pop(lobby_name, None)
+                self.records.pop(lobby_name, None)
+            return
+        record = json.loads(payload)
+        node_id = record['node']
+        if node_id == self.node_id:
+            return
+        if self.owners.get(lobby_name) == self.node_id:
+            if self.node_id < node_id:
+                # Lost race of the other node, restate the claim since the broker keeps the last record
+                self.lobby_updated(lobby_name)
+                return
+            self.__hand_over(lobby_name, node_id)
+        self.owners[lobby_name] = node_id
+        self.records[lobby_name] = record
+        if node_id not in self.nodes:
+            self.__reconcile()
+
+    def __hand_over(self, lobby_name, node_id):
+        # Our claim lost, the players that joined here are sent on to the winner as new joins
+        lobby = self.lobbies.get(lobby_name)
+        self.owners[lobby_name] = node_id
+        for team_name, player_names in (lobby.teams.items() if lobby is not None else ()):
+            for player_name in player_names:
+                self.forwarded += 1
+                self.publish(f'{INBOX_TOPIC}/{node_id}/new_game', json.dumps(
+                    {'lobby_name': lobby_name, 'team_name': team_name, 'player_name': player_name}), qos=1)
+        remove_lobby(self, lobby_name)
+
+    def __settle(self):
+        with self.lock:
+            self.__settled = True
+            self.__reconcile()
+
+    def __reconcile(self):
+        """
+        Takes over the lobbies of nodes that are gone when this node is next in their ranking
+        """
+        if not self.__settled:
+            return
+        live = self.nodes | {self.node_id}
+        for lobby_name, owner in list(self.owners.items()):
+            if owner not in live and rank(lobby_name, live)[0] == self.node_id:
+                self.__take_over(lobby_name, self.records.pop(lobby_name, {}))
+
+    def __take_over(self, lobby_name, record):
+        teams = dict(record.get('teams') or {'started': False})
+        started = teams.get('started', False)
+        self.__claim(lobby_name)
+        lobby = self.lobbies.get(lobby_name) or self.lobbies.create(lobby_name, self.default_config)
+        if lobby is None:
+            publish_to_lobby(self, lobby_name, f"Error: Server {self.node_id} is full, the lobby was closed")
+            self.lobby_removed(lobby_name)
+            return
+        lobby.teams = {team_name: player_names for team_name, player_names in teams.items() if team_name != 'started'}
+        if record.get('config') is not None:
+            lobby.config = LobbyConfig(**record['config'])
+        publish_to_lobby(self, lobby_name, f"Lobby handed over to server {self.node_id}"
+                                           + (", the game was restarted" if started else ""))
+        if started:
+            start_game(self, ['games', lobby_name, 'start'], b'START')
+        else:
+            self.lobby_updated(lobby_name)
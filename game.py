@@ -2,17 +2,20 @@
 Author: Charles Lee
 """
 
+from __future__ import annotations
 from map import Map
 from moveset import Moveset
 from player import Player
 from team import Team
 from gameItems import *
 import random
+from collections import Counter
 
 class Game:
-    def __init__(self, playerNames: dict[str,list[str]], width: int = 10, height: int = 10):
+    def __init__(self, playerNames: dict[str,list[str]], width: int = 10, height: int = 10, layout: Map = None):
         """
         :param playerNames: Dictionary for each team name with a list of player names
+        :param layout: a Map of the same size made without players, e.g. from a MapPool, used instead of a new map
         """
         self.numTeams = len(playerNames)
 
@@ -20,7 +23,53 @@ class Game:
 
         self.__height = height
         self.__width = width
-        self.map = Map(height, width, list(self.all_players.values()))
+        if layout is None:
+            self.map = Map(height, width, list(self.all_players.values()))
+        else:
+            assert layout.height == height and layout.width == width
+            layout.placePlayers(list(self.all_players.values()))
+            self.map = layout
+        self.tick = 0
+
+    def snapshot(self) -> dict:
+        """
+        Full state of the game, enough for fromSnapshot to rebuild it
+        :return: {
+            height: int,
+            width: int,
+            tick: int,
+            teams: {teamName: {score: int, players: {playerName: (x,y),...}},...},
+            cells: bytes
+        }
+        """
+        teams = {teamName: {'score': team.score, 'players': {}} for teamName, team in self.teams.items()}
+        for player in self.all_players.values():
+            teams[player.team.name]['players'][player.name] = player.loc
+        return {'height': self.__height,
+                'width': self.__width,
+                'tick': self.tick,
+                'teams': teams,
+                'cells': self.map.cells}
+
+    @classmethod
+    def fromSnapshot(cls, snapshot: dict) -> Game:
+        """
+        :param snapshot: from Game.snapshot, locations may be lists after a JSON round trip
+        """
+        game = cls.__new__(cls)
+        teams = snapshot['teams']
+        game.numTeams = len(teams)
+        game.teams, game.all_players = game.__initializePlayers({teamName: list(team['players']) for teamName, team in teams.items()})
+        for teamName, team in teams.items():
+            game.teams[teamName].increaseScore(team['score'])
+            for playerName, loc in team['players'].items():
+                game.all_players[playerName].loc = tuple(loc)
+
+        game.__height = snapshot['height']
+        game.__width = snapshot['width']
+        game.map = Map(game.__height, game.__width, list(game.all_players.values()), cells=snapshot['cells'])
+        game.tick = snapshot['tick']
+        return game
 
     def __initializePlayers(self, playerNames: dict[str,list[str]]):
         teams = {}
@@ -43,18 +92,83 @@ class Game:
         if not (0 <= new_loc[0] < self.__height) or not (0 <= new_loc[1] < self.__width):
             return
 
-        cell = self.map.get(new_loc)
-        if isinstance(cell, Player) or isinstance(cell, Wall):
+        code = self.map.getCode(new_loc)
+        if code == PLAYER or code == WALL:
             return
 
-        if isinstance(cell, Coin):
-            player.team.increaseScore(cell.value)
+        if code in COIN_VALUES:
+            player.team.increaseScore(COIN_VALUES[code])
             self.map.decreaseCoin()
 
         self.map.set(player.loc, None)
         self.map.set(new_loc, player)
         player.loc = new_loc
 
+    def applyMoves(self, moves: dict[str, Moveset]) -> dict:
+        """
+        Resolves a whole turn at once, independent of the order the moves arrived in.
+        A move is dropped if it leaves the map or hits a wall, if another player targets the same cell,
+        if two players would swap places, or if the target is held by a player who is not moving away.
+        Players may step into cells vacated in the same turn.
+        :param moves: {playerName: move}, players without a move stay in place
+        :return: {
+            tick: int,
+            moved: {playerName: ((x,y), (x,y)),...},
+            coins: [((x,y), value),...],
+            scores: {teamName: gained,...}
+        }
+        """
+        targets = {}
+        for playerName, move in moves.items():
+            assert isinstance(move, Moveset)
+            player = self.getPlayer(playerName)
+            x, y = player.loc
+            dx, dy = move.value
+            new_loc = x+dx, y+dy
+            if not (0 <= new_loc[0] < self.__height) or not (0 <= new_loc[1] < self.__width):
+                continue
+            if self.map.getCode(new_loc) == WALL:
+                continue
+            targets[player] = new_loc
+
+        claims = Counter(targets.values())
+        movers = {player: new_loc for player, new_loc in targets.items() if claims[new_loc] == 1}
+
+        occupants = {player.loc: player for player in self.all_players.values()}
+        swapped = [player for player, new_loc in movers.items()
+                   if occupants.get(new_loc) is not None and movers.get(occupants[new_loc]) == player.loc]
+        for player in swapped:
+            del movers[player]
+
+        # Blocking spreads back along chains of players queued behind a player that stays
+        blocked = True
+        while blocked:
+            blocked = [player for player, new_loc in movers.items()
+                       if new_loc in occupants and occupants[new_loc] not in movers]
+            for player in blocked:
+                del movers[player]
+
+        self.tick += 1
+        delta = {'tick': self.tick, 'moved': {}, 'coins': [], 'scores': {}}
+        codes = {player: self.map.getCode(new_loc) for player, new_loc in movers.items()}
+        for player in movers:
+            self.map.set(player.loc, None)
+        for player in self.all_players.values():
+            if player not in movers:
+                continue
+            new_loc = movers[player]
+            if codes[player] in COIN_VALUES:
+                value = COIN_VALUES[codes[player]]
+                player.team.increaseScore(value)
+                self.map.decreaseCoin()
+                delta['coins'].append((new_loc, value))
+                delta['scores'][player.team.name] = delta['scores'].get(player.team.name, 0) + value
+            self.map.set(new_loc, player)
+            delta['moved'][player.name] = (player.loc, new_loc)
+            player.loc = new_loc
+
+        return delta
+
     def getPlayer(self, playerName: str) -> Player:
         assert isinstance(playerName, str)
         try:
@@ -78,45 +192,50 @@ class Game:
         }
         """
         assert isinstance(playerName, str)
+        return self.getAllGameData(visionRadius, [playerName])[playerName]
+
+    def getAllGameData(self, visionRadius: int = 2, playerNames: list[str] = None) -> dict[str, dict]:
+        """
+        Vision payloads for many players, their windows are queried from the map together
+        :param visionRadius:
+        :param playerNames: players to compute for, every player by default
+        :return: {playerName: getGameData(playerName), ...}
+        """
         assert isinstance(visionRadius, int)
-        player = self.getPlayer(playerName)
-        centerX, centerY = player.loc
-        minX = max(centerX - visionRadius, 0)
-        maxX = min(centerX + visionRadius, self.__height-1)
-        minY = max(centerY - visionRadius, 0)
-        maxY = min(centerY + visionRadius, self.__width-1)
-        gameData = {'teammateNames': [],
-                    'teammatePositions': [],
-                    'enemyPositions': [],
-                    'currentPosition': player.loc,
-                    'coin1': [],
-                    'coin2': [],
-                    'coin3': [],
-                    'walls': []}
-
-        for x in range(minX, maxX+1):
-            for y in range(minY, maxY+1):
-                cell = self.map.get((x,y))
-                self.__addGameData(gameData, cell, (x,y), player)
-
-        return gameData
-
-    def __addGameData(self, gameData: dict, cell: object, loc: tuple[int, int], player: Player):
-        if isinstance(cell, Player):
-            if cell.team is player.team and cell is not player:
-                gameData['teammateNames'].append(cell.name)
-                gameData['teammatePositions'].append(loc)
-            elif cell.team is not player.team:
-                gameData['enemyPositions'].append(loc)
-        elif isinstance(cell, Coin1):
-            gameData['coin1'].append(loc)
-        elif isinstance(cell, Coin2):
-            gameData['coin2'].append(loc)
-        elif isinstance(cell, Coin3):
-            gameData['coin3'].append(loc)
-        elif isinstance(cell, Wall):
-            gameData['walls'].append(loc)
-    
+        players = list(self.all_players.values()) if playerNames is None else [self.getPlayer(name) for name in playerNames]
+
+        windows = []
+        for player in players:
+            centerX, centerY = player.loc
+            windows.append((max(centerX - visionRadius, 0), min(centerX + visionRadius, self.__height-1),
+                            max(centerY - visionRadius, 0), min(centerY + visionRadius, self.__width-1)))
+
+        allGameData = {}
+        for player, (items, teams) in zip(players, self.map.findInWindows(windows)):
+            gameData = {'teammateNames': [],
+                        'teammatePositions': [],
+                        'enemyPositions': [],
+                        'currentPosition': player.loc,
+                        'coin1': items[COIN1],
+                        'coin2': items[COIN2],
+                        'coin3': items[COIN3],
+                        'walls': items[WALL]}
+
+            for team, visible in teams.items():
+                if team is player.team:
+                    for teammate in visible:
+                        if teammate is not player:
+                            gameData['teammateNames'].append(teammate.name)
+                            gameData['teammatePositions'].append(teammate.loc)
+                else:
+                    gameData['enemyPositions'].extend(enemy.loc for enemy in visible)
+            # Teams are queried one after another, restore row-major order across them
+            gameData['enemyPositions'].sort()
+
+            allGameData[player.name] = gameData
+
+        return allGameData
+
     def gameOver(self):
         return self.map.numCoins <= 0
 
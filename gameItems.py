@@ -25,4 +25,14 @@ class Coin2(Coin):
 class Coin3(Coin):
     @property
     def value(self):
-        return 3
\ No newline at end of file
+        return 3
+
+# Cell codes used by the compact grid in Map, one byte per cell
+EMPTY = 0
+WALL = 1
+COIN1 = 2
+COIN2 = 3
+COIN3 = 4
+PLAYER = 5
+
+COIN_VALUES = {COIN1: 1, COIN2: 2, COIN3: 3}
@@ -0,0 +1,113 @@
+"""
+Logging for the game server and the player clients.
+
+Logging calls only put the record on a queue. A listener thread formats the records and writes them to the
+terminal, so a slow terminal or a full pipe never holds up a turn. Records are formatted on the listener thread
+too, so their arguments must not change after the call: pass strings, numbers, bytes or a BoardDump.
+
+Board dumps are sampled, a lobby's board is logged at DEBUG every board_every ticks rather than every turn.
+
+    python GameClient.py --log-level DEBUG --board-every 10
+"""
+
+from __future__ import annotations
+
+import atexit
+import logging
+import logging.handlers
+import queue
+import sys
+
+from gameItems import PLAYER
+from map import CELL_NAMES
+
+
+FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+
+board_every = 10 # Ticks between board dumps of a lobby, 0 for none
+_listener: logging.handlers.QueueListener = None
+_settings: tuple = None
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # QueueHandler formats the message on the calling thread, the listener's handlers do that instead
+        return record
+
+
+class BoardDump:
+    __slots__ = ('width', 'cells', 'players')
+
+    def __init__(self, game):
+        """
+        Copy of the board taken where the game runs, rendered like Map.__repr__ on the listener thread
+        :param game: the Game whose board to copy
+        """
+        self.width = game.map.width
+        self.cells = game.map.cells
+        self.players = {player.loc: player.name for player in game.all_players.values()}
+
+    def __str__(self):
+        rows = []
+        for x in range(len(self.cells) // self.width):
+            row = self.cells[x * self.width:(x + 1) * self.width]
+            rows.append('\t'.join(self.players[(x, y)] if code == PLAYER else CELL_NAMES[code] for y, code in enumerate(row)))
+        return '\n'.join(rows)
+
+
+def setup_logging(level: int | str = logging.INFO, board_every_ticks: int = None, stream=None):
+    """
+    Sends every logger of this process through a queue to a listener thread writing to stream.
+    Calling it again replaces the previous setup
+    :param level: records below this level are dropped where they are logged, before they reach the queue
+    :param board_every_ticks: ticks between board dumps of a lobby, 0 for none, unchanged when None
+    :param stream: where the listener writes, stderr by default
+    """
+    global _listener, _settings, board_every
+    if board_every_ticks is not None:
+        assert board_every_ticks >= 0
+        board_every = board_every_ticks
+    if isinstance(level, str):
+        level = logging.getLevelName(level.upper())
+    stop_logging()
+
+    records = queue.SimpleQueue()
+    output = logging.StreamHandler(stream if stream is not None else sys.stderr)
+    output.setFormatter(logging.Formatter(FORMAT))
+    _listener = logging.handlers.QueueListener(records, output)
+    _listener.start()
+    root = logging.getLogger()
+    # A process forked from a configured one inherits its handler but not its listener thread
+    for handler in [h for h in root.handlers if isinstance(h, DeferredQueueHandler)]:
+        root.removeHandler(handler)
+    root.addHandler(DeferredQueueHandler(records))
+    root.setLevel(level)
+    _settings = (level, board_every)
+
+
+def stop_logging():
+    """
+    Writes the records still queued and stops the listener thread
+    """
+    global _listener
+    listener, _listener = _listener, None
+    if listener is not None:
+        listener.stop()
+
+
+def settings() -> tuple | None:
+    """
+    :return: (level, board_every) of the last setup_logging(), for worker processes to set up the same way
+    """
+    return _settings
+
+
+def log_board(logger: logging.Logger, lobby_name: str, game):
+    """
+    Logs the board at DEBUG if the game is at a sampled tick, only then is the board copied
+    """
+    if board_every and game.tick % board_every == 0 and logger.isEnabledFor(logging.DEBUG):
+        logger.debug('%s board at tick %d\n%s', lobby_name, game.tick, BoardDump(game))
+
+
+atexit.register(stop_logging)
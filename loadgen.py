@@ -0,0 +1,326 @@
+"""
+Load generator that plays many simulated lobbies against a GameServer and reports
+throughput and the latency from publishing a move to receiving the resulting game_state.
+
+    python loadgen.py --lobbies 200 --players-per-team 2 --duration 10
+    python loadgen.py --transport mqtt --broker localhost --port 1883 --no-tls
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+
+from gameLogging import setup_logging
+from mapPool import parse_size
+from PlayerClient import state_mapping, manhattan_distance, find_path_to_coin, find_nearest_unexplored_cell
+from transport import InMemoryBus, PahoTransport, Transport
+from wireFormat import decode_state, decode_tick, is_binary
+
+
+MOVES = {'UP': (-1, 0), 'DOWN': (1, 0), 'LEFT': (0, -1), 'RIGHT': (0, 1)}
+
+
+def percentile(values: list[float], p: float) -> float:
+    """
+    Nearest-rank percentile of already sorted values
+    """
+    if not values:
+        return float('nan')
+    k = max(0, min(len(values) - 1, int(round(p / 100 * len(values) + 0.5)) - 1))
+    return values[k]
+
+
+class SimulatedPlayer:
+    def __init__(self, lobby: 'SimulatedLobby', team_name: str, player_name: str):
+        self.lobby = lobby
+        self.team_name = team_name
+        self.player_name = player_name
+        self.position = None
+        self.sent_at = None
+        self.waiting = False
+
+
+class SimulatedLobby:
+    def __init__(self, lobby_name: str, board: tuple[int, int]):
+        self.lobby_name = lobby_name
+        self.players: dict[str, SimulatedPlayer] = {}
+        self.team_maps: dict[str, list[list[str]]] = {}
+        self.height, self.width = board
+        self.next_tick = 0.0
+        self.over = False
+
+    def team_map(self, team_name: str) -> list[list[str]]:
+        if team_name not in self.team_maps:
+            self.team_maps[team_name] = [[state_mapping['unexplored']] * self.width for _ in range(self.height)]
+        return self.team_maps[team_name]
+
+
+class LoadGenerator:
+    def __init__(self, transport: Transport, lobbies: int, teams: int, players_per_team: int,
+                 rate: float, policy: str = 'random', board: tuple[int, int] = (10, 10), vision_radius: int = 2, seed: int = 0,
+                 skip: float = 0.0):
+        """
+        :param rate: turns per second each lobby tries to play, 0 plays as fast as states come back
+        :param policy: 'random' moves, or 'planner' which steers with the PlayerClient path finding
+        :param skip: chance a player sits a turn out, which only timed turns recover from
+        :param board: (height, width) of the boards the server starts the games on
+        """
+        self.transport = transport
+        self.transport.on_message = self.on_message
+        self.num_lobbies = lobbies
+        self.teams = teams
+        self.players_per_team = players_per_team
+        self.rate = rate
+        self.policy = policy
+        self.board = board
+        self.vision_radius = vision_radius
+        self.skip = skip
+        self.rng = random.Random(seed)
+
+        self.lock = threading.Lock()
+        self.lobbies: dict[str, SimulatedLobby] = {}
+        self.generation = 0
+        self.latencies: list[float] = []
+        self.moves_sent = 0
+        self.moves_skipped = 0
+        self.states_received = 0
+        self.messages_received = 0
+        self.bytes_received = 0
+        self.games_finished = 0
+
+    def on_message(self, client, userdata, msg):
+        now = time.perf_counter()
+        topic_list = msg.topic.split('/')
+        with self.lock:
+            self.messages_received += 1
+            self.bytes_received += len(msg.payload)
+            lobby = self.lobbies.get(topic_list[1])
+            if lobby is None:
+                return
+            if topic_list[-1] == 'game_state':
+                state = decode_state(msg.payload) if is_binary(msg.payload) else json.loads(msg.payload)
+                self.on_state(lobby, topic_list[2], state, now)
+            elif topic_list[-1] == 'tick':
+                # Combined turn message of a lobby that batches its publishes
+                if is_binary(msg.payload):
+                    states = {name: decode_state(state) for name, state in decode_tick(msg.payload).items()}
+                else:
+                    states = json.loads(msg.payload)['states']
+                for player_name, state in states.items():
+                    self.on_state(lobby, player_name, state, now)
+            elif topic_list[-1] == 'lobby' and msg.payload.startswith(b'Game Over'):
+                lobby.over = True
+
+    def on_state(self, lobby: SimulatedLobby, player_name: str, state: dict, now: float):
+        player = lobby.players.get(player_name)
+        if player is None:
+            return
+        self.states_received += 1
+        if player.sent_at is not None:
+            self.latencies.append(now - player.sent_at)
+            player.sent_at = None
+        player.waiting = False
+        if 'currentPosition' in state:
+            player.position = tuple(state['currentPosition'])
+        if self.policy == 'planner':
+            self.update_team_map(lobby.team_map(player.team_name), state)
+
+    def update_team_map(self, team_map: list[list[str]], state: dict):
+        if 'currentPosition' not in state:
+            return
+        x, y = state['currentPosition']
+        r = self.vision_radius
+        height, width = self.board
+        for i in range(max(x - r, 0), min(x + r, height - 1) + 1):
+            for j in range(max(y - r, 0), min(y + r, width - 1) + 1):
+                team_map[i][j] = state_mapping['free']
+        for key, symbol in (('walls', 'wall'), ('coin1', 'coin'), ('coin2', 'coin'), ('coin3', 'coin'),
+                            ('teammatePositions', 'player'), ('enemyPositions', 'player')):
+            for i, j in state.get(key, ()):
+                team_map[i][j] = state_mapping[symbol]
+
+    def choose_move(self, lobby: SimulatedLobby, player: SimulatedPlayer) -> str:
+        if self.policy == 'planner' and player.position is not None:
+            team_map = lobby.team_map(player.team_name)
+            start = player.position
+            coins = [(i, j) for i, row in enumerate(team_map) for j, cell in enumerate(row) if cell == state_mapping['coin']]
+            path = None
+            if coins:
+                path = find_path_to_coin(team_map, start, min(coins, key=lambda coin: manhattan_distance(start, coin)))
+            if not path or len(path) < 2:
+                path = find_nearest_unexplored_cell(team_map, start)
+            if path and len(path) >= 2:
+                step = (path[1][0] - start[0], path[1][1] - start[1])
+                for move, delta in MOVES.items():
+                    if delta == step:
+                        return move
+        return self.rng.choice(tuple(MOVES))
+
+    def create_lobby(self, index: int):
+        lobby = SimulatedLobby(f'Load{index}-{self.generation}', self.board)
+        for t in range(self.teams):
+            for p in range(self.players_per_team):
+                player = SimulatedPlayer(lobby, f'Team{t}', f'P{t}-{p}')
+                lobby.players[player.player_name] = player
+        with self.lock:
+            self.lobbies[lobby.lobby_name] = lobby
+            # Waiting for the first game_state, which START publishes
+            for player in lobby.players.values():
+                player.waiting = True
+        for player in lobby.players.values():
+            self.transport.publish('new_game', json.dumps({'lobby_name': lobby.lobby_name,
+                                                          'team_name': player.team_name,
+                                                          'player_name': player.player_name}), qos=1)
+        self.transport.publish(f'games/{lobby.lobby_name}/start', 'START', qos=1)
+
+    def play_turn(self, lobby: SimulatedLobby, now: float) -> bool:
+        """
+        :return: whether the lobby was ready and moves were sent
+        """
+        with self.lock:
+            if any(player.waiting for player in lobby.players.values()):
+                return False
+            moves = []
+            for player in lobby.players.values():
+                player.waiting = True
+                if self.skip and self.rng.random() < self.skip:
+                    self.moves_skipped += 1
+                    continue
+                moves.append((player, self.choose_move(lobby, player)))
+        for player, move in moves:
+            player.sent_at = time.perf_counter()
+            self.moves_sent += 1
+            self.transport.publish(f'games/{lobby.lobby_name}/{player.player_name}/move', move, qos=1)
+        lobby.next_tick = now + (1 / self.rate if self.rate > 0 else 0)
+        return True
+
+    def run(self, duration: float) -> dict:
+        self.transport.subscribe('games/+/+/game_state')
+        self.transport.subscribe('games/+/lobby')
+        self.transport.subscribe('games/+/tick')
+        self.transport.loop_start()
+
+        for i in range(self.num_lobbies):
+            self.create_lobby(i)
+
+        start = time.perf_counter()
+        end = start + duration
+        while True:
+            now = time.perf_counter()
+            if now >= end:
+                break
+            played = False
+            for index, lobby in enumerate(list(self.lobbies.values())):
+                if lobby.over:
+                    with self.lock:
+                        del self.lobbies[lobby.lobby_name]
+                        self.games_finished += 1
+                    self.generation += 1
+                    self.create_lobby(index)
+                elif now >= lobby.next_tick:
+                    played = self.play_turn(lobby, now) or played
+            if not played:
+                # Nothing was ready, leave the server and network threads room to deliver states
+                time.sleep(0.0005)
+
+        elapsed = time.perf_counter() - start
+        self.transport.loop_stop()
+        latencies = sorted(self.latencies)
+        return {'lobbies': self.num_lobbies,
+                'players': self.num_lobbies * self.teams * self.players_per_team,
+                'seconds': elapsed,
+                'moves_sent': self.moves_sent,
+                'moves_skipped': self.moves_skipped,
+                'states_received': self.states_received,
+                'messages_received': self.messages_received,
+                'messages_per_state': self.messages_received / max(self.states_received, 1),
+                'bytes_per_state': self.bytes_received / max(self.states_received, 1),
+                'games_finished': self.games_finished,
+                'moves_per_sec': self.moves_sent / elapsed,
+                'states_per_sec': self.states_received / elapsed,
+                'latency_ms': {'p50': percentile(latencies, 50) * 1000,
+                               'p95': percentile(latencies, 95) * 1000,
+                               'p99': percentile(latencies, 99) * 1000,
+                               'samples': len(latencies)}}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--transport', choices=('memory', 'mqtt'), default='memory',
+                        help='memory runs a GameServer in this process, mqtt talks to a running GameClient through a broker')
+    parser.add_argument('--server-mode', choices=('sync', 'async', 'pool', 'sharded', 'cluster'), default='sync', help='GameServer flavour for the memory transport')
+    parser.add_argument('--workers', type=int, default=None, help='threads for the pool server, worker processes for the sharded server, nodes for the cluster')
+    parser.add_argument('--broker', help='broker address, credentials.env is used when omitted')
+    parser.add_argument('--port', type=int, default=1883)
+    parser.add_argument('--no-tls', action='store_true')
+    parser.add_argument('--username')
+    parser.add_argument('--password')
+    parser.add_argument('--lobbies', type=int, default=50)
+    parser.add_argument('--teams', type=int, default=2)
+    parser.add_argument('--players-per-team', type=int, default=2)
+    parser.add_argument('--rate', type=float, default=0, help='turns per second per lobby, 0 for as fast as possible')
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--policy', choices=('random', 'planner'), default='random')
+    parser.add_argument('--skip', type=float, default=0.0, help='chance a player sits out a turn')
+    parser.add_argument('--tick-ms', type=int, help='memory transport server resolves turns at this fixed interval')
+    parser.add_argument('--move-deadline-ms', type=int, help='memory transport server resolves turns with missing moves after this long')
+    parser.add_argument('--batch', choices=('pipelined', 'combined'), default='pipelined', help='memory transport server publish batching')
+    parser.add_argument('--encoding', choices=('json', 'binary'), default='json', help='memory transport server game_state format')
+    parser.add_argument('--board', metavar='HEIGHTxWIDTH', default='10x10',
+                        help='board size the simulated players plan on, and that the memory transport server uses')
+    parser.add_argument('--map-pool', action='store_true', help='memory transport server starts games on pre-generated maps')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='also write the report to this JSON file')
+    args = parser.parse_args()
+    # Only problems, the report is the output
+    setup_logging('WARNING')
+
+    random.seed(args.seed)
+    height, width = parse_size(args.board)
+    maps = None
+    if args.transport == 'memory':
+        from InputTypes import LobbyConfig
+        from mapPool import MapPool
+        default_config = LobbyConfig(tick_ms=args.tick_ms, move_deadline_ms=args.move_deadline_ms, batch=args.batch,
+                                     encoding=args.encoding, height=height, width=width)
+        if args.map_pool:
+            maps = MapPool([(height, width)], seed=args.seed)
+            # Stock up before the lobbies start, all of them start at once
+            maps.fill()
+        bus = InMemoryBus()
+        if args.server_mode == 'async':
+            from asyncServer import AsyncGameServer
+            AsyncGameServer(bus.connect('GameClient'), default_config=default_config, maps=maps).serve_in_background()
+        elif args.server_mode == 'pool':
+            from workerPool import PooledGameServer
+            PooledGameServer(bus.connect('GameClient'), args.workers, default_config=default_config, maps=maps).start()
+        elif args.server_mode == 'sharded':
+            from shardedServer import ShardedGameServer
+            ShardedGameServer(bus.connect('GameClient'), args.workers, default_config=default_config, maps=maps).start()
+        elif args.server_mode == 'cluster':
+            from clusterServer import ClusterGameServer, node_will
+            for n in range(args.workers or 2):
+                ClusterGameServer(bus.connect(f'GameClient-node{n}', will=node_will(f'node{n}')), f'node{n}', settle=0,
+                                  default_config=default_config, maps=maps).start()
+        else:
+            from GameClient import GameServer
+            GameServer(bus.connect('GameClient'), default_config, maps=maps).start()
+        transport = bus.connect('LoadGenerator')
+    elif args.broker:
+        transport = PahoTransport('LoadGenerator', args.broker, args.port, args.username, args.password, tls=not args.no_tls)
+    else:
+        transport = PahoTransport.from_env('LoadGenerator')
+
+    generator = LoadGenerator(transport, args.lobbies, args.teams, args.players_per_team, args.rate, args.policy,
+                              board=(height, width), seed=args.seed, skip=args.skip)
+    report = generator.run(args.duration)
+    if maps is not None and args.server_mode != 'sharded':
+        # Sharded workers fill pools of their own in their processes
+        report['map_pool'] = maps.stats()
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    transport.disconnect()
@@ -2,12 +2,21 @@
 Author: Charles Lee
 """
 
-from copy import deepcopy
+from __future__ import annotations
+from array import array
 from player import Player
+from team import Team
 import random
 from gameItems import *
 from typing import Optional
 
+# Shared stateless items handed out by Map.get, indexed by cell code
+CELL_ITEMS = (None, Wall(), Coin1(), Coin2(), Coin3())
+CELL_NAMES = ('None', 'Wall', 'Coin1', 'Coin2', 'Coin3')
+ITEM_KINDS = (WALL, COIN1, COIN2, COIN3)
+ITEM_CODES = {type(None): EMPTY, Wall: WALL, Coin1: COIN1, Coin2: COIN2, Coin3: COIN3}
+
+
 def getDefaultWallChoices():
     wall = []
     for row in range(1,9):
@@ -20,24 +29,87 @@ def getDefaultWallChoices():
     return wall
 
 
+class FreeCells:
+    """
+    Set of empty cell indices supporting O(1) removal and uniform random draws.
+    Cells live in a dense array, with a position map so any cell can be swapped with the last one and dropped.
+    """
+    def __init__(self, size: int):
+        self.__cells = array('i', range(size))
+        self.__pos = array('i', range(size))
+        self.__size = size
+
+    def __len__(self):
+        return self.__size
+
+    def __contains__(self, i: int):
+        k = self.__pos[i]
+        return k < self.__size and self.__cells[k] == i
+
+    def add(self, i: int):
+        self.__cells[self.__size] = i
+        self.__pos[i] = self.__size
+        self.__size += 1
+
+    def remove(self, i: int):
+        k = self.__pos[i]
+        last = self.__cells[self.__size - 1]
+        self.__cells[k] = last
+        self.__pos[last] = k
+        self.__size -= 1
+
+    def popRandom(self, rng=random) -> int:
+        i = self.__cells[rng.randrange(self.__size)]
+        self.remove(i)
+        return i
+
+
 class Map:
     COIN_MIN_RATIO = 0.1
     COIN_MAX_RATIO = 0.2
     WALL_MIN_RATIO = 0.1
     WALL_MAX_RATIO = 0.3
+    TILE_SIZE = 8
+    # Costs that decide between scanning and sweeping a window, in the time a scan takes to read an empty cell.
+    # Fitted on boards from 10x10 to 2000x2000 with 0.5% to 40% of the cells occupied, see benchmark.py
+    SCAN_ROW_COST = 9.0 # Slicing one row of a window
+    SCAN_HIT_COST = 4.5 # Reporting one occupied cell found by the scan
+    SWEEP_PROBE_COST = 4.75 # Looking up one tile in the index of one item code or team
+    SWEEP_HIT_COST = 9.5 # Testing one occupied cell of a tile against a window and reporting it
 
-    def __init__(self, height: int, width: int, playersList: list[Player], wallChoices: list[tuple[int]] = None):
+    def __init__(self, height: int, width: int, playersList: list[Player], wallChoices: list[tuple[int]] = None,
+                 cells: bytes = None, rng: random.Random = None):
+        """
+        :param cells: cell codes of an existing map in row-major order, e.g. from Map.cells,
+                      placed instead of a random fill. Players must already have their loc set
+        :param rng: source of the random fill and of placePlayers, the random module by default
+        """
         assert isinstance(width, int) and isinstance(height, int)
         assert isinstance(playersList, list)
         self.__height = height
         self.__width = width
-        self.__map: list[list[object]] = [[None for _ in range(width)] for _ in range(height)]
+        self.__rng = random if rng is None else rng
+        # One cell code per cell in row-major order, players are kept in a separate layer keyed by cell index
+        self.__cells = bytearray(height * width)
+        self.__players: dict[int, Player] = {}
+
+        # Spatial index of occupied cells, bucketed by tile: {tile: {cell index, ...}}
+        # Items are indexed per cell code and players per team, so queries never visit empty cells
+        self.__tilesPerRow = (width + Map.TILE_SIZE - 1) // Map.TILE_SIZE
+        self.__itemTiles: list[dict[int, set[int]]] = [{} for _ in range(PLAYER)]
+        self.__playerTiles: dict[Team, dict[int, set[int]]] = {}
+        self.__occupied = 0 # Cells that are not EMPTY
+        # Empty cells of a layout made without players, kept for placePlayers and dropped once it has run
+        self.__free: Optional[FreeCells] = None
 
         self.__numCoins = 0
 
         self.wallChoices = getDefaultWallChoices() if wallChoices is None else wallChoices
 
-        self.__fillMap(playersList)
+        if cells is None:
+            self.__fillMap(playersList)
+        else:
+            self.__restore(cells, playersList)
 
 
     @property
@@ -48,8 +120,18 @@ class Map:
         self.__numCoins -= 1
 
     @property
-    def map(self):
-        return deepcopy(self.__map)
+    def map(self) -> memoryview:
+        """
+        Read-only (height, width) view of the cell codes, indexed as map[x, y]
+        """
+        return memoryview(self.__cells).toreadonly().cast('B', (self.__height, self.__width))
+
+    @property
+    def cells(self) -> bytes:
+        """
+        Copy of the cell codes in row-major order
+        """
+        return bytes(self.__cells)
 
     @property
     def height(self):
@@ -61,15 +143,14 @@ class Map:
 
     def __repr__(self):
         result = []
-        for row in self.__map:
+        for x in range(self.__height):
             row_str = []
-            for cell in row:
-                if cell is None:
-                    cellName = 'None'
-                elif isinstance(cell, Player):
-                    cellName = cell.name
+            for i in range(x * self.__width, (x + 1) * self.__width):
+                code = self.__cells[i]
+                if code == PLAYER:
+                    cellName = self.__players[i].name
                 else:
-                    cellName = cell.__class__.__name__
+                    cellName = CELL_NAMES[code]
                 row_str.append(cellName)
             result.append('\t'.join(row_str))
 
@@ -79,51 +160,259 @@ class Map:
 
     def set(self, loc: tuple[int, int], item: object):
         assert isinstance(loc, tuple) and len(loc) == 2 and isinstance(loc[0], int) and isinstance(loc[1], int)
-        self.__map[loc[0]][loc[1]] = item
+        i = loc[0] * self.__width + loc[1]
+        if isinstance(item, Player):
+            self.__put(i, PLAYER, item)
+        else:
+            self.__put(i, ITEM_CODES[type(item)])
 
     def get(self, loc: tuple[int, int]):
         assert isinstance(loc, tuple) and len(loc) == 2 and isinstance(loc[0], int) and isinstance(loc[1], int)
-        return self.__map[loc[0]][loc[1]]
+        i = loc[0] * self.__width + loc[1]
+        code = self.__cells[i]
+        if code == PLAYER:
+            return self.__players[i]
+        return CELL_ITEMS[code]
+
+    def getCode(self, loc: tuple[int, int]) -> int:
+        """
+        Cell code at loc without materializing an item object
+        """
+        return self.__cells[loc[0] * self.__width + loc[1]]
+
+    def findItems(self, code: int, minX: int, maxX: int, minY: int, maxY: int) -> list[tuple[int, int]]:
+        """
+        Locations holding the given item code inside the inclusive window, in row-major order
+        """
+        return self.findInWindows([(minX, maxX, minY, maxY)])[0][0][code]
+
+    def findPlayers(self, minX: int, maxX: int, minY: int, maxY: int) -> dict[Team, list[Player]]:
+        """
+        Players inside the inclusive window grouped by team, each list in row-major order
+        """
+        return self.findInWindows([(minX, maxX, minY, maxY)])[0][1]
+
+    def findInWindows(self, windows: list[tuple[int, int, int, int]]) -> list[tuple[dict[int, list[tuple[int, int]]], dict[Team, list[Player]]]]:
+        """
+        Runs many window queries. Each window is either scanned cell by cell or left to one shared sweep that
+        reads every tile under the swept windows once and hands each occupied cell in it to the windows that
+        contain it, whichever costs less for that window: small windows and full tiles favour the scan, large
+        windows over sparse tiles the sweep.
+        :param windows: inclusive (minX, maxX, minY, maxY) boxes
+        :return: for each window, ({item code: [(x,y),...]}, {team: [player,...]}) in row-major order
+        """
+        T = Map.TILE_SIZE
+        # The scan reads every cell of a window, the sweep every occupied cell of the tiles it overlaps
+        fill = self.__occupied / (self.__height * self.__width)
+        cellCost = 1 + Map.SCAN_HIT_COST * fill
+        tileCost = Map.SWEEP_PROBE_COST * (len(ITEM_KINDS) + len(self.__playerTiles)) + \
+                   Map.SWEEP_HIT_COST * fill * min(T * T, self.__height * self.__width)
+        scanned, swept = [], []
+        for window in windows:
+            minX, maxX, minY, maxY = window
+            rows = maxX - minX + 1
+            tiles = (maxX // T - minX // T + 1) * (maxY // T - minY // T + 1)
+            if tiles * tileCost < rows * ((maxY - minY + 1) * cellCost + Map.SCAN_ROW_COST):
+                swept.append(window)
+                scanned.append(None)
+            else:
+                scanned.append(window)
+        results = self.__scanWindows(scanned)
+        if swept:
+            sweptResults = iter(self.__sweepWindows(swept))
+            results = [next(sweptResults) if window is None else result for window, result in zip(scanned, results)]
+        return results
+
+    def __sweepWindows(self, windows: list[tuple[int, int, int, int]]) -> list[tuple[dict[int, list[tuple[int, int]]], dict[Team, list[Player]]]]:
+        T = Map.TILE_SIZE
+        # {tile: [(window, tile lies fully inside window), ...]}
+        tileWindows: dict[int, list[tuple[int, bool]]] = {}
+        for w, (minX, maxX, minY, maxY) in enumerate(windows):
+            for tileX in range(minX // T, maxX // T + 1):
+                rowStart = tileX * self.__tilesPerRow
+                insideX = minX <= tileX * T and (tileX + 1) * T - 1 <= maxX
+                for tileY in range(minY // T, maxY // T + 1):
+                    inside = insideX and minY <= tileY * T and (tileY + 1) * T - 1 <= maxY
+                    tileWindows.setdefault(rowStart + tileY, []).append((w, inside))
+
+        items = [{code: [] for code in ITEM_KINDS} for _ in windows]
+        players = [{} for _ in windows]
+        for code in ITEM_KINDS:
+            self.__sweep(self.__itemTiles[code], tileWindows, windows, [found[code] for found in items])
+        for team, tiles in self.__playerTiles.items():
+            found = [[] for _ in windows]
+            self.__sweep(tiles, tileWindows, windows, found)
+            for w, cells in enumerate(found):
+                if cells:
+                    players[w][team] = [self.__players[i] for i in sorted(cells)]
+
+        width = self.__width
+        for found in items:
+            for code, cells in found.items():
+                cells.sort()
+                found[code] = [divmod(i, width) for i in cells]
+        return list(zip(items, players))
+
+    def __scanWindows(self, windows: list[Optional[tuple[int, int, int, int]]]) -> list[Optional[tuple[dict[int, list[tuple[int, int]]], dict[Team, list[Player]]]]]:
+        # Reads each window's cells directly, one row slice at a time, None windows are left to the sweep
+        cells = self.__cells
+        width = self.__width
+        playerLayer = self.__players
+        results = []
+        for window in windows:
+            if window is None:
+                results.append(None)
+                continue
+            minX, maxX, minY, maxY = window
+            items = {code: [] for code in ITEM_KINDS}
+            players = {}
+            for x in range(minX, maxX + 1):
+                row = x * width
+                for y, code in enumerate(cells[row + minY:row + maxY + 1], minY):
+                    if code == EMPTY:
+                        continue
+                    if code == PLAYER:
+                        player = playerLayer[row + y]
+                        players.setdefault(player.team, []).append(player)
+                    else:
+                        items[code].append((x, y))
+            results.append((items, players))
+        return results
+
+    def __sweep(self, tiles: dict[int, set[int]], tileWindows: dict[int, list[tuple[int, bool]]],
+                windows: list[tuple[int, int, int, int]], found: list[list[int]]):
+        if not tiles:
+            return
+        width = self.__width
+        for tile, overlapping in tileWindows.items():
+            bucket = tiles.get(tile)
+            if bucket is None:
+                continue
+            for w, inside in overlapping:
+                if inside:
+                    found[w].extend(bucket)
+                    continue
+                minX, maxX, minY, maxY = windows[w]
+                for i in bucket:
+                    x, y = divmod(i, width)
+                    if minX <= x <= maxX and minY <= y <= maxY:
+                        found[w].append(i)
+
+    def placePlayers(self, players: list[Player]):
+        """
+        Puts players on random empty cells of a layout made ahead of time with no players
+        """
+        assert self.__free is not None, 'players can only be placed on a layout made without players'
+        free, self.__free = self.__free, None
+        assert len(free) >= len(players), 'not enough empty cells for the players'
+        for player in players:
+            player.loc = self.__placeRandom(player, free)
+
+    def __tileOf(self, i: int) -> int:
+        x, y = divmod(i, self.__width)
+        return (x // Map.TILE_SIZE) * self.__tilesPerRow + y // Map.TILE_SIZE
+
+    def __put(self, i: int, code: int, player: Optional[Player] = None):
+        """
+        Writes a cell and keeps the player layer and the spatial index in step with it
+        """
+        tile = self.__tileOf(i)
+        old = self.__cells[i]
+        if old == PLAYER:
+            tiles = self.__playerTiles[self.__players.pop(i).team]
+        elif old != EMPTY:
+            tiles = self.__itemTiles[old]
+        else:
+            tiles = None
+        if tiles is not None:
+            self.__occupied -= 1
+            bucket = tiles[tile]
+            bucket.discard(i)
+            if not bucket:
+                del tiles[tile]
+            if self.__free is not None and code == EMPTY:
+                self.__free.add(i)
+        elif self.__free is not None and code != EMPTY:
+            self.__free.remove(i)
+
+        self.__cells[i] = code
+        if code == PLAYER:
+            self.__players[i] = player
+            tiles = self.__playerTiles.setdefault(player.team, {})
+        elif code != EMPTY:
+            tiles = self.__itemTiles[code]
+        else:
+            return
+        self.__occupied += 1
+        tiles.setdefault(tile, set()).add(i)
 
     def __fillMap(self, players: list[Player]):
         assert isinstance(players, list)
 
         empty = self.__width*self.__height
 
+        # Duplicate choices would let numWalls exceed the number of distinct wall cells
+        wallChoices = None if self.wallChoices is None else list(dict.fromkeys(self.wallChoices))
+
         maxWalls = int(Map.WALL_MAX_RATIO * empty)
-        maxWalls = maxWalls if self.wallChoices is None else len(self.wallChoices)
+        maxWalls = maxWalls if wallChoices is None else len(wallChoices)
 
         minWalls = int(Map.WALL_MIN_RATIO * empty)
         minWalls = 0 if maxWalls < minWalls else minWalls
 
-        numWalls = random.randint(minWalls, maxWalls)
-        wallChoices = deepcopy(self.wallChoices)
+        numWalls = self.__rng.randint(minWalls, maxWalls)
+        free = FreeCells(empty)
         for _ in range(numWalls):
-            self.__placeRandom(Wall(), wallChoices)
+            self.__placeRandom(WALL, free, wallChoices)
 
         # Fill players
         for player in players:
-            player.loc = self.__placeRandom(player)
+            player.loc = self.__placeRandom(player, free)
 
         numPlayers = len(players)
         empty = empty - numWalls - numPlayers
 
-        self.__numCoins = random.randint(int(Map.COIN_MIN_RATIO * empty), int(Map.COIN_MAX_RATIO * empty))
-        for _ in range(self.__numCoins):
-            coin = random.choices((Coin1, Coin2, Coin3), (6,3,1))[0]()
-            self.__placeRandom(coin)
+        self.__numCoins = self.__rng.randint(int(Map.COIN_MIN_RATIO * empty), int(Map.COIN_MAX_RATIO * empty))
+        for coin in self.__rng.choices((COIN1, COIN2, COIN3), (6,3,1), k=self.__numCoins):
+            self.__placeRandom(coin, free)
+        if not players:
+            self.__free = free
 
-    def __placeRandom(self, obj, choice: Optional[list] = None):
-        while True:
-            if choice is None:
-                x, y = random.randint(0, self.__height - 1), random.randint(0, self.__width - 1)
-            else:
-                x, y = random.choice(choice)
-                choice.remove((x,y))
-            if self.__map[x][y] is None:
-                self.__map[x][y] = obj
-                return x, y
+    def __restore(self, cells: bytes, players: list[Player]):
+        assert len(cells) == self.__width * self.__height
+        playersAt = {player.loc[0] * self.__width + player.loc[1]: player for player in players}
+        assert cells.count(PLAYER) == len(playersAt) == len(players), 'players must stand on the PLAYER cells'
+        for i, code in enumerate(cells):
+            if code == PLAYER:
+                self.__put(i, PLAYER, playersAt[i])
+            elif code != EMPTY:
+                self.__put(i, code)
+        self.__numCoins = sum(cells.count(code) for code in COIN_VALUES)
+
+    def __placeRandom(self, obj, free: FreeCells, choice: Optional[list] = None):
+        """
+        :param obj: a cell code or a Player
+        :param free: index of the cells that are still empty
+        :param choice: candidate locations, consumed as they are drawn
+        """
+        if choice is None:
+            i = free.popRandom(self.__rng)
+        else:
+            while True:
+                # Swap the drawn location to the end so it can be dropped in O(1)
+                k = self.__rng.randrange(len(choice))
+                choice[k], choice[-1] = choice[-1], choice[k]
+                x, y = choice.pop()
+                i = x * self.__width + y
+                if i in free:
+                    free.remove(i)
+                    break
 
+        if isinstance(obj, Player):
+            self.__put(i, PLAYER, obj)
+        else:
+            self.__put(i, obj)
+        return divmod(i, self.__width)
 
 if __name__ == '__main__':
     m = Map(10, 10, [Player('Charles', None), Player('James', None)])
@@ -0,0 +1,104 @@
+"""
+Maps generated ahead of time, so starting a game does not wait on Map.__fillMap.
+
+A background thread keeps a stock of seeded layouts, maps with their walls, coins and spatial index in place
+but no players, for each configured board size. start_game takes a layout and places the players on it.
+A START for a size the pool does not hold, or that finds the stock empty, builds its map inline as before.
+"""
+
+from __future__ import annotations
+
+import random
+import threading
+from collections import deque
+
+from map import Map
+
+
+def parse_size(text: str) -> tuple[int, int]:
+    """
+    :param text: 'HEIGHTxWIDTH', e.g. '10x10'
+    """
+    height, width = text.lower().split('x')
+    return int(height), int(width)
+
+
+class MapPool:
+    def __init__(self, sizes: list[tuple[int, int]] = ((10, 10),), depth: int = 8, refill_rate: float = 50.0,
+                 seed: int = None):
+        """
+        :param sizes: (height, width) of the boards to keep layouts for
+        :param depth: layouts kept ready per size
+        :param refill_rate: most layouts generated per second, generation shares the interpreter with the games
+        :param seed: seeds the layouts, the same seed and sizes give the same layouts in the same order
+        """
+        assert depth > 0 and refill_rate > 0
+        self.depth = depth
+        self.refill_rate = refill_rate
+        self.__rng = random.Random(seed)
+        self.__lock = threading.Lock()
+        self.sizes = [tuple(size) for size in sizes]
+        self.__stock: dict[tuple[int, int], deque] = {size: deque() for size in self.sizes}
+        self.hits = 0
+        self.misses = 0
+        self.generated = 0
+        self.__wake = threading.Event()
+        self.__stopped = threading.Event()
+        self.__thread: threading.Thread = None
+
+    def start(self):
+        if self.__thread is None:
+            self.__thread = threading.Thread(target=self.__run, name='MapPool', daemon=True)
+            self.__thread.start()
+
+    def stop(self):
+        self.__stopped.set()
+        self.__wake.set()
+
+    def take(self, height: int, width: int) -> Map | None:
+        """
+        :return: a layout with no players for Game(layout=...), None when there is none ready
+        """
+        stock = self.__stock.get((height, width))
+        with self.__lock:
+            if not stock:
+                self.misses += 1
+                return None
+            self.hits += 1
+            layout = stock.popleft()
+        self.__wake.set()
+        return layout
+
+    def fill(self):
+        """
+        Generates layouts until every size is stocked, on the calling thread
+        """
+        while self.__generate():
+            pass
+
+    def stats(self) -> dict:
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'generated': self.generated,
+                'stock': {f'{height}x{width}': len(stock) for (height, width), stock in self.__stock.items()}}
+
+    def __generate(self) -> bool:
+        # The emptiest size first, so one popular size cannot starve the others
+        size, stock = min(self.__stock.items(), key=lambda item: len(item[1]))
+        if len(stock) >= self.depth:
+            return False
+        # Every layout gets its own rng, placePlayers keeps drawing from it on the thread that starts the game
+        layout = Map(*size, [], rng=random.Random(self.__rng.getrandbits(64)))
+        with self.__lock:
+            stock.append(layout)
+            self.generated += 1
+        return True
+
+    def __run(self):
+        while not self.__stopped.is_set():
+            if self.__generate():
+                self.__stopped.wait(1 / self.refill_rate)
+            else:
+                # Stocked up, sleep until take() uses a layout
+                self.__wake.wait()
+                self.__wake.clear()
@@ -0,0 +1,213 @@
+"""
+Metrics of a game server: counters and fixed-bucket histograms recorded where the work happens, and gauges
+read from the server when the metrics are collected.
+
+Recording takes no lock, an observation is a bisect and two additions. Under the GIL an update is only lost
+when a thread switch lands inside it, and only pool mode records from several threads at once, so the odd lost
+count is the price of keeping the hot path cheap. Every message is counted and every turn is timed, while the
+dispatch of a message and the phases of a turn (getAllGameData, encoding, publish) are timed for one message and
+one tick in sample_every, as every clock read shows at tens of thousands of messages a second.
+
+Every metrics interval the server takes a sample, which turns what happened since the previous sample into
+rates and percentiles, and publishes it as JSON on games/$sys/metrics. With --metrics-port the same metrics
+are served in the Prometheus text format.
+
+    python GameClient.py --metrics-port 9100 --metrics-interval 10
+    curl localhost:9100/metrics
+"""
+
+from __future__ import annotations
+
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Seconds, from a fast dispatch up to a turn that stalls the lobby
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+class Counter:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, n: int = 1):
+        self.value += n
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets: tuple = LATENCY_BUCKETS):
+        """
+        :param buckets: upper bounds of the buckets in increasing order, a last bucket catches everything above
+        """
+        assert list(buckets) == sorted(buckets)
+        self.name = name
+        self.help = help
+        self.bounds = tuple(buckets)
+        self.counts = [0] * (len(self.bounds) + 1) # The last bucket counts the values above the last bound
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        # Buckets are inclusive of their upper bound, as in Prometheus
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def totals(self) -> tuple[list[int], float]:
+        """
+        :return: (count of every bucket including the one above the last bound, sum of the values)
+        """
+        return list(self.counts), self.sum
+
+
+def quantile(bounds: tuple, counts: list[int], q: float) -> float | None:
+    """
+    Estimates a quantile from bucket counts by interpolating inside the bucket it falls in, like histogram_quantile
+    :return: None when there are no counts
+    """
+    total = sum(counts)
+    if not total:
+        return None
+    rank = q * total
+    seen = 0
+    for i, count in enumerate(counts):
+        if count and seen + count >= rank:
+            if i == len(bounds):
+                # Above the last bound, which is all that is known about it
+                return bounds[-1]
+            lower = bounds[i - 1] if i > 0 else 0.0
+            return lower + (bounds[i] - lower) * (rank - seen) / count
+        seen += count
+    return bounds[-1]
+
+
+class ServerMetrics:
+    def __init__(self, sample_every: int = 8):
+        """
+        What a GameServer records while it runs, the gauges are read from the server on every sample and scrape
+        :param sample_every: messages between timed dispatches, and ticks between timed phases of a lobby's turn
+        """
+        assert sample_every > 0
+        self.sample_every = sample_every
+        self.dispatch = Histogram('gameclient_dispatch_seconds', 'Time to handle a sampled message in on_message')
+        self.turn = Histogram('gameclient_turn_seconds', 'Time to resolve a turn and send its states and scores')
+        self.game_data = Histogram('gameclient_game_data_seconds', 'Time in getAllGameData of a sampled turn')
+        self.encode = Histogram('gameclient_encode_seconds', 'Time encoding the states and scores of a sampled turn')
+        self.publish = Histogram('gameclient_publish_seconds', 'Time handing the messages of a sampled turn to the transport')
+        self.messages_in = Counter('gameclient_messages_in_total', 'Messages handled')
+        self.messages_out = Counter('gameclient_messages_out_total', 'Messages published')
+        self.histograms = (self.dispatch, self.turn, self.game_data, self.encode, self.publish)
+        self.started = time.monotonic()
+        self.last_sample: dict = {}
+        self.__window = (self.started, {histogram.name: histogram.totals()[0] for histogram in self.histograms}, 0, 0)
+
+    def gauges(self, server) -> dict[str, tuple[str, float]]:
+        """
+        :return: {name: (help, value)} read from the server now
+        """
+        lobbies = server.lobbies.stats()
+        gauges = {'gameclient_lobbies': ('Lobbies held', lobbies['lobbies']),
+                  'gameclient_lobbies_running': ('Lobbies with a game running', lobbies['running']),
+                  'gameclient_players': ('Players in all lobbies', lobbies['players']),
+                  'gameclient_lobby_bytes': ('Estimated memory held by lobby state', lobbies['approx_bytes']),
+                  'gameclient_lobbies_evicted_total': ('Lobbies closed for being idle', lobbies['evicted']),
+                  'gameclient_lobbies_rejected_total': ('Lobbies refused because the server was full', lobbies['rejected'])}
+        for queue_name, depth in server.queue_depths().items():
+            gauges[f'gameclient_queue_depth_{queue_name}'] = (f'Work waiting, {queue_name}', depth)
+        if server.maps is not None:
+            maps = server.maps.stats()
+            gauges['gameclient_map_pool_hits_total'] = ('Games started on a pre-generated map', maps['hits'])
+            gauges['gameclient_map_pool_misses_total'] = ('Games that found no map ready and generated their own', maps['misses'])
+            gauges['gameclient_map_pool_generated_total'] = ('Maps generated by the pool', maps['generated'])
+            for size, stock in maps['stock'].items():
+                gauges[f'gameclient_map_pool_stock_{size}'] = (f'Maps ready, {size}', stock)
+        return gauges
+
+    def sample(self, server) -> dict:
+        """
+        Rates and percentiles since the previous sample, plus the gauges.
+        Also kept as last_sample, which the Prometheus endpoint serves between samples
+        """
+        now = time.monotonic()
+        then, previous, previous_in, previous_out = self.__window
+        seconds = max(now - then, 1e-9)
+        latency = {}
+        totals = {}
+        for histogram in self.histograms:
+            counts = totals[histogram.name] = histogram.totals()[0]
+            window = [count - before for count, before in zip(counts, previous[histogram.name])]
+            p50, p99 = quantile(histogram.bounds, window, 0.5), quantile(histogram.bounds, window, 0.99)
+            latency[histogram.name[len('gameclient_'):-len('_seconds')]] = {
+                'count': sum(window),
+                'p50': p50 * 1000 if p50 is not None else None,
+                'p99': p99 * 1000 if p99 is not None else None}
+        messages_in, messages_out = self.messages_in.value, self.messages_out.value
+        self.__window = (now, totals, messages_in, messages_out)
+        self.last_sample = {'uptime': now - self.started,
+                            'window': seconds,
+                            'messages_in_per_sec': (messages_in - previous_in) / seconds,
+                            'messages_out_per_sec': (messages_out - previous_out) / seconds,
+                            **{name[len('gameclient_'):]: value for name, (_, value) in self.gauges(server).items()},
+                            'latency_ms': latency}
+        return self.last_sample
+
+    def prometheus(self, server) -> str:
+        """
+        Every metric in the Prometheus text exposition format
+        """
+        lines = []
+        for histogram in self.histograms:
+            counts, total = histogram.totals()
+            lines += [f'# HELP {histogram.name} {histogram.help}', f'# TYPE {histogram.name} histogram']
+            cumulative = 0
+            for bound, count in zip(histogram.bounds + ('+Inf',), counts):
+                cumulative += count
+                lines.append(f'{histogram.name}_bucket{{le="{bound}"}} {cumulative}')
+            lines += [f'{histogram.name}_sum {total}', f'{histogram.name}_count {cumulative}']
+        for counter in (self.messages_in, self.messages_out):
+            lines += [f'# HELP {counter.name} {counter.help}', f'# TYPE {counter.name} counter', f'{counter.name} {counter.value}']
+        gauges = self.gauges(server)
+        # Windowed values of the last sample, rate() and histogram_quantile() give the same over any range
+        sample = self.last_sample
+        for key, help in (('messages_in_per_sec', 'Messages handled per second over the last metrics interval'),
+                          ('messages_out_per_sec', 'Messages published per second over the last metrics interval')):
+            if key in sample:
+                gauges[f'gameclient_{key}'] = (help, sample[key])
+        for name, window in sample.get('latency_ms', {}).items():
+            if window['p99'] is not None:
+                gauges[f'gameclient_{name}_p99_seconds'] = (f'99th percentile of gameclient_{name}_seconds over the last metrics interval',
+                                                           window['p99'] / 1000)
+        for name, (help, value) in gauges.items():
+            # Totals the server keeps itself only ever grow, so they are counters to Prometheus
+            kind = 'counter' if name.endswith('_total') else 'gauge'
+            lines += [f'# HELP {name} {help}', f'# TYPE {name} {kind}', f'{name} {value}']
+        return '\n'.join(lines) + '\n'
+
+
+def serve_metrics(server, port: int, host: str = '127.0.0.1') -> ThreadingHTTPServer:
+    """
+    Serves server.metrics at http://host:port/metrics on a daemon thread
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = server.metrics.prometheus(server).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # Scrapes every few seconds would flood the log
+            pass
+
+    http_server = ThreadingHTTPServer((host, port), Handler)
+    http_server.daemon_threads = True
+    threading.Thread(target=http_server.serve_forever, name='MetricsHTTP', daemon=True).start()
+    return http_server
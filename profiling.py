@@ -0,0 +1,265 @@
+"""
+Profiling of a running game server, switched on for a bounded window by a message on its admin topic.
+
+A server started with --profile-dir subscribes to games/$sys/admin/profile (games/$sys/admin/<node_id>/profile
+in cluster mode) and takes requests like
+
+    {"kind": "cprofile", "seconds": 10, "lobby": "lobby1", "token": "..."}
+
+that carry the token it was started with, --profile-token or PROFILE_TOKEN, and refuses the others.
+cprofile traces the lobby work, sample traces one message or turn deadline in sample_every, which
+costs that much less under load, and memory diffs two tracemalloc snapshots taken at the start and the end of
+the window. The CPU kinds cover the handling of messages and turn deadlines, of one lobby when the request
+names it and of every lobby otherwise, tracemalloc always traces the whole process. The interpreter has a
+single profiling hook, so one work item is traced at a time, and work that runs alongside it on the other
+threads of the async and pool modes is counted but not traced.
+A thread reading stacks every few milliseconds would cost less still, but under the GIL it only gets to run
+when the thread it samples waits on the network, between messages rather than in them.
+One capture runs at a time, its progress and the files it wrote are published on <admin topic>/status.
+
+The files are named by time and kind, a .txt summary next to a .prof (pstats) or .snap (tracemalloc) file
+that two captures can be compared with:
+
+    python profiling.py request --kind sample --seconds 30 --lobby lobby1
+    python profiling.py compare profiles/20260101-120000-cprofile.prof profiles/20260102-120000-cprofile.prof
+"""
+
+from __future__ import annotations
+
+import argparse
+import cProfile
+import hmac
+import io
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+
+from InputTypes import ProfileRequest
+
+
+TRACEMALLOC_FRAMES = 16 # Frames kept per allocation, enough to see which Game or Map call allocated
+TOP = 40 # Entries in the text summaries
+
+
+class ProfileSession:
+    def __init__(self, request: ProfileRequest, sample_every: int = 10):
+        """
+        One capture, from the request that started it until stop()
+        :param sample_every: work items of the covered lobbies per traced one, for the sample kind
+        """
+        assert sample_every > 0
+        self.kind = request.kind
+        self.lobby = request.lobby
+        self.seconds = request.seconds
+        self.sample_every = sample_every if self.kind == 'sample' else 1
+        self.started = time.time()
+        self.covered = 0 # Work items of the covered lobbies, traced or not
+        self.traced = 0
+        self.__profile = cProfile.Profile()
+        self.__idle = threading.Condition()
+        self.__tracing = False
+        self.__stopped = False
+        self.__snapshot = None
+        self.__started_tracing = False
+        if self.kind == 'memory':
+            self.__started_tracing = not tracemalloc.is_tracing()
+            if self.__started_tracing:
+                tracemalloc.start(TRACEMALLOC_FRAMES)
+            self.__snapshot = tracemalloc.take_snapshot()
+
+    def run(self, lobby_name, fn, *args):
+        """
+        Runs fn(*args) as work of the lobby, profiled if the capture covers the lobby
+        """
+        if self.kind == 'memory' or (self.lobby is not None and lobby_name != self.lobby):
+            return fn(*args)
+        with self.__idle:
+            if self.__stopped:
+                return fn(*args)
+            self.covered += 1
+            # The interpreter has one profiling hook, so one work item is traced at a time, and work that starts
+            # while another is traced, on another thread or nested in it, runs untraced
+            if self.__tracing or self.covered % self.sample_every:
+                return fn(*args)
+            self.__tracing = True
+        try:
+            self.__profile.enable()
+        except ValueError:
+            # Another tool holds the profiling hook, Python 3.12 and later refuse a second one
+            self.__release()
+            return fn(*args)
+        try:
+            return fn(*args)
+        finally:
+            self.__profile.disable()
+            self.__release(traced=True)
+
+    def __release(self, traced: bool = False):
+        with self.__idle:
+            self.__tracing = False
+            self.traced += traced
+            self.__idle.notify_all()
+
+    def stop(self, timeout: float = 5.0):
+        """
+        Stops profiling new work and waits for the work being profiled to finish
+        """
+        with self.__idle:
+            self.__stopped = True
+            self.__idle.wait_for(lambda: not self.__tracing, timeout)
+
+    def write(self, path: str) -> list[str]:
+        """
+        Writes the capture, call stop() first
+        :param path: path of the files without their extension
+        :return: paths of the files written
+        """
+        if self.kind == 'memory':
+            return self.__write_memory(path)
+        return self.__write_cprofile(path)
+
+    def __header(self) -> str:
+        scope = f'lobby {self.lobby}' if self.lobby is not None else 'all lobbies'
+        header = f"{self.kind} of {scope}, {self.seconds:g} s from {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.started))}\n"
+        if self.kind != 'memory':
+            header += f'{self.traced} of {self.covered} messages and turn deadlines traced\n'
+        return header + '\n'
+
+    def __write_cprofile(self, path: str) -> list[str]:
+        if not self.traced:
+            return write_text(f'{path}.txt', self.__header() + 'No lobby work ran during the window\n')
+        stats = pstats.Stats(self.__profile)
+        stats.dump_stats(f'{path}.prof')
+        text = io.StringIO()
+        stats.stream = text
+        stats.sort_stats('cumulative').print_stats(TOP)
+        stats.sort_stats('tottime').print_stats(TOP)
+        return [f'{path}.prof'] + write_text(f'{path}.txt', self.__header() + text.getvalue())
+
+    def __write_memory(self, path: str) -> list[str]:
+        # Leave out what tracemalloc allocated for itself
+        ignore = (tracemalloc.Filter(False, tracemalloc.__file__),)
+        snapshot = tracemalloc.take_snapshot().filter_traces(ignore)
+        if self.__started_tracing:
+            tracemalloc.stop()
+        snapshot.dump(f'{path}.snap')
+        lines = ['Growth over the window', *map(str, snapshot.compare_to(self.__snapshot.filter_traces(ignore), 'lineno')[:TOP]),
+                 '', 'Largest at the end', *map(str, snapshot.statistics('lineno')[:TOP])]
+        return [f'{path}.snap'] + write_text(f'{path}.txt', self.__header() + '\n'.join(lines) + '\n')
+
+
+class Profiler:
+    def __init__(self, token: str, directory: str = 'profiles', sample_every: int = 10):
+        """
+        Starts the captures of a server and writes them to directory
+        :param token: secret a request has to carry, anyone on the broker can publish to the admin topic
+        :param sample_every: work items of the covered lobbies per traced one, for the sample kind
+        """
+        assert token, 'profiling needs a token'
+        self.directory = directory
+        self.sample_every = sample_every
+        self.__token = token
+
+    def authorized(self, request: ProfileRequest) -> bool:
+        return request.token is not None and hmac.compare_digest(request.token.encode(), self.__token.encode())
+
+    def start(self, request: ProfileRequest) -> ProfileSession:
+        return ProfileSession(request, self.sample_every)
+
+    def finish(self, session: ProfileSession) -> list[str]:
+        """
+        Stops the session and writes its files, which can take a while for a large heap
+        :return: paths of the files written
+        """
+        session.stop()
+        os.makedirs(self.directory, exist_ok=True)
+        name = f"{time.strftime('%Y%m%d-%H%M%S', time.localtime(session.started))}-{session.kind}"
+        if session.lobby is not None:
+            name += f'-{session.lobby}'
+        path = os.path.join(self.directory, name)
+        suffix = 1
+        while any(entry.startswith(os.path.basename(path) + '.') for entry in os.listdir(self.directory)):
+            suffix += 1
+            path = os.path.join(self.directory, f'{name}-{suffix}')
+        return session.write(path)
+
+
+def write_text(path: str, text: str) -> list[str]:
+    with open(path, 'w') as file:
+        file.write(text)
+    return [path]
+
+
+def compare(old_path: str, new_path: str, top: int = TOP) -> str:
+    """
+    What changed between two captures of the same kind, by the extension of their files
+    """
+    extension = os.path.splitext(old_path)[1]
+    assert extension == os.path.splitext(new_path)[1], 'compare files of the same kind'
+    lines = []
+    if extension == '.prof':
+        old, new = pstats.Stats(old_path).stats, pstats.Stats(new_path).stats
+        old_total = sum(entry[2] for entry in old.values()) or 1e-9
+        new_total = sum(entry[2] for entry in new.values()) or 1e-9
+        # Windows differ in length, load and kind, so functions are compared by their share of the time
+        shares = {}
+        for function in old.keys() | new.keys():
+            before = old[function][2] / old_total if function in old else 0.0
+            after = new[function][2] / new_total if function in new else 0.0
+            shares[function] = (before, after)
+        lines.append('own time share  before -> after   function')
+        for (filename, line, name), (before, after) in sorted(shares.items(), key=lambda item: -abs(item[1][1] - item[1][0]))[:top]:
+            lines.append(f'{after - before:+8.1%}  {before:7.1%} -> {after:7.1%}  {name} ({os.path.basename(filename)}:{line})')
+    elif extension == '.snap':
+        old, new = tracemalloc.Snapshot.load(old_path), tracemalloc.Snapshot.load(new_path)
+        lines += map(str, new.compare_to(old, 'lineno')[:top])
+    else:
+        raise ValueError(f'cannot compare {extension} files')
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    from transport import PahoTransport
+
+    parser = argparse.ArgumentParser(description='Starts a capture on a running GameClient, or compares two captures')
+    commands = parser.add_subparsers(dest='command', required=True)
+    request_parser = commands.add_parser('request', help='publish a profiling request and wait for its files')
+    request_parser.add_argument('--kind', choices=('cprofile', 'sample', 'memory'), default='sample')
+    request_parser.add_argument('--seconds', type=float, default=10.0)
+    request_parser.add_argument('--lobby', help='profile only the work of this lobby')
+    request_parser.add_argument('--node-id', help='node to profile in cluster mode')
+    request_parser.add_argument('--token', help='token the server was started with, PROFILE_TOKEN by default')
+    compare_parser = commands.add_parser('compare', help='show what changed between two files of the same kind')
+    compare_parser.add_argument('old')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument('--top', type=int, default=TOP)
+    args = parser.parse_args()
+
+    if args.command == 'compare':
+        print(compare(args.old, args.new, args.top))
+        sys.exit()
+
+    # Loads credentials.env, which can hold the PROFILE_TOKEN too
+    transport = PahoTransport.from_env(f'ProfileRequest-{os.getpid()}')
+    request = ProfileRequest(kind=args.kind, seconds=args.seconds, lobby=args.lobby,
+                             token=args.token or os.environ.get('PROFILE_TOKEN'))
+    topic = f'games/$sys/admin/{args.node_id}/profile' if args.node_id else 'games/$sys/admin/profile'
+    done = threading.Event()
+
+    def on_status(client, userdata, msg):
+        status = json.loads(msg.payload)
+        print(json.dumps(status))
+        if status['status'] != 'started':
+            done.set()
+
+    transport.on_message = on_status
+    transport.subscribe(f'{topic}/status', qos=1)
+    transport.loop_start()
+    transport.publish(topic, request.model_dump_json(), qos=1)
+    # The files are written after the window, a large heap snapshot takes a while
+    if not done.wait(request.seconds + 60):
+        sys.exit('No result from the server, is it running with --profile-dir?')
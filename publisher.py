@@ -0,0 +1,76 @@
+"""
+Outbound messages of one lobby turn, collected while the turn resolves and sent together once it is done
+"""
+
+import json
+import time
+
+from wireFormat import encode_tick
+
+
+class TickPublisher:
+    def __init__(self, lobby_name: str, tick: int):
+        """
+        Collects the game states and scores a lobby publishes for one tick
+        """
+        self.lobby_name = lobby_name
+        self.tick = tick
+        self.states: dict[str, dict | bytes] = {}
+        self.scores: dict = None
+        self.encode_seconds: float = None # Spent encoding the states of a timed turn, flush adds the JSON encoding to it
+
+    def add_state(self, player_name: str, game_data):
+        """
+        :param game_data: a game_state dict, or its binary encoding
+        """
+        self.states[player_name] = game_data
+
+    def set_scores(self, scores: dict):
+        self.scores = scores
+
+    def messages(self, batch: str = 'pipelined') -> list[tuple]:
+        """
+        :param batch: 'pipelined' gives the usual game_state and scores messages,
+                      'combined' gives one games/<lobby>/tick message {tick, states: {player: game_state}, scores?}
+                      which every subscriber of the lobby can read, so it suits lobbies that do not rely on fog of war.
+                      Binary states are combined with wireFormat.encode_tick and their scores still go out as JSON
+        :return: (topic, payload, qos, retain) for Transport.publish_many
+        """
+        binary = any(isinstance(game_data, bytes) for game_data in self.states.values())
+        if batch == 'combined' and binary:
+            messages = [(f'games/{self.lobby_name}/tick', encode_tick(self.states), 0, False)]
+        elif batch == 'combined':
+            if not self.states and self.scores is None:
+                return []
+            payload = {'tick': self.tick, 'states': self.states}
+            if self.scores is not None:
+                payload['scores'] = self.scores
+            return [(f'games/{self.lobby_name}/tick', json.dumps(payload), 0, False)]
+        else:
+            messages = [(f'games/{self.lobby_name}/{player_name}/game_state',
+                         game_data if binary else json.dumps(game_data), 0, False)
+                        for player_name, game_data in self.states.items()]
+        if self.scores is not None:
+            messages.append((f'games/{self.lobby_name}/scores', json.dumps(self.scores), 0, False))
+        return messages
+
+    def flush(self, client, batch: str = 'pipelined'):
+        """
+        Hands everything collected to client.publish_many in one call
+        :param client: GameServer, which also gets the encoding and publish times of timed turns in its metrics
+        """
+        if self.encode_seconds is None:
+            messages = self.messages(batch)
+            if messages:
+                client.publish_many(messages)
+        else:
+            start = time.perf_counter()
+            messages = self.messages(batch)
+            encoded = time.perf_counter()
+            client.metrics.encode.observe(self.encode_seconds + encoded - start)
+            if messages:
+                client.publish_many(messages)
+                client.metrics.publish.observe(time.perf_counter() - encoded)
+        self.states = {}
+        self.scores = None
+        self.encode_seconds = None
@@ -0,0 +1,251 @@
+"""
+Recordings of whole games and a replay engine that can jump to any tick of one.
+
+A recording is a header followed by records:
+
+    header      b'GREC', version uint8, keyframe interval uint16
+    keyframe    b'K', tick uint32, length uint32, Game.snapshot() without its cells as JSON,
+                length uint32, the cells compressed with zlib
+    moves       b'M', tick uint32, one nibble per player in keyframe order, 0 for no move or 1 + the Moveset index
+    end         b'E', tick uint32, length uint32, Game.getScores() as JSON
+
+The moves record of tick t holds the moves applied while game.tick was t. A keyframe is written every
+keyframe interval ticks, so seeking rebuilds the nearest keyframe before the tick and applies at most
+interval - 1 turns of moves. A recording cut short by a crash stays readable up to its last whole record.
+
+    python replay.py recordings/MyLobby-20240101-120000.rec --tick 40
+    python replay.py recordings/MyLobby-20240101-120000.rec --verify
+"""
+
+from __future__ import annotations
+
+import argparse
+import bisect
+import json
+import os
+import struct
+import time
+import zlib
+
+from game import Game
+from moveset import Moveset
+
+
+MAGIC = b'GREC'
+VERSION = 1
+HEADER = struct.Struct('<4sBH')
+RECORD = struct.Struct('<cI')
+LENGTH = struct.Struct('<I')
+KEYFRAME, MOVES, END = b'K', b'M', b'E'
+
+MOVES_ORDER = tuple(Moveset)
+MOVE_CODES = {move: code + 1 for code, move in enumerate(MOVES_ORDER)}
+
+
+def recording_path(directory: str, lobby_name: str) -> str:
+    # NewPlayer keeps path separators out of lobby names, and the suffix turns '..' into a plain file name
+    return os.path.join(directory, f"{lobby_name}-{time.strftime('%Y%m%d-%H%M%S')}.rec")
+
+
+def encode_keyframe(game: Game) -> bytes:
+    snapshot = game.snapshot()
+    cells = snapshot.pop('cells')
+    meta = json.dumps(snapshot, separators=(',', ':')).encode()
+    # Most cells are empty, so even the fastest level shrinks the grid several times over
+    cells = zlib.compress(cells, 1)
+    return RECORD.pack(KEYFRAME, game.tick) + LENGTH.pack(len(meta)) + meta + LENGTH.pack(len(cells)) + cells
+
+
+def encode_moves(tick: int, moves: dict[str, Moveset], player_index: dict[str, int]) -> bytes:
+    packed = bytearray((len(player_index) + 1) // 2)
+    for player_name, move in moves.items():
+        i = player_index[player_name]
+        packed[i // 2] |= MOVE_CODES[move] << (4 * (i % 2))
+    return RECORD.pack(MOVES, tick) + packed
+
+
+class GameRecorder:
+    def __init__(self, path: str, game: Game, keyframe_interval: int = 50):
+        """
+        Starts a recording of game from its current tick
+        :param keyframe_interval: ticks between keyframes, a seek applies at most this many turns
+        """
+        assert 0 < keyframe_interval < 65536
+        self.path = path
+        self.keyframe_interval = keyframe_interval
+        self.player_index = {player_name: i for i, player_name in enumerate(game.all_players)}
+        self.__file = open(path, 'wb')
+        self.__file.write(HEADER.pack(MAGIC, VERSION, keyframe_interval))
+        self.__file.write(encode_keyframe(game))
+        self.__file.flush()
+
+    def record(self, game: Game, moves: dict[str, Moveset]):
+        """
+        Call after game.applyMoves(moves)
+        """
+        self.__file.write(encode_moves(game.tick - 1, moves, self.player_index))
+        if game.tick % self.keyframe_interval == 0:
+            self.__file.write(encode_keyframe(game))
+        # Every tick reaches the file, so a live recording or one cut short by a crash replays up to its last turn
+        self.__file.flush()
+
+    def close(self, game: Game = None):
+        """
+        :param game: the finished game, its scores end the recording
+        """
+        if self.__file.closed:
+            return
+        if game is not None:
+            scores = json.dumps(game.getScores()).encode()
+            self.__file.write(RECORD.pack(END, game.tick) + LENGTH.pack(len(scores)) + scores)
+        self.__file.close()
+
+
+class Replay:
+    def __init__(self, data: bytes):
+        """
+        Indexes a recording, use Replay.open for files
+        """
+        if len(data) < HEADER.size:
+            raise ValueError('recording is shorter than its header')
+        magic, version, self.keyframe_interval = HEADER.unpack_from(data)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('not a game recording')
+        self.data = data
+        self.keyframe_ticks: list[int] = []
+        self.keyframe_offsets: list[int] = []
+        self.move_offsets: dict[int, int] = {} # Offset of each tick's packed moves
+        self.scores: dict = None # Final scores, None if the recording did not end with the game
+        self.players: list[str] = None
+
+        offset = HEADER.size
+        while offset + RECORD.size <= len(data):
+            kind, tick = RECORD.unpack_from(data, offset)
+            start = offset + RECORD.size
+            if kind == MOVES and self.players is not None:
+                end = start + (len(self.players) + 1) // 2
+            elif kind in (KEYFRAME, END) and start + LENGTH.size <= len(data):
+                (length,) = LENGTH.unpack_from(data, start)
+                end = start + LENGTH.size + length
+                if kind == KEYFRAME:
+                    # A keyframe holds a second length, of its cells
+                    if end + LENGTH.size > len(data):
+                        break
+                    if self.players is None:
+                        meta = json.loads(data[start + LENGTH.size:end])
+                        self.players = [player_name for team in meta['teams'].values() for player_name in team['players']]
+                    (length,) = LENGTH.unpack_from(data, end)
+                    end += LENGTH.size + length
+            else:
+                break
+            if end > len(data):
+                break
+            if kind == KEYFRAME:
+                self.keyframe_ticks.append(tick)
+                self.keyframe_offsets.append(offset)
+            elif kind == MOVES:
+                self.move_offsets[tick] = start
+            else:
+                self.scores = json.loads(data[start + LENGTH.size:end])
+            offset = end
+        if not self.keyframe_ticks:
+            raise ValueError('recording has no keyframe')
+
+        self.first_tick = self.keyframe_ticks[0]
+        # Ticks are recorded in order, the last state is the one after the last moves
+        self.last_tick = max(self.keyframe_ticks[-1], max(self.move_offsets, default=-1) + 1)
+
+    @classmethod
+    def open(cls, path: str) -> Replay:
+        with open(path, 'rb') as f:
+            return cls(f.read())
+
+    def keyframe(self, tick: int) -> Game:
+        """
+        :param tick: the tick of a keyframe
+        """
+        k = bisect.bisect_left(self.keyframe_ticks, tick)
+        if k == len(self.keyframe_ticks) or self.keyframe_ticks[k] != tick:
+            raise KeyError(f'no keyframe at tick {tick}')
+        offset = self.keyframe_offsets[k]
+        start = offset + RECORD.size
+        (length,) = LENGTH.unpack_from(self.data, start)
+        start += LENGTH.size
+        snapshot = json.loads(self.data[start:start + length])
+        start += length
+        (length,) = LENGTH.unpack_from(self.data, start)
+        start += LENGTH.size
+        snapshot['cells'] = zlib.decompress(self.data[start:start + length])
+        return Game.fromSnapshot(snapshot)
+
+    def moves(self, tick: int) -> dict[str, Moveset]:
+        """
+        Moves applied while the game was at tick, {playerName: Moveset}
+        """
+        start = self.move_offsets[tick]
+        moves = {}
+        for i, player_name in enumerate(self.players):
+            code = (self.data[start + i // 2] >> (4 * (i % 2))) & 0xF
+            if code:
+                moves[player_name] = MOVES_ORDER[code - 1]
+        return moves
+
+    def seek(self, tick: int) -> Game:
+        """
+        :return: a new Game in the state it had at tick
+        """
+        if not self.first_tick <= tick <= self.last_tick:
+            raise IndexError(f'tick {tick} is outside the recording, {self.first_tick} to {self.last_tick}')
+        start = self.keyframe_ticks[bisect.bisect_right(self.keyframe_ticks, tick) - 1]
+        game = self.keyframe(start)
+        for t in range(start, tick):
+            game.applyMoves(self.moves(t))
+        return game
+
+    def play(self, start: int = None, stop: int = None):
+        """
+        Yields the game at every tick from start up to and including stop, the same Game object advanced in place
+        """
+        start = self.first_tick if start is None else start
+        stop = self.last_tick if stop is None else stop
+        game = self.seek(start)
+        yield game
+        for tick in range(start, stop):
+            game.applyMoves(self.moves(tick))
+            yield game
+
+    def verify(self) -> list[str]:
+        """
+        Replays the whole recording and checks it against every keyframe and the final scores
+        :return: descriptions of the mismatches, empty when the recording replays exactly
+        """
+        errors = []
+        keyframes = set(self.keyframe_ticks[1:])
+        for game in self.play():
+            if game.tick in keyframes and game.snapshot() != self.keyframe(game.tick).snapshot():
+                errors.append(f'tick {game.tick}: replayed state differs from the keyframe')
+        if self.scores is not None and game.getScores() != self.scores:
+            errors.append(f'final scores {game.getScores()} differ from the recorded {self.scores}')
+        return errors
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path')
+    parser.add_argument('--tick', type=int, help='print the board and scores at this tick, the last tick by default')
+    parser.add_argument('--verify', action='store_true', help='replay every tick and check the keyframes and final scores')
+    args = parser.parse_args()
+
+    replay = Replay.open(args.path)
+    print(f'ticks {replay.first_tick} to {replay.last_tick}, {len(replay.keyframe_ticks)} keyframes, players {replay.players}')
+    if args.verify:
+        errors = replay.verify()
+        for error in errors:
+            print(error)
+        print('replay matches the recording' if not errors else f'{len(errors)} mismatches')
+    else:
+        start = time.perf_counter()
+        game = replay.seek(replay.last_tick if args.tick is None else args.tick)
+        seconds = time.perf_counter() - start
+        print(game.map)
+        print(f'tick {game.tick} scores {game.getScores()} (seek took {seconds * 1000:.2f} ms)')
@@ -0,0 +1,251 @@
+"""
+Sharded mode of the game server: a supervisor owns the broker subscription and routes every message
+to one of N worker processes by a stable hash of its lobby name, so each lobby lives in exactly one worker.
+"""
+
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import zlib
+
+import gameLogging
+from GameClient import GameServer, get_lobby_name
+from checkpoint import CheckpointStore
+from InputTypes import LobbyConfig
+from lobbyRegistry import LobbyRegistry
+from mapPool import MapPool
+from transport import Message, PahoTransport, Transport
+
+log = logging.getLogger('GameClient.shard')
+
+
+def shard_of(lobby_name: str, num_shards: int) -> int:
+    """
+    Stable across processes and restarts, unlike hash()
+    """
+    if lobby_name is None:
+        return 0
+    return zlib.crc32(lobby_name.encode()) % num_shards
+
+
+class QueueTransport(Transport):
+    def __init__(self, inbox: multiprocessing.Queue, outbox: multiprocessing.Queue = None, connection: Transport = None):
+        """
+        Worker side of a shard. Messages arrive from the supervisor on inbox.
+        Publishes made while handling one inbox batch go back to the supervisor as a single batch on outbox,
+        or straight out through the worker's own connection when there is one.
+        """
+        super().__init__()
+        self.inbox = inbox
+        self.outbox = outbox
+        self.connection = connection
+        self.__pending = []
+        self.__loop_thread: threading.Thread = None
+
+    def publish(self, topic: str, payload=None, qos: int = 0, retain: bool = False):
+        if self.connection is not None:
+            self.connection.publish(topic, payload, qos, retain)
+        elif threading.current_thread() is self.__loop_thread:
+            self.__pending.append((topic, payload, qos, retain))
+        else:
+            # Turn timers publish from the scheduler thread, no inbox batch is going to flush those
+            self.outbox.put([(topic, payload, qos, retain)])
+
+    def publish_many(self, messages):
+        if self.connection is not None:
+            self.connection.publish_many(messages)
+        elif threading.current_thread() is self.__loop_thread:
+            self.__pending.extend(messages)
+        else:
+            self.outbox.put(list(messages))
+
+    def subscribe(self, topic: str, qos: int = 0):
+        # The supervisor holds the subscriptions
+        pass
+
+    def unsubscribe(self, topic: str):
+        pass
+
+    def loop_forever(self):
+        self.__loop_thread = threading.current_thread()
+        while True:
+            batch = self.inbox.get()
+            if batch is None:
+                return
+            for topic, payload, qos in batch:
+                try:
+                    self.on_message(self, None, Message(topic, payload, qos))
+                except Exception:
+                    # One bad message must not take down the worker and every lobby of its shard
+                    log.exception('Error handling %s', topic)
+            if self.__pending:
+                self.outbox.put(self.__pending)
+                self.__pending = []
+
+    def loop_start(self):
+        pass
+
+    def loop_stop(self):
+        pass
+
+    def disconnect(self):
+        if self.connection is not None:
+            self.connection.loop_stop()
+            self.connection.disconnect()
+
+
+def run_worker(index: int, inbox: multiprocessing.Queue, outbox: multiprocessing.Queue, connection_args: dict = None,
+               default_config: LobbyConfig = None, lobbies: LobbyRegistry = None, checkpoint: tuple = None,
+               maps: tuple = None, logging_settings: tuple = None, metrics_interval: float = None):
+    """
+    :param checkpoint: (path, interval) of the shard's CheckpointStore
+    :param maps: (sizes, depth, refill_rate) of the shard's MapPool
+    :param logging_settings: gameLogging.settings() of the supervisor, the worker gets its own listener thread
+    :param metrics_interval: seconds between the worker's metrics samples, published on games/$sys/metrics/shard<index>
+    """
+    if logging_settings is not None:
+        gameLogging.setup_logging(*logging_settings)
+    connection = None
+    if connection_args is not None:
+        connection = PahoTransport(client_id=f"GameClient-shard{index}", **connection_args)
+        connection.loop_start()
+    transport = QueueTransport(inbox, outbox, connection)
+    checkpoints = CheckpointStore(*checkpoint) if checkpoint is not None else None
+    server = GameServer(transport, default_config, lobbies, checkpoints, MapPool(*maps) if maps is not None else None)
+    server.metrics_topic = f'{server.metrics_topic}/shard{index}'
+    if metrics_interval is not None:
+        server.metrics_interval = metrics_interval
+    server.start()
+    transport.loop_forever()
+    transport.disconnect()
+
+
+class ShardedGameServer:
+    WATCH_INTERVAL = 1.0 # Seconds between checks for workers that died
+
+    def __init__(self, transport: Transport, workers: int = None, connection_args: dict = None, max_batch: int = 64,
+                 default_config: LobbyConfig = None, lobbies: LobbyRegistry = None, checkpoints: CheckpointStore = None,
+                 maps: MapPool = None):
+        """
+        :param transport: the supervisor's connection, which receives every message
+        :param workers: number of worker processes, one per core by default
+        :param connection_args: PahoTransport arguments for one outbound connection per worker,
+                                by default workers publish back through the supervisor's connection
+        :param max_batch: most messages forwarded to a worker in one queue put
+        :param default_config: options of lobbies that set no config of their own, used by every worker
+        :param lobbies: empty registry copied to every worker, so its lobby limit applies per worker
+        :param checkpoints: every worker checkpoints to its own file next to checkpoints.path, lobbies are assigned
+                            to workers by name so restarts must keep the number of workers
+        :param maps: every worker fills a map pool of its own with the same settings
+        """
+        self.transport = transport
+        self.transport.on_message = self.on_message
+        self.num_workers = workers or os.cpu_count()
+        self.connection_args = connection_args
+        self.max_batch = max_batch
+        self.default_config = default_config
+        self.lobbies = lobbies
+        self.checkpoints = checkpoints
+        self.maps = maps
+        self.metrics_interval: float = None # Seconds between the metrics samples of every worker, the default when None
+        self.outbox = multiprocessing.Queue()
+        self.inboxes = [multiprocessing.Queue() for _ in range(self.num_workers)]
+        self.workers: list[multiprocessing.Process] = []
+        self.__routed = [queue.SimpleQueue() for _ in range(self.num_workers)]
+        self.__threads: list[threading.Thread] = []
+        self.__stopping = threading.Event()
+        self.restarts = 0
+
+    def on_message(self, client, userdata, msg):
+        lobby_name = get_lobby_name(msg.topic, msg.payload)
+        self.__routed[shard_of(lobby_name, self.num_workers)].put((msg.topic, bytes(msg.payload), msg.qos))
+
+    def __forward(self, index: int):
+        # Drains what arrived for a worker and ships it in one put, which keeps pickling and pipe writes per batch
+        routed, inbox = self.__routed[index], self.inboxes[index]
+        while True:
+            msg = routed.get()
+            if msg is None:
+                inbox.put(None)
+                return
+            batch = [msg]
+            while len(batch) < self.max_batch:
+                try:
+                    msg = routed.get_nowait()
+                except queue.Empty:
+                    break
+                if msg is None:
+                    inbox.put(batch)
+                    inbox.put(None)
+                    return
+                batch.append(msg)
+            inbox.put(batch)
+
+    def __publish_outbound(self):
+        while True:
+            batch = self.outbox.get()
+            if batch is None:
+                return
+            self.transport.publish_many(batch)
+
+    def __shard_checkpoint(self, index: int) -> tuple:
+        if self.checkpoints is None:
+            return None
+        return f'{self.checkpoints.path}.shard{index}', self.checkpoints.interval
+
+    def __shard_maps(self) -> tuple:
+        if self.maps is None:
+            return None
+        return self.maps.sizes, self.maps.depth, self.maps.refill_rate
+
+    def __start_worker(self, index: int) -> multiprocessing.Process:
+        worker = multiprocessing.Process(target=run_worker, name=f'GameClient-shard{index}', daemon=True,
+                                         args=(index, self.inboxes[index], self.outbox, self.connection_args, self.default_config,
+                                               self.lobbies, self.__shard_checkpoint(index), self.__shard_maps(),
+                                               gameLogging.settings(), self.metrics_interval))
+        worker.start()
+        return worker
+
+    def __watch(self):
+        # A dead worker would leave its inbox filling up with nobody to read it
+        while not self.__stopping.wait(self.WATCH_INTERVAL):
+            for index, worker in enumerate(self.workers):
+                if worker.is_alive() or self.__stopping.is_set():
+                    continue
+                if self.checkpoints is not None:
+                    log.error('Worker of shard %d exited with code %s, restarting it from %s', index, worker.exitcode,
+                              self.__shard_checkpoint(index)[0])
+                else:
+                    log.error('Worker of shard %d exited with code %s, restarting it, its lobbies are lost without --checkpoint',
+                              index, worker.exitcode)
+                # The new worker reads the same inbox, so what was queued for the shard meanwhile is still handled
+                self.workers[index] = self.__start_worker(index)
+                self.restarts += 1
+
+    def start(self):
+        for index in range(self.num_workers):
+            self.workers.append(self.__start_worker(index))
+            self.__threads.append(threading.Thread(target=self.__forward, args=(index,), daemon=True))
+        self.__threads.append(threading.Thread(target=self.__publish_outbound, daemon=True))
+        self.__threads.append(threading.Thread(target=self.__watch, name='ShardWatch', daemon=True))
+        for thread in self.__threads:
+            thread.start()
+        for topic in GameServer.SUBSCRIPTIONS:
+            self.transport.subscribe(topic)
+
+    def serve_forever(self):
+        self.start()
+        try:
+            self.transport.loop_forever()
+        finally:
+            self.stop()
+
+    def stop(self):
+        self.__stopping.set()
+        for routed in self.__routed:
+            routed.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.outbox.put(None)
@@ -0,0 +1,95 @@
+"""
+Delta encoding of the game_state payloads published to each player
+"""
+
+from typing import Optional
+
+
+# Location lists of a game_state that are diffed between ticks, teammates are sent whole when they change
+LOCATION_KEYS = ('enemyPositions', 'coin1', 'coin2', 'coin3', 'walls')
+
+
+class DeltaTracker:
+    def __init__(self, keyframeInterval: int = 20):
+        """
+        Remembers the last game_state sent to each player of one lobby
+        :param keyframeInterval: number of ticks between full keyframes for a player
+        """
+        assert isinstance(keyframeInterval, int) and keyframeInterval > 0
+        self.keyframeInterval = keyframeInterval
+        self.__last: dict[str, dict] = {}
+        self.__sinceKeyframe: dict[str, int] = {}
+        self.__lastScores: Optional[dict] = None
+
+    def encode(self, playerName: str, gameData: dict, tick: int, keyframe: bool = False) -> dict:
+        """
+        :param gameData: the full payload from Game.getGameData
+        :param keyframe: force a full keyframe, e.g. when the client asked for a resync
+        :return: {type: 'keyframe', tick, **gameData} or
+                 {type: 'delta', tick, currentPosition?, teammateNames?, teammatePositions?,
+                  added?: {key: [(x,y),...]}, removed?: {key: [(x,y),...]}}
+        """
+        last = self.__last.get(playerName)
+        self.__last[playerName] = gameData
+
+        if keyframe or last is None or self.__sinceKeyframe[playerName] + 1 >= self.keyframeInterval:
+            self.__sinceKeyframe[playerName] = 0
+            return {'type': 'keyframe', 'tick': tick, **gameData}
+        self.__sinceKeyframe[playerName] += 1
+
+        payload = {'type': 'delta', 'tick': tick}
+        if gameData['currentPosition'] != last['currentPosition']:
+            payload['currentPosition'] = gameData['currentPosition']
+        if gameData['teammateNames'] != last['teammateNames'] or gameData['teammatePositions'] != last['teammatePositions']:
+            payload['teammateNames'] = gameData['teammateNames']
+            payload['teammatePositions'] = gameData['teammatePositions']
+
+        for key in LOCATION_KEYS:
+            if gameData[key] == last[key]:
+                continue
+            old, new = set(last[key]), set(gameData[key])
+            added = [loc for loc in gameData[key] if loc not in old]
+            removed = [loc for loc in last[key] if loc not in new]
+            if added:
+                payload.setdefault('added', {})[key] = added
+            if removed:
+                payload.setdefault('removed', {})[key] = removed
+
+        return payload
+
+    def scoresChanged(self, scores: dict) -> bool:
+        """
+        Records scores and reports whether they differ from the last published ones
+        """
+        if scores == self.__lastScores:
+            return False
+        self.__lastScores = dict(scores)
+        return True
+
+
+def applyDelta(state: Optional[dict], payload: dict) -> dict:
+    """
+    Client side counterpart of DeltaTracker.encode, rebuilds the full game_state from the previous one
+    :param state: the previously rebuilt game_state, None before the first keyframe
+    :param payload: a decoded keyframe or delta
+    """
+    if payload['type'] == 'keyframe':
+        state = {key: value for key, value in payload.items() if key not in ('type', 'tick')}
+        return state
+    if state is None:
+        raise ValueError('Received a delta before any keyframe, request a resync')
+
+    state = dict(state)
+    for key in ('currentPosition', 'teammateNames', 'teammatePositions'):
+        if key in payload:
+            state[key] = payload[key]
+    for key in LOCATION_KEYS:
+        removed = payload.get('removed', {}).get(key)
+        added = payload.get('added', {}).get(key)
+        if removed is None and added is None:
+            continue
+        # JSON turns coordinate tuples into lists, compare them as tuples
+        removed = {tuple(loc) for loc in removed or ()}
+        locations = [loc for loc in state[key] if tuple(loc) not in removed] + list(added or ())
+        state[key] = sorted(locations, key=tuple)
+    return state
@@ -0,0 +1,106 @@
+"""
+Timers that drive turn resolution. One hashed timer wheel serves every lobby of a server,
+so scheduling, cancelling and firing a turn deadline stay O(1) however many lobbies are running.
+"""
+
+import threading
+import time
+
+
+class Timer:
+    __slots__ = ('tick', 'callback', 'args', 'cancelled')
+
+    def __init__(self, tick: int, callback, args: tuple):
+        self.tick = tick
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        # Cancelled timers stay in their slot and are skipped when it comes around
+        self.cancelled = True
+
+
+class TimerWheel:
+    def __init__(self, resolution: float = 0.005, slots: int = 512, now: float = 0.0):
+        """
+        Hashed timer wheel, timers fire at the first advance() at or after their resolution step
+        :param resolution: seconds per slot, the precision of the timers
+        :param slots: timers further out than slots * resolution wait in their slot for later rounds
+        """
+        self.resolution = resolution
+        self.slots: list[list[Timer]] = [[] for _ in range(slots)]
+        self.current = int(now / resolution)
+        self.pending = 0
+
+    def schedule(self, when: float, callback, *args) -> Timer:
+        timer = Timer(max(int(when / self.resolution), self.current), callback, args)
+        self.slots[timer.tick % len(self.slots)].append(timer)
+        self.pending += 1
+        return timer
+
+    def advance(self, now: float) -> list[Timer]:
+        """
+        :return: the timers due by now, in the order of their deadlines
+        """
+        due = []
+        target = int(now / self.resolution)
+        # An idle wheel can jump ahead, a full turn of the wheel visits every slot once
+        steps = min(target - self.current + 1, len(self.slots)) if self.pending else 0
+        for step in range(steps):
+            slot = self.slots[(self.current + step) % len(self.slots)]
+            if not slot:
+                continue
+            waiting = []
+            for timer in slot:
+                if timer.cancelled:
+                    self.pending -= 1
+                elif timer.tick <= target:
+                    self.pending -= 1
+                    due.append(timer)
+                else:
+                    waiting.append(timer)
+            slot[:] = waiting
+        self.current = max(self.current, target + 1)
+        due.sort(key=lambda timer: timer.tick)
+        return due
+
+
+class TickScheduler:
+    def __init__(self, resolution: float = 0.005, slots: int = 512):
+        """
+        Runs a TimerWheel on its own thread, which is started by the first call_at()
+        Callbacks run on that thread and must not block, they should only hand work to the server.
+        """
+        self.wheel = TimerWheel(resolution, slots, time.monotonic())
+        self.lock = threading.Lock()
+        self.thread: threading.Thread = None
+        self.__stopped = threading.Event()
+
+    def call_at(self, when: float, callback, *args) -> Timer:
+        """
+        :param when: time.monotonic() deadline
+        """
+        with self.lock:
+            timer = self.wheel.schedule(when, callback, *args)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.__run, name='TickScheduler', daemon=True)
+                self.thread.start()
+        return timer
+
+    def call_later(self, delay: float, callback, *args) -> Timer:
+        return self.call_at(time.monotonic() + delay, callback, *args)
+
+    def stop(self):
+        self.__stopped.set()
+
+    def __run(self):
+        resolution = self.wheel.resolution
+        while not self.__stopped.is_set():
+            with self.lock:
+                due = self.wheel.advance(time.monotonic())
+            for timer in due:
+                if not timer.cancelled:
+                    timer.callback(*timer.args)
+            # Sleep to the start of the next slot rather than a fixed amount, so firing times do not drift
+            self.__stopped.wait(resolution - time.monotonic() % resolution)
@@ -0,0 +1,354 @@
+"""
+Message transports the game server and bots run on: the paho MQTT client or an in-process bus.
+Both call on_message(client, userdata, msg) like paho, so the same callbacks work with either.
+"""
+
+import os
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from typing import Callable, Optional
+
+
+class Message:
+    """
+    The parts of paho's MQTTMessage that the callbacks use
+    """
+    __slots__ = ('topic', 'payload', 'qos', 'retain')
+
+    def __init__(self, topic: str, payload: bytes, qos: int = 0, retain: bool = False):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+
+
+def to_payload(payload) -> bytes:
+    """
+    Converts a payload the way paho does, bytes are passed through without a copy
+    """
+    if payload is None:
+        return b''
+    if isinstance(payload, (bytes, bytearray, memoryview)):
+        return payload
+    if isinstance(payload, str):
+        return payload.encode()
+    if isinstance(payload, (int, float)):
+        return str(payload).encode()
+    raise TypeError('payload must be a string, bytearray, int, float or None.')
+
+
+def topic_matches(pattern: str, topic: str) -> bool:
+    """
+    MQTT topic filter matching with + and # wildcards, which never match topics starting with $
+    """
+    if pattern == topic:
+        return True
+    if topic.startswith('$') and pattern[:1] in ('+', '#'):
+        return False
+    pattern_levels = pattern.split('/')
+    topic_levels = topic.split('/')
+    for i, level in enumerate(pattern_levels):
+        if level == '#':
+            return True
+        if i >= len(topic_levels):
+            return False
+        if level != '+' and level != topic_levels[i]:
+            return False
+    return len(pattern_levels) == len(topic_levels)
+
+
+class Transport(ABC):
+    def __init__(self):
+        # on_message(client, userdata, msg), same signature as the paho callback
+        self.on_message: Optional[Callable] = None
+
+    @abstractmethod
+    def publish(self, topic: str, payload=None, qos: int = 0, retain: bool = False):
+        ...
+
+    def publish_many(self, messages):
+        """
+        Publishes a batch in order, transports that can send a batch cheaper than one publish at a time override this
+        :param messages: iterable of (topic, payload, qos, retain)
+        """
+        for message in messages:
+            self.publish(*message)
+
+    @abstractmethod
+    def subscribe(self, topic: str, qos: int = 0):
+        ...
+
+    @abstractmethod
+    def unsubscribe(self, topic: str):
+        ...
+
+    @abstractmethod
+    def loop_forever(self):
+        ...
+
+    @abstractmethod
+    def loop_start(self):
+        ...
+
+    @abstractmethod
+    def loop_stop(self):
+        ...
+
+    @abstractmethod
+    def disconnect(self):
+        ...
+
+
+class PahoTransport(Transport):
+    def __init__(self, client_id: str, broker_address: str, broker_port: int,
+                 username: str = None, password: str = None, tls: bool = True, will: tuple = None):
+        """
+        Connects a paho MQTTv5 client, the paho client stays available as .client for its own callbacks
+        :param tls: disable for a local broker such as mosquitto on localhost
+        :param will: (topic, payload, qos, retain) the broker publishes when the connection is lost
+        """
+        import paho.mqtt.client as paho
+        from paho import mqtt
+
+        super().__init__()
+        self.client = paho.Client(callback_api_version=paho.CallbackAPIVersion.VERSION1, client_id=client_id, userdata=None, protocol=paho.MQTTv5)
+        if tls:
+            # enable TLS for secure connection
+            self.client.tls_set(tls_version=mqtt.client.ssl.PROTOCOL_TLS)
+        if username is not None:
+            self.client.username_pw_set(username, password)
+        if will is not None:
+            self.client.will_set(*will)
+        self.client.on_message = self.__on_message
+        self.client.on_connect = self.__on_connect
+        # Topic aliases granted by the broker in CONNACK, none until connected
+        self.topic_alias_maximum = 0
+        self.__aliases: OrderedDict[str, int] = OrderedDict()
+        self.__alias_lock = threading.Lock()
+        self.client.connect(broker_address, broker_port)
+
+    @staticmethod
+    def env_args(dotenv_path: str = './credentials.env') -> dict:
+        """
+        Connection arguments from the BROKER_ADDRESS, BROKER_PORT, USER_NAME and PASSWORD in credentials.env
+        """
+        from dotenv import load_dotenv
+
+        load_dotenv(dotenv_path=dotenv_path)
+        return {'broker_address': os.environ.get('BROKER_ADDRESS'),
+                'broker_port': int(os.environ.get('BROKER_PORT')),
+                'username': os.environ.get('USER_NAME'),
+                'password': os.environ.get('PASSWORD')}
+
+    @classmethod
+    def from_env(cls, client_id: str, dotenv_path: str = './credentials.env', **kwargs) -> 'PahoTransport':
+        return cls(client_id, **PahoTransport.env_args(dotenv_path), **kwargs)
+
+    def __on_message(self, client, userdata, msg):
+        if self.on_message is not None:
+            self.on_message(self, userdata, msg)
+
+    def __on_connect(self, client, userdata, flags, rc, properties=None):
+        # Aliases only live as long as the connection
+        with self.__alias_lock:
+            self.__aliases.clear()
+            self.topic_alias_maximum = getattr(properties, 'TopicAliasMaximum', 0)
+
+    def publish(self, topic: str, payload=None, qos: int = 0, retain: bool = False):
+        return self.client.publish(topic, payload, qos, retain)
+
+    def publish_many(self, messages):
+        """
+        Sends repeated topics as MQTT v5 topic aliases, the broker's alias slots hold the most recently used topics
+        """
+        if not self.topic_alias_maximum:
+            return super().publish_many(messages)
+        from paho.mqtt.packettypes import PacketTypes
+        from paho.mqtt.properties import Properties
+
+        with self.__alias_lock:
+            for topic, payload, qos, retain in messages:
+                properties = Properties(PacketTypes.PUBLISH)
+                alias = self.__aliases.get(topic)
+                if alias is not None:
+                    self.__aliases.move_to_end(topic)
+                    properties.TopicAlias = alias
+                    self.client.publish('', payload, qos, retain, properties)
+                    continue
+                if len(self.__aliases) < self.topic_alias_maximum:
+                    alias = len(self.__aliases) + 1
+                else:
+                    alias = self.__aliases.popitem(last=False)[1]
+                self.__aliases[topic] = alias
+                properties.TopicAlias = alias
+                self.client.publish(topic, payload, qos, retain, properties)
+
+    def subscribe(self, topic: str, qos: int = 0):
+        return self.client.subscribe(topic, qos)
+
+    def unsubscribe(self, topic: str):
+        return self.client.unsubscribe(topic)
+
+    def loop_forever(self):
+        self.client.loop_forever()
+
+    def loop_start(self):
+        self.client.loop_start()
+
+    def loop_stop(self):
+        self.client.loop_stop()
+
+    def disconnect(self):
+        self.client.disconnect()
+
+
+class InMemoryBus:
+    """
+    In-process stand-in for the broker. Messages are delivered in publish order on the thread that drains the queue,
+    payloads are handed to every subscriber as the same bytes object.
+    Shared subscriptions ($share/<group>/<filter>) hand each message to one member of the group in turn.
+    """
+    def __init__(self):
+        self.__lock = threading.RLock()
+        self.__exact: dict[str, dict['InMemoryTransport', int]] = {}
+        self.__wildcards: dict[str, dict['InMemoryTransport', int]] = {}
+        self.__shared: dict[tuple[str, str], dict['InMemoryTransport', int]] = {}
+        self.__turns: dict[tuple[str, str], int] = {}
+        self.__retained: dict[str, Message] = {}
+        self.__queue: deque[Message] = deque()
+        self.__delivering = False
+
+    def connect(self, client_id: str = '', will: tuple = None) -> 'InMemoryTransport':
+        return InMemoryTransport(self, client_id, will)
+
+    def subscribe(self, transport: 'InMemoryTransport', pattern: str, qos: int = 0):
+        if pattern.startswith('$share/'):
+            # Like MQTT v5, shared subscriptions get no retained messages
+            _, group, topic_filter = pattern.split('/', 2)
+            with self.__lock:
+                self.__shared.setdefault((group, topic_filter), {})[transport] = qos
+            return
+        with self.__lock:
+            table = self.__wildcards if '+' in pattern or '#' in pattern else self.__exact
+            table.setdefault(pattern, {})[transport] = qos
+            retained = [msg for topic, msg in self.__retained.items() if topic_matches(pattern, topic)]
+        for msg in retained:
+            transport.deliver(msg)
+
+    def unsubscribe(self, transport: 'InMemoryTransport', pattern: str = None):
+        """
+        :param pattern: None drops every subscription of transport
+        """
+        with self.__lock:
+            for table in (self.__exact, self.__wildcards):
+                for key in list(table.keys()):
+                    if pattern is None or key == pattern:
+                        table[key].pop(transport, None)
+                        if not table[key]:
+                            del table[key]
+            for group, topic_filter in list(self.__shared.keys()):
+                if pattern is None or pattern == f'$share/{group}/{topic_filter}':
+                    self.__shared[group, topic_filter].pop(transport, None)
+                    if not self.__shared[group, topic_filter]:
+                        del self.__shared[group, topic_filter]
+
+    def publish(self, topic: str, payload=None, qos: int = 0, retain: bool = False):
+        self.publish_many(((topic, payload, qos, retain),))
+
+    def publish_many(self, messages):
+        """
+        Queues the whole batch under one lock and delivers it in one drain
+        """
+        messages = [Message(topic, to_payload(payload), qos, retain) for topic, payload, qos, retain in messages]
+        with self.__lock:
+            for msg in messages:
+                if msg.retain:
+                    if msg.payload:
+                        self.__retained[msg.topic] = msg
+                    else:
+                        self.__retained.pop(msg.topic, None)
+            self.__queue.extend(messages)
+            if self.__delivering:
+                # Whoever is draining the queue delivers it, which keeps callbacks from nesting
+                return
+            self.__delivering = True
+        try:
+            self.__drain()
+        except BaseException:
+            with self.__lock:
+                self.__delivering = False
+            raise
+
+    def __drain(self):
+        while True:
+            with self.__lock:
+                if not self.__queue:
+                    # Cleared under the lock so a concurrent publish either sees it or gets drained here
+                    self.__delivering = False
+                    return
+                msg = self.__queue.popleft()
+                receivers = dict(self.__exact.get(msg.topic, {}))
+                for pattern, subscribers in self.__wildcards.items():
+                    if topic_matches(pattern, msg.topic):
+                        for transport, qos in subscribers.items():
+                            receivers.setdefault(transport, qos)
+                for key, members in self.__shared.items():
+                    if topic_matches(key[1], msg.topic):
+                        turn = self.__turns.get(key, 0)
+                        self.__turns[key] = turn + 1
+                        transport, qos = list(members.items())[turn % len(members)]
+                        receivers.setdefault(transport, qos)
+            for transport in receivers:
+                transport.deliver(msg)
+
+
+class InMemoryTransport(Transport):
+    def __init__(self, bus: InMemoryBus, client_id: str = '', will: tuple = None):
+        """
+        :param will: (topic, payload, qos, retain) published by drop()
+        """
+        super().__init__()
+        self.bus = bus
+        self.client_id = client_id
+        self.will = will
+        self.__stopped = threading.Event()
+
+    def deliver(self, msg: Message):
+        if self.on_message is not None:
+            self.on_message(self, None, msg)
+
+    def publish(self, topic: str, payload=None, qos: int = 0, retain: bool = False):
+        self.bus.publish(topic, payload, qos, retain)
+
+    def publish_many(self, messages):
+        self.bus.publish_many(messages)
+
+    def subscribe(self, topic: str, qos: int = 0):
+        self.bus.subscribe(self, topic, qos)
+
+    def unsubscribe(self, topic: str):
+        self.bus.unsubscribe(self, topic)
+
+    def loop_forever(self):
+        # Messages are delivered by the bus, just block until disconnected
+        self.__stopped.wait()
+
+    def loop_start(self):
+        pass
+
+    def loop_stop(self):
+        pass
+
+    def disconnect(self):
+        self.bus.unsubscribe(self)
+        self.__stopped.set()
+
+    def drop(self):
+        """
+        Loses the connection without a clean disconnect, so the will is published like a broker would
+        """
+        self.bus.unsubscribe(self)
+        self.__stopped.set()
+        if self.will is not None:
+            self.bus.publish(*self.will)
@@ -0,0 +1,139 @@
+"""
+Binary encoding of game_state and move payloads, used by lobbies whose config sets encoding to 'binary'.
+
+A game_state only ever shows the (2r+1) x (2r+1) window around its player, so every location is sent as one byte,
+its index in that window, instead of a pair of absolute coordinates:
+
+    magic 0xC5, version, tick uint32, x uint16, y uint16, radius uint8
+    counts of teammatePositions, enemyPositions, coin1, coin2, coin3, walls, one byte each
+    the window indices of those locations in the same order
+    teammateNames as a length byte and utf-8 bytes each, in the order of teammatePositions
+
+Move batches pack four moves into a byte: magic 0xC6, version, tick uint32, count uint8, moves.
+A combined turn message holds the binary states of several players: magic 0xC7, version, count uint16,
+then per player a length byte and utf-8 name, a uint16 length and the state.
+JSON payloads start with '{' or a letter, so the first byte tells the encodings apart.
+"""
+
+import struct
+from functools import lru_cache
+
+
+STATE_MAGIC = 0xC5
+MOVES_MAGIC = 0xC6
+TICK_MAGIC = 0xC7
+VERSION = 1
+
+# Location lists of a game_state in the order they are encoded
+LOCATION_KEYS = ('teammatePositions', 'enemyPositions', 'coin1', 'coin2', 'coin3', 'walls')
+MOVE_NAMES = ('UP', 'DOWN', 'LEFT', 'RIGHT')
+MOVE_CODES = {name: code for code, name in enumerate(MOVE_NAMES)}
+
+STATE_HEADER = struct.Struct('<BBIHHB6B')
+MOVES_HEADER = struct.Struct('<BBIB')
+TICK_HEADER = struct.Struct('<BBH')
+LENGTH = struct.Struct('<H')
+
+
+def is_binary(payload: bytes) -> bool:
+    return payload[:1] in (b'\xc5', b'\xc6', b'\xc7')
+
+
+def encode_state(game_data: dict, tick: int, radius: int = 2) -> bytes:
+    """
+    :param game_data: the payload from Game.getGameData with the same vision radius
+    """
+    assert 0 <= radius <= 7, 'window indices must fit in a byte'
+    x, y = game_data['currentPosition']
+    side = 2 * radius + 1
+    # Index of (i, j) in the window centred on (x, y) is (i - x + radius) * side + (j - y + radius)
+    base = (radius - x) * side + radius - y
+    locations = [game_data[key] for key in LOCATION_KEYS]
+    parts = [STATE_HEADER.pack(STATE_MAGIC, VERSION, tick, x, y, radius, *map(len, locations))]
+    parts.extend(bytes([i * side + j + base for i, j in locs]) for locs in locations)
+    for name in game_data['teammateNames']:
+        name = name.encode()
+        parts.append(bytes((len(name),)))
+        parts.append(name)
+    return b''.join(parts)
+
+
+@lru_cache(maxsize=4096)
+def window_locations(x: int, y: int, radius: int) -> tuple:
+    """
+    Board location of every window index around (x, y), players revisit cells so the tables are cached
+    """
+    side = 2 * radius + 1
+    return tuple((x - radius + index // side, y - radius + index % side) for index in range(side * side))
+
+
+def decode_state(payload: bytes) -> dict:
+    """
+    :return: the game_state dict with a 'tick' entry, locations as (x, y) tuples
+    """
+    magic, version, tick, x, y, radius, *counts = STATE_HEADER.unpack_from(payload)
+    if magic != STATE_MAGIC or version != VERSION:
+        raise ValueError('not a binary game_state')
+    locations = window_locations(x, y, radius)
+    game_data = {'tick': tick, 'currentPosition': (x, y)}
+    offset = STATE_HEADER.size
+    for key, count in zip(LOCATION_KEYS, counts):
+        game_data[key] = [locations[index] for index in payload[offset:offset + count]]
+        offset += count
+    names = []
+    for _ in range(counts[0]):
+        length = payload[offset]
+        names.append(payload[offset + 1:offset + 1 + length].decode())
+        offset += 1 + length
+    game_data['teammateNames'] = names
+    return game_data
+
+
+def encode_moves(tick: int, moves: list[str]) -> bytes:
+    assert 0 < len(moves) <= 255
+    packed = bytearray((len(moves) + 3) // 4)
+    for i, move in enumerate(moves):
+        packed[i // 4] |= MOVE_CODES[move] << (2 * (i % 4))
+    return MOVES_HEADER.pack(MOVES_MAGIC, VERSION, tick, len(moves)) + packed
+
+
+def decode_moves(payload: bytes) -> tuple[int, list[str]]:
+    """
+    :return: (tick, moves) in the shape of InputTypes.MoveBatch
+    """
+    magic, version, tick, count = MOVES_HEADER.unpack_from(payload)
+    if magic != MOVES_MAGIC or version != VERSION or len(payload) < MOVES_HEADER.size + (count + 3) // 4:
+        raise ValueError('not a binary move batch')
+    packed = payload[MOVES_HEADER.size:]
+    return tick, [MOVE_NAMES[(packed[i // 4] >> (2 * (i % 4))) & 3] for i in range(count)]
+
+
+def encode_tick(states: dict[str, bytes]) -> bytes:
+    parts = [TICK_HEADER.pack(TICK_MAGIC, VERSION, len(states))]
+    for name, state in states.items():
+        name = name.encode()
+        parts.append(bytes((len(name),)))
+        parts.append(name)
+        parts.append(LENGTH.pack(len(state)))
+        parts.append(state)
+    return b''.join(parts)
+
+
+def decode_tick(payload: bytes) -> dict[str, bytes]:
+    """
+    :return: {playerName: binary game_state}, decode each with decode_state
+    """
+    magic, version, count = TICK_HEADER.unpack_from(payload)
+    if magic != TICK_MAGIC or version != VERSION:
+        raise ValueError('not a binary turn message')
+    states = {}
+    offset = TICK_HEADER.size
+    for _ in range(count):
+        length = payload[offset]
+        name = payload[offset + 1:offset + 1 + length].decode()
+        offset += 1 + length
+        (length,) = LENGTH.unpack_from(payload, offset)
+        offset += LENGTH.size
+        states[name] = payload[offset:offset + length]
+        offset += length
+    return states
@@ -0,0 +1,97 @@
+"""
+Worker pool mode of the game server. The transport's network thread only files each message in its lobby's mailbox,
+so keepalives and intake never wait on game logic. A thread pool works through the mailboxes: a lobby runs on
+one worker at a time and in the order its messages arrived, while different lobbies run on different workers.
+
+Timers, idle sweeps and checkpoints are posted to the mailboxes as well, so a lobby's state is only ever
+touched by the worker currently running that lobby.
+
+    python GameClient.py --mode pool --workers 8
+"""
+
+import functools
+import logging
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from GameClient import GameServer, checkpoint_lobby, get_lobby_name, on_message, sweep_lobbies, turn_deadline
+from checkpoint import CheckpointStore
+from InputTypes import LobbyConfig
+from lobbyRegistry import LobbyRegistry
+from mapPool import MapPool
+from transport import Transport
+
+log = logging.getLogger('GameClient.pool')
+
+
+class PooledGameServer(GameServer):
+    def __init__(self, transport: Transport, workers: int = None, max_burst: int = 16, default_config: LobbyConfig = None,
+                 lobbies: LobbyRegistry = None, checkpoints: CheckpointStore = None, maps: MapPool = None):
+        """
+        :param workers: threads running lobbies, by default the ThreadPoolExecutor default for this machine
+        :param max_burst: messages a lobby handles before its worker moves on to other lobbies
+        """
+        super().__init__(transport, default_config, lobbies, checkpoints, maps)
+        self.max_burst = max_burst
+        self.executor = ThreadPoolExecutor(workers or min(32, (os.cpu_count() or 1) + 4), thread_name_prefix='GameClient-lobby')
+        self.__mailboxes: dict[str, deque] = {}
+        self.__mailbox_lock = threading.Lock()
+
+    def on_message(self, client, userdata, msg):
+        # paho's network thread only takes the mailbox lock to file the message, a worker handles it
+        self.post(get_lobby_name(msg.topic, msg.payload), on_message, self, None, msg)
+
+    def on_timer(self, lobby, tick, deadline):
+        self.post(lobby.name, turn_deadline, self, lobby, tick, deadline)
+
+    def on_sweep(self):
+        sweep_lobbies(self)
+        self.scheduler.call_later(self.SWEEP_INTERVAL, self.on_sweep)
+
+    def on_checkpoint(self):
+        changed, removed = self.lobbies.take_changes()
+        self.checkpoints.submit(dict.fromkeys(removed))
+        for lobby_name in changed:
+            self.post(lobby_name, checkpoint_lobby, self, lobby_name)
+        self.scheduler.call_later(self.checkpoints.interval, self.on_checkpoint)
+
+    def post(self, lobby_name, fn, *args):
+        """
+        Queues fn(*args) behind the lobby's earlier work, messages that name no lobby share the None mailbox
+        """
+        with self.__mailbox_lock:
+            mailbox = self.__mailboxes.get(lobby_name)
+            if mailbox is None:
+                # A lobby only holds a worker while it has mail
+                mailbox = self.__mailboxes[lobby_name] = deque()
+                self.executor.submit(self.__run_lobby, lobby_name, mailbox)
+            mailbox.append(functools.partial(fn, *args))
+
+    def mailbox_depths(self) -> dict[str, int]:
+        with self.__mailbox_lock:
+            return {lobby_name: len(mailbox) for lobby_name, mailbox in self.__mailboxes.items()}
+
+    def queue_depths(self) -> dict[str, int]:
+        depths = self.mailbox_depths().values()
+        return {'mailboxes': sum(depths), 'mailbox_max': max(depths, default=0)}
+
+    def __run_lobby(self, lobby_name, mailbox: deque):
+        for _ in range(self.max_burst):
+            with self.__mailbox_lock:
+                if not mailbox:
+                    del self.__mailboxes[lobby_name]
+                    return
+                work = mailbox.popleft()
+            try:
+                work()
+            except Exception:
+                # The executor would keep the exception in a future nobody reads and end the burst, leaving the
+                # mailbox registered with no worker to drain it, so post would never submit the lobby again
+                log.exception('Error handling work for lobby %s', lobby_name)
+        # Back of the queue, so a busy lobby cannot hold a worker while others wait
+        self.executor.submit(self.__run_lobby, lobby_name, mailbox)
+
+    def stop(self):
+        self.executor.shutdown(wait=True)